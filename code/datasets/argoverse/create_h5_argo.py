@@ -3,6 +3,8 @@ import argparse
 import h5py
 import os
 import time
+from functools import partial
+from multiprocessing import get_context
 
 import numpy as np
 from argoverse.map_representation.map_api import ArgoverseMap
@@ -63,14 +65,155 @@ def get_args():
     parser.add_argument("--output-h5-path", type=str, required=True, help="output path to H5 files.")
     parser.add_argument("--raw-dataset-path", type=str, required=True, help="raw Dataset path to root of extracted files")
     parser.add_argument("--split-name", type=str, default="train", help="split-name to create", choices=["train", "val", "test"])
+    parser.add_argument("--num-workers", type=int, default=8, help="Number of sequence files processed in parallel.")
+    parser.add_argument("--grid-size", type=float, default=100.0, help="Size (m) of the cells of the lane index.")
     args = parser.parse_args()
     return args
 
 
+class LaneIndex:
+    """
+    Grid bucket index over the bounding boxes of the lane centerlines of one city, so that the lanes overlapping a
+    query box are found by only testing the lanes of the grid cells the box covers instead of every lane of the city.
+    Lanes are returned in the order of avm.city_lane_centerlines_dict[city_name].
+    """
+    def __init__(self, city_lane_props, grid_size):
+        self.grid_size = grid_size
+        # single point lanes are never used.
+        self.centerlines = [lane_props.centerline for lane_props in city_lane_props.values()
+                            if len(lane_props.centerline) > 1]
+        self.bboxes = np.array([[np.min(lane_cl[:, 0]), np.min(lane_cl[:, 1]), np.max(lane_cl[:, 0]), np.max(lane_cl[:, 1])]
+                                for lane_cl in self.centerlines]).reshape(-1, 4)
+
+        self.cells = {}
+        min_cells = np.floor(self.bboxes[:, :2] / grid_size).astype(int)
+        max_cells = np.floor(self.bboxes[:, 2:] / grid_size).astype(int)
+        for lane_idx, (min_cell, max_cell) in enumerate(zip(min_cells, max_cells)):
+            for cell_x in range(min_cell[0], max_cell[0] + 1):
+                for cell_y in range(min_cell[1], max_cell[1] + 1):
+                    self.cells.setdefault((cell_x, cell_y), []).append(lane_idx)
+
+    def query(self, query_bbox):
+        """
+        Returns the centerlines whose bounding box overlaps query_bbox = (xmin, xmax, ymin, ymax).
+        """
+        min_cell_x, max_cell_x = np.floor(np.array(query_bbox[:2]) / self.grid_size).astype(int)
+        min_cell_y, max_cell_y = np.floor(np.array(query_bbox[2:]) / self.grid_size).astype(int)
+        candidates = [lane_idx for cell_x in range(min_cell_x, max_cell_x + 1)
+                      for cell_y in range(min_cell_y, max_cell_y + 1)
+                      for lane_idx in self.cells.get((cell_x, cell_y), [])]
+        candidates = np.unique(np.array(candidates, dtype=int))
+
+        bboxes = self.bboxes[candidates]
+        overlaps = ((bboxes[:, 0] < query_bbox[1]) & (bboxes[:, 1] < query_bbox[3])
+                    & (bboxes[:, 2] > query_bbox[0]) & (bboxes[:, 3] > query_bbox[2]))
+        return [self.centerlines[lane_idx] for lane_idx in candidates[overlaps]]
+
+
+# set in the main process before the worker pool is forked, so that the loader and the lane indices are inherited by
+# the workers instead of being rebuilt or pickled for each of them.
+afl = None
+lane_indices = None
+
+
+def process_seq_file(seq_file, root_dir, num_timesteps, max_num_agents, max_num_roads):
+    fname = os.path.join(root_dir, seq_file)
+    df = afl.get(fname).seq_df
+
+    # Gather agents' trajectories
+    ego_x = df[df["OBJECT_TYPE"] == "AGENT"]["X"]
+    ego_y = df[df["OBJECT_TYPE"] == "AGENT"]["Y"]
+    ego_traj = np.column_stack((ego_x, ego_y, np.ones_like(ego_x)))
+    ego_timestamps = df[df["OBJECT_TYPE"] == "AGENT"]["TIMESTAMP"].values
+
+    ego_pred_timestamp = ego_timestamps[19]
+    others_traj = []
+    frames = df.groupby("TRACK_ID")
+    for group_name, group_data in frames:
+        object_type = group_data["OBJECT_TYPE"].values[0]
+        if "AGENT" in object_type:  # skip ego agent trajectory
+            continue
+
+        other_timestamp = group_data["TIMESTAMP"].values
+        if ego_pred_timestamp not in other_timestamp:
+            # ignore agents that are not there at the prediction time.
+            continue
+
+        other_x = group_data["X"].values
+        other_y = group_data["Y"].values
+        other_traj = np.column_stack((other_x, other_y, np.ones(len(other_x))))
+        if 10 <= len(other_traj) < num_timesteps:  # if we have an imcomplete trajectory of an 'other' agent.
+            temp_other_traj = np.zeros((num_timesteps, 3))
+
+            for j, timestamp in enumerate(ego_timestamps):
+                if timestamp == other_timestamp[0]:
+                    temp_other_traj[j:j+len(other_traj)] = other_traj
+                    break
+            other_traj = temp_other_traj.copy()
+        elif len(other_traj) < 10:
+            continue
+
+        if np.linalg.norm(other_traj[19, :2] - ego_traj[19, :2]) > 40:
+            continue
+
+        others_traj.append(other_traj)
+
+    # Rotating trajectories so that ego is going up.
+    ego_yaw = compute_yaw(ego_traj[:20, :2])
+    rot_ego_traj = convert_global_coords_to_local(ego_traj[:, :2], ego_traj[19, :2], ego_yaw)
+    rot_ego_traj = np.concatenate((rot_ego_traj, ego_traj[:, 2:]), axis=-1)
+    rot_others_traj = []
+    for other_traj in others_traj:
+        rot_other_traj = convert_global_coords_to_local(other_traj[:, :2], ego_traj[19, :2], ego_yaw)
+        rot_other_traj = rot_other_traj * other_traj[:, 2:]
+        rot_other_traj = np.column_stack((rot_other_traj[:, 0], rot_other_traj[:, 1], other_traj[:, 2]))
+        rot_others_traj.append(rot_other_traj)
+    rot_others_traj = np.array(rot_others_traj)
+    if len(rot_others_traj) == 0:
+        rot_others_traj = np.zeros((max_num_agents, num_timesteps, 3))
+    elif len(rot_others_traj) <= max_num_agents:
+        temp_rot_others_traj = np.zeros((max_num_agents, num_timesteps, 3))
+        temp_rot_others_traj[:len(rot_others_traj)] = rot_others_traj
+        rot_others_traj = temp_rot_others_traj.copy()
+    else:
+        dists = np.linalg.norm(rot_others_traj[:, 19, :2], axis=-1)
+        closest_inds = np.argsort(dists)[:max_num_agents]
+        rot_others_traj = rot_others_traj[closest_inds]
+
+    # Get lane centerlines which lie within the range of trajectories and rotate all lanes
+    city_name = df["CITY_NAME"].values[0]
+    query_bbox = (ego_traj[19, 0] - 50, ego_traj[19, 0] + 50, ego_traj[19, 1] - 50, ego_traj[19, 1] + 50)
+    lane_centerlines = []
+    for lane_cl in lane_indices[city_name].query(query_bbox):
+        lane_cl = convert_global_coords_to_local(lane_cl[:, :2], ego_traj[19, :2], ego_yaw)
+        lane_cl = np.concatenate((lane_cl, np.ones((len(lane_cl), 1))), axis=-1)  # adding existence mask
+        if len(lane_cl) < 10:
+            temp_lane_cl = np.zeros((10, 3))
+            temp_lane_cl[:len(lane_cl)] = lane_cl
+            lane_cl = temp_lane_cl.copy()
+        elif len(lane_cl) > 10:
+            print("found lane with more than 10 pts...")
+            continue
+
+        lane_centerlines.append(lane_cl)
+
+    lane_centerlines = np.array(lane_centerlines)
+    if len(lane_centerlines) <= max_num_roads:
+        temp_lane_centerlines = np.zeros((max_num_roads, 10, 3))
+        temp_lane_centerlines[:len(lane_centerlines)] = lane_centerlines
+        lane_centerlines = temp_lane_centerlines.copy()
+
+    extra = [int(seq_file.split(".")[0]), ego_yaw, ego_traj[19, 0], ego_traj[19, 1]]
+
+    return rot_ego_traj, rot_others_traj.transpose(1, 0, 2), lane_centerlines, ego_traj, np.array(extra)
+
+
 if __name__ == "__main__":
     args = get_args()
     root_dir = os.path.join(args.raw_dataset_path, args.split_name, 'data')
     avm = ArgoverseMap()
+    lane_indices = {city_name: LaneIndex(city_lane_props, args.grid_size)
+                    for city_name, city_lane_props in avm.city_lane_centerlines_dict.items()}
     afl = ArgoverseForecastingLoader(root_dir)  # simply change to your local path of the data
     start_time = time.time()
 
@@ -97,109 +240,18 @@ if __name__ == "__main__":
     orig_egos = f.create_dataset("orig_egos", shape=(num_scenes, num_timesteps, 3), chunks=(1, num_timesteps, 3),
                                  dtype=np.float32)
 
-    for i, seq_file in enumerate(seq_files):
-        if i % 1000 == 0:
-            print(i)
-        fname = os.path.join(root_dir, seq_file)
-        df = afl.get(fname).seq_df
-
-        # Gather agents' trajectories
-        ego_x = df[df["OBJECT_TYPE"] == "AGENT"]["X"]
-        ego_y = df[df["OBJECT_TYPE"] == "AGENT"]["Y"]
-        ego_traj = np.column_stack((ego_x, ego_y, np.ones_like(ego_x)))
-        ego_timestamps = df[df["OBJECT_TYPE"] == "AGENT"]["TIMESTAMP"].values
-
-        ego_pred_timestamp = ego_timestamps[19]
-        others_traj = []
-        frames = df.groupby("TRACK_ID")
-        for group_name, group_data in frames:
-            object_type = group_data["OBJECT_TYPE"].values[0]
-            if "AGENT" in object_type:  # skip ego agent trajectory
-                continue
-
-            other_timestamp = group_data["TIMESTAMP"].values
-            if ego_pred_timestamp not in other_timestamp:
-                # ignore agents that are not there at the prediction time.
-                continue
-
-            other_x = group_data["X"].values
-            other_y = group_data["Y"].values
-            other_traj = np.column_stack((other_x, other_y, np.ones(len(other_x))))
-            if 10 <= len(other_traj) < num_timesteps:  # if we have an imcomplete trajectory of an 'other' agent.
-                temp_other_traj = np.zeros((num_timesteps, 3))
-
-                for j, timestamp in enumerate(ego_timestamps):
-                    if timestamp == other_timestamp[0]:
-                        temp_other_traj[j:j+len(other_traj)] = other_traj
-                        break
-                other_traj = temp_other_traj.copy()
-            elif len(other_traj) < 10:
-                continue
-
-            if np.linalg.norm(other_traj[19, :2] - ego_traj[19, :2]) > 40:
-                continue
-
-            others_traj.append(other_traj)
-
-        # Rotating trajectories so that ego is going up.
-        ego_yaw = compute_yaw(ego_traj[:20, :2])
-        rot_ego_traj = convert_global_coords_to_local(ego_traj[:, :2], ego_traj[19, :2], ego_yaw)
-        rot_ego_traj = np.concatenate((rot_ego_traj, ego_traj[:, 2:]), axis=-1)
-        rot_others_traj = []
-        for other_traj in others_traj:
-            rot_other_traj = convert_global_coords_to_local(other_traj[:, :2], ego_traj[19, :2], ego_yaw)
-            rot_other_traj = rot_other_traj * other_traj[:, 2:]
-            rot_other_traj = np.column_stack((rot_other_traj[:, 0], rot_other_traj[:, 1], other_traj[:, 2]))
-            rot_others_traj.append(rot_other_traj)
-        rot_others_traj = np.array(rot_others_traj)
-        if len(rot_others_traj) == 0:
-            rot_others_traj = np.zeros((max_num_agents, num_timesteps, 3))
-        elif len(rot_others_traj) <= max_num_agents:
-            temp_rot_others_traj = np.zeros((max_num_agents, num_timesteps, 3))
-            temp_rot_others_traj[:len(rot_others_traj)] = rot_others_traj
-            rot_others_traj = temp_rot_others_traj.copy()
-        else:
-            dists = np.linalg.norm(rot_others_traj[:, 19, :2], axis=-1)
-            closest_inds = np.argsort(dists)[:max_num_agents]
-            rot_others_traj = rot_others_traj[closest_inds]
-
-        # Get lane centerlines which lie within the range of trajectories and rotate all lanes
-        city_name = df["CITY_NAME"].values[0]
-        seq_lane_props = avm.city_lane_centerlines_dict[city_name]
-        query_bbox = (ego_traj[19, 0] - 50, ego_traj[19, 0] + 50, ego_traj[19, 1] - 50, ego_traj[19, 1] + 50)
-        lane_centerlines = []
-        for lane_id, lane_props in seq_lane_props.items():
-            lane_cl = lane_props.centerline
-            if len(lane_cl) == 1:
-                continue
-
-            if (np.min(lane_cl[:, 0]) < query_bbox[1] and np.min(lane_cl[:, 1]) < query_bbox[3]
-                    and np.max(lane_cl[:, 0]) > query_bbox[0] and np.max(lane_cl[:, 1]) > query_bbox[2]):
-                lane_cl = convert_global_coords_to_local(lane_cl[:, :2], ego_traj[19, :2], ego_yaw)
-                lane_cl = np.concatenate((lane_cl, np.ones((len(lane_cl), 1))), axis=-1)  # adding existence mask
-                if len(lane_cl) < 10:
-                    temp_lane_cl = np.zeros((10, 3))
-                    temp_lane_cl[:len(lane_cl)] = lane_cl
-                    lane_cl = temp_lane_cl.copy()
-                elif len(lane_cl) > 10:
-                    print("found lane with more than 10 pts...")
-                    continue
-
-                lane_centerlines.append(lane_cl)
-
-        lane_centerlines = np.array(lane_centerlines)
-        if len(lane_centerlines) <= max_num_roads:
-            temp_lane_centerlines = np.zeros((max_num_roads, 10, 3))
-            temp_lane_centerlines[:len(lane_centerlines)] = lane_centerlines
-            lane_centerlines = temp_lane_centerlines.copy()
-
-        extra = [int(seq_file.split(".")[0]), ego_yaw, ego_traj[19, 0], ego_traj[19, 1]]
-
-        ego_trajectories[i] = rot_ego_traj
-        agent_trajectories[i] = rot_others_traj.transpose(1, 0, 2)
-        road_pts[i] = lane_centerlines
-        orig_egos[i] = ego_traj
-        extras[i] = np.array(extra)
-
-        if (i+1) % 100 == 0:
-            print("Time taken", time.time() - start_time, "Number of examples", i+1)
+    # sequence files are processed in parallel, and written in order by this process only.
+    with get_context("fork").Pool(args.num_workers) as pool:
+        results = pool.imap(partial(process_seq_file, root_dir=root_dir, num_timesteps=num_timesteps,
+                                    max_num_agents=max_num_agents, max_num_roads=max_num_roads),
+                            seq_files, chunksize=64)
+        for i, (rot_ego_traj, rot_others_traj, lane_centerlines, ego_traj, extra) in enumerate(results):
+            ego_trajectories[i] = rot_ego_traj
+            agent_trajectories[i] = rot_others_traj
+            road_pts[i] = lane_centerlines
+            orig_egos[i] = ego_traj
+            extras[i] = extra
+
+            if (i+1) % 1000 == 0:
+                print("Time taken", time.time() - start_time, "Number of examples", i+1)
+    f.close()
@@ -1,11 +1,11 @@
 import os
-import h5py
-from torch.utils.data import Dataset
 import numpy as np
+from datasets.h5_dataset import H5Dataset
 
 
-class ArgoH5Dataset(Dataset):
+class ArgoH5Dataset(H5Dataset):
     def __init__(self, dset_path, split_name="train", orig_ego=False, use_map_lanes=True):
+        super(ArgoH5Dataset, self).__init__(os.path.join(dset_path, split_name + '_dataset.hdf5'))
         self.data_root = dset_path
         self.split_name = split_name
         self.orig_ego = orig_ego
@@ -17,8 +17,7 @@ class ArgoH5Dataset(Dataset):
         self.scene_context_img = True
         self.predict_yaw = False
 
-        dataset = h5py.File(os.path.join(self.data_root, split_name+'_dataset.hdf5'), 'r')
-        self.dset_len = len(dataset["ego_trajectories"])
+        self.dset_len = self.get_h5_len("ego_trajectories")
 
     def get_input_output_seqs(self, ego_data, agents_data):
         in_len = 20
@@ -31,23 +30,32 @@ class ArgoH5Dataset(Dataset):
         agents_in = agents_data[:in_len, :self.num_others]
         return ego_in, ego_out, agents_in
 
-    def __getitem__(self, idx: int):
-        dataset = h5py.File(os.path.join(self.data_root, self.split_name + '_dataset.hdf5'), 'r')
-        ego_data = dataset['ego_trajectories'][idx]
-        agents_data = dataset['agents_trajectories'][idx]
+    def get_h5_fields(self):
+        fields = ['ego_trajectories', 'agents_trajectories']
+        if self.use_map_lanes:
+            fields.append('road_pts')
+        if "test" in self.split_name:
+            fields.append('extras')
+        elif self.orig_ego:
+            fields += ['extras', 'orig_egos']
+        return {field: () for field in fields}
+
+    def get_sample(self, data):
+        ego_data = data['ego_trajectories']
+        agents_data = data['agents_trajectories']
         ego_in, ego_out, agents_in = self.get_input_output_seqs(ego_data, agents_data)
 
         if self.use_map_lanes:
-            roads = dataset['road_pts'][idx]
+            roads = data['road_pts']
         else:
             roads = np.zeros((1, 1))  # dummy
 
         if "test" in self.split_name:
-            extra = dataset['extras'][idx]
+            extra = data['extras']
             return ego_in, agents_in, roads, extra
         elif self.orig_ego:  # for validation with re-rotation to global coordinates
-            extra = dataset['extras'][idx]
-            ego_data = dataset['orig_egos'][idx]
+            extra = data['extras']
+            ego_data = data['orig_egos']
             ego_out = ego_data[20:]
             return ego_in, ego_out, agents_in, roads, extra
 
@@ -0,0 +1,112 @@
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+
+class H5Dataset(Dataset):
+    """
+    Base class for the datasets stored in a single HDF5 file.
+    The file is opened lazily, once per process, and the handle is then kept for all the samples read by that process
+    instead of reopening the file in every __getitem__. The handle is never pickled or shared with DataLoader workers:
+    each worker opens its own one in h5_worker_init_fn.
+
+    Subclasses list the HDF5 fields (and the part of a row to read from each of them) a sample needs in get_h5_fields
+    and build the sample from the read rows in get_sample. __getitems__ uses this to read a whole batch with one slice
+    per field and per run of consecutive indices, instead of one read per field and per sample.
+    """
+    def __init__(self, h5_fname):
+        self.h5_fname = h5_fname
+        self._h5_file = None
+
+    def get_h5_len(self, key):
+        with h5py.File(self.h5_fname, 'r') as dataset:
+            return len(dataset[key])
+
+    def open_h5(self):
+        self._h5_file = h5py.File(self.h5_fname, 'r')
+
+    @property
+    def dataset(self):
+        if self._h5_file is None:
+            self.open_h5()
+        return self._h5_file
+
+    def get_h5_fields(self):
+        """
+        Returns a dict mapping the name of every HDF5 field needed to build a sample to the index applied to the
+        remaining dimensions of a row of that field (an empty tuple to read the full row).
+        """
+        raise NotImplementedError
+
+    def get_sample(self, data):
+        """
+        Builds a sample from a dict mapping the names returned by get_h5_fields to the rows read for that sample.
+        """
+        raise NotImplementedError
+
+    def __getitem__(self, idx: int):
+        return self.get_sample({key: self.dataset[key][(idx, *sel)] for key, sel in self.get_h5_fields().items()})
+
+    def __getitems__(self, indices):
+        order = np.argsort(indices, kind="stable")
+        sorted_indices = np.asarray(indices)[order]
+        run_starts = np.concatenate(([0], np.where(np.diff(sorted_indices) != 1)[0] + 1, [len(sorted_indices)]))
+        runs = [(sorted_indices[start], sorted_indices[end - 1] + 1) for start, end in zip(run_starts[:-1], run_starts[1:])]
+
+        rows = {}
+        for key, sel in self.get_h5_fields().items():
+            field_rows = [self.dataset[key][(slice(start, end), *sel)] for start, end in runs]
+            rows[key] = field_rows[0] if len(field_rows) == 1 else np.concatenate(field_rows)
+
+        samples = [None] * len(indices)
+        for i, sample_id in enumerate(order):
+            samples[sample_id] = self.get_sample({key: rows[key][i] for key in rows})
+        return samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_h5_file"] = None
+        return state
+
+
+def h5_worker_init_fn(worker_id):
+    """
+    DataLoader worker_init_fn opening the HDF5 file of the worker's dataset copy, so that a handle inherited from the
+    main process through fork is never used by the worker.
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    if isinstance(dataset, H5Dataset):
+        dataset.open_h5()
+
+
+class BlockBatchSampler(Sampler):
+    """
+    Batch sampler yielding batches made of contiguous blocks of block_size indices, sorted within every batch.
+    Only the order of the blocks is shuffled, so that H5Dataset.__getitems__ reads every block of a batch with one
+    slice per field. Samples of the same block always end up in the same batch, which makes batches less random than
+    with a RandomSampler the larger block_size is.
+    """
+    def __init__(self, data_len, batch_size, block_size, shuffle=True, drop_last=False):
+        self.data_len = data_len
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        block_starts = torch.arange(0, self.data_len, self.block_size)
+        if self.shuffle:
+            block_starts = block_starts[torch.randperm(len(block_starts))]
+        indices = torch.cat([torch.arange(start, min(start + self.block_size, self.data_len))
+                             for start in block_starts.tolist()]).tolist()
+        for start in range(0, self.data_len, self.batch_size):
+            batch = indices[start:start + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                return
+            yield sorted(batch)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.data_len // self.batch_size
+        return (self.data_len + self.batch_size - 1) // self.batch_size
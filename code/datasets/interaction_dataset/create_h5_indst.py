@@ -2,73 +2,84 @@ import argparse
 import h5py
 import glob
 import os
+from functools import partial
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 from datasets.interaction_dataset.utils import get_minmax_mapfile
 
 
+MAX_NUM_AGENTS = 50  # found by inspection
+TRAJ_LEN = 40
+STATE_COLUMNS = ['x', 'y', 'vx', 'vy', 'psi_rad', 'length', 'width']
+
+
 def get_args():
     parser = argparse.ArgumentParser(description="Interaction-Dataset H5 Creator")
     parser.add_argument("--output-h5-path", type=str, required=True, help="output path to H5 files.")
     parser.add_argument("--raw-dataset-path", type=str, required=True, help="raw Dataset path to multi-agent folder.")
     parser.add_argument("--split-name", type=str, default="train", help="split-name to create", choices=["train", "val"])
+    parser.add_argument("--num-workers", type=int, default=8, help="Number of csv files processed in parallel.")
     args = parser.parse_args()
     return args
 
 
-if __name__ == '__main__':
-    args = get_args()
-    datafiles = glob.glob(args.raw_dataset_path + args.split_name + "/*.csv")
-    num_scenes = 0
-    for datafile in datafiles:
-        data = pd.read_csv(datafile)
-        num_scenes += len(list(set(data['case_id'].tolist())))
-
-    max_num_agents = 50  # found by inspection
-    f = h5py.File(os.path.join(args.output_h5_path, args.split_name + '_dataset.hdf5'), 'w')
-    agent_trajectories = f.create_dataset("agents_trajectories", shape=(num_scenes, max_num_agents, 40, 7), chunks=(1, max_num_agents, 40, 7), dtype=np.float32)
-    agent_types = f.create_dataset("agents_types", shape=(num_scenes, max_num_agents, 2), chunks=(1, max_num_agents, 2), dtype=np.float32)
-    metas = f.create_dataset("metas", shape=(num_scenes, 5), chunks=(1, 5))
-    map_paths = f.create_dataset("map_paths", shape=(num_scenes, 1), chunks=(1, 1), dtype='S200')
-
-    global_scene_id = 0
-    for datafile_id, datafile in enumerate(datafiles):
-        data = pd.read_csv(datafile)
-        current_roads = datafile.split("/")[-1].split(".")[0].replace("_" + args.split_name, "")
-        lanelet_map_file = os.path.join(args.raw_dataset_path, "maps", current_roads + ".osm")
-        xmin, ymin, xmax, ymax = get_minmax_mapfile(lanelet_map_file)
+def process_datafile(datafile, raw_dataset_path, split_name):
+    """
+    Reads all the scenes of one csv file in a single groupby pass.
+    Returns the path to the file's map, the map's (xmin, ymin, xmax, ymax) and the scenes' padded agent trajectories
+    and types, with the scenes sorted by case_id and their agents by track_id.
+    """
+    data = pd.read_csv(datafile)
+    current_roads = datafile.split("/")[-1].split(".")[0].replace("_" + split_name, "")
+    lanelet_map_file = os.path.join(raw_dataset_path, "maps", current_roads + ".osm")
+    minmax = get_minmax_mapfile(lanelet_map_file)
 
-        scene_ids = list(set(data['case_id'].tolist()))
-        for i, scene_id in enumerate(scene_ids):
-            if i % 10 == 0:
-                print(scene_id, "/", len(scene_ids))
-            scene_data = data.loc[data['case_id'] == scene_id]
+    scene_ids = np.unique(data['case_id'].to_numpy())
+    scene_index = {scene_id: i for i, scene_id in enumerate(scene_ids)}
+    scene_trajectories = np.zeros((len(scene_ids), MAX_NUM_AGENTS, TRAJ_LEN, len(STATE_COLUMNS)), dtype=np.float32) - 1
+    scene_agent_types = np.zeros((len(scene_ids), MAX_NUM_AGENTS, 2), dtype=np.float32) - 1
+    num_agents = np.zeros(len(scene_ids), dtype=int)
+    for (scene_id, agent_id), agent_data in data.groupby(['case_id', 'track_id'], sort=True):
+        if len(agent_data) < TRAJ_LEN:  # only take complete trajectories
+            continue
+        i = scene_index[scene_id]
+        scene_trajectories[i, num_agents[i]] = agent_data[STATE_COLUMNS].to_numpy()
+        scene_agent_types[i, num_agents[i]] = [1.0, 0.0] if 'car' in agent_data['agent_type'].iloc[0] else [0.0, 1.0]
+        num_agents[i] += 1
 
-            agent_ids = list(set(data['track_id'].tolist()))
-            scene_trajectories = []
-            scene_agent_types = []
-            for agent_id in agent_ids:
-                agent_data = scene_data.loc[scene_data['track_id'] == agent_id]
-                if len(agent_data['frame_id'].tolist()) < 40:  # only take complete trajectories
-                    continue
-                curr_agent_type = [1.0, 0.0] if 'car' in agent_data['agent_type'].tolist()[0] else [0.0, 1.0]
-                scene_agent_types.append(curr_agent_type)
-                scene_trajectories.append(agent_data[['x', 'y', 'vx', 'vy', 'psi_rad', 'length', 'width']].to_numpy())
+    print(datafile, ":", len(scene_ids), "scenes")
+    return lanelet_map_file, minmax, scene_trajectories, scene_agent_types
 
-            scene_trajectories = np.array(scene_trajectories)
-            scene_agent_types = np.array(scene_agent_types)
-            if len(scene_trajectories) < max_num_agents:
-                temp_scene_trajectories = np.zeros((max_num_agents, 40, 7)) - 1
-                temp_scene_trajectories[:len(scene_trajectories)] = scene_trajectories
-                scene_trajectories = temp_scene_trajectories.copy()
-                temp_scene_types = np.zeros((max_num_agents, 2)) - 1
-                temp_scene_types[:len(scene_agent_types)] = scene_agent_types
-                scene_agent_types = temp_scene_types.copy()
 
-            agent_trajectories[global_scene_id] = scene_trajectories
-            agent_types[global_scene_id] = scene_agent_types
-            metas[global_scene_id] = np.array([xmin, ymin, xmax, ymax, datafile_id])
-            map_paths[global_scene_id] = lanelet_map_file.encode("ascii", "ignore")
-            global_scene_id += 1
+if __name__ == '__main__':
+    args = get_args()
+    datafiles = sorted(glob.glob(args.raw_dataset_path + args.split_name + "/*.csv"))
 
+    # datasets are grown file by file, as the number of scenes of a file is only known once it has been read.
+    f = h5py.File(os.path.join(args.output_h5_path, args.split_name + '_dataset.hdf5'), 'w')
+    agent_trajectories = f.create_dataset("agents_trajectories", shape=(0, MAX_NUM_AGENTS, TRAJ_LEN, 7),
+                                          maxshape=(None, MAX_NUM_AGENTS, TRAJ_LEN, 7),
+                                          chunks=(1, MAX_NUM_AGENTS, TRAJ_LEN, 7), dtype=np.float32)
+    agent_types = f.create_dataset("agents_types", shape=(0, MAX_NUM_AGENTS, 2), maxshape=(None, MAX_NUM_AGENTS, 2),
+                                   chunks=(1, MAX_NUM_AGENTS, 2), dtype=np.float32)
+    metas = f.create_dataset("metas", shape=(0, 5), maxshape=(None, 5), chunks=(1, 5))
+    map_paths = f.create_dataset("map_paths", shape=(0, 1), maxshape=(None, 1), chunks=(1, 1), dtype='S200')
 
+    # files are processed in parallel, and written in order by this process only.
+    global_scene_id = 0
+    with Pool(args.num_workers) as pool:
+        results = pool.imap(partial(process_datafile, raw_dataset_path=args.raw_dataset_path,
+                                    split_name=args.split_name), datafiles)
+        for datafile_id, (lanelet_map_file, minmax, scene_trajectories, scene_agent_types) in enumerate(results):
+            num_scenes = len(scene_trajectories)
+            end = global_scene_id + num_scenes
+            for dataset in [agent_trajectories, agent_types, metas, map_paths]:
+                dataset.resize(end, axis=0)
+            agent_trajectories[global_scene_id:end] = scene_trajectories
+            agent_types[global_scene_id:end] = scene_agent_types
+            metas[global_scene_id:end] = np.array([*minmax, datafile_id])
+            map_paths[global_scene_id:end] = lanelet_map_file.encode("ascii", "ignore")
+            global_scene_id = end
+    f.close()
+    print("Wrote", global_scene_id, "scenes from", len(datafiles), "files.")
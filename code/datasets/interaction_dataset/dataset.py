@@ -1,17 +1,15 @@
-import xml.etree.ElementTree as xml
-import h5py
 import os
 import glob
 import matplotlib.pyplot as plt
 from sklearn.metrics import euclidean_distances
-from torch.utils.data import Dataset
 import numpy as np
-from datasets.interaction_dataset.utils import LL2XYProjector, Point, get_type, get_subtype, get_x_y_lists, \
-    get_relation_members
+from datasets.h5_dataset import H5Dataset
+from datasets.interaction_dataset.utils import load_map_lanes
 
 
-class InteractionDataset(Dataset):
+class InteractionDataset(H5Dataset):
     def __init__(self, dset_path, split_name="train", evaluation=False, use_map_lanes=True):
+        super(InteractionDataset, self).__init__(os.path.join(dset_path, split_name + '_dataset.hdf5'))
         self.data_root = dset_path
         self.split_name = split_name
         self.pred_horizon = 15
@@ -21,15 +19,13 @@ class InteractionDataset(Dataset):
         self.map_attr = 7
         self.k_attr = 8
 
-        dataset = h5py.File(os.path.join(self.data_root, split_name + '_dataset.hdf5'), 'r')
-        self.dset_len = len(dataset["agents_trajectories"])
+        self.dset_len = self.get_h5_len("agents_trajectories")
 
         roads_fnames = glob.glob(os.path.join(self.data_root, "maps", "*.osm"))
-        self.max_num_pts_per_road_seg = 0
         self.max_num_road_segs = 0
         self.roads = {}
         for osm_fname in roads_fnames:
-            road_info = self.get_map_lanes(osm_fname, 0., 0.)
+            road_info = load_map_lanes(osm_fname)
             if len(road_info) > self.max_num_road_segs:
                 self.max_num_road_segs = len(road_info)
             key_fname = osm_fname.split("/")[-1]
@@ -42,110 +38,6 @@ class InteractionDataset(Dataset):
         else:
             self.num_others = 40  # evaluate with 40 agents.
 
-    def get_map_lanes(self, filename, lat_origin, lon_origin):
-        projector = LL2XYProjector(lat_origin, lon_origin)
-
-        e = xml.parse(filename).getroot()
-
-        point_dict = dict()
-        for node in e.findall("node"):
-            point = Point()
-            point.x, point.y = projector.latlon2xy(float(node.get('lat')), float(node.get('lon')))
-            point_dict[int(node.get('id'))] = point
-
-        unknown_linestring_types = list()
-        road_lines = []
-
-        road_lines_dict = {}
-        exlusion_ids = []
-
-        min_length = 40
-        for way in e.findall('way'):
-            way_type = get_type(way)
-
-            if way_type is None:
-                raise RuntimeError("Linestring type must be specified")
-            elif way_type == "curbstone":
-                mark_type = np.array([1.0, 0.0, 0.0, 1.0])
-            elif way_type == "line_thin":
-                way_subtype = get_subtype(way)
-                if way_subtype == "dashed":
-                    mark_type = np.array([1.0, 1.0, 0.0, 1.0])
-                else:
-                    mark_type = np.array([0.0, 1.0, 0.0, 1.0])
-            elif way_type == "line_thick":
-                way_subtype = get_subtype(way)
-                if way_subtype == "dashed":
-                    mark_type = np.array([1.0, 1.0, 0.0, 1.0])
-                else:
-                    mark_type = np.array([0.0, 1.0, 0.0, 1.0])
-            elif way_type == "pedestrian_marking":
-                mark_type = np.array([0.0, 0.0, 1.0, 1.0])
-            elif way_type == "bike_marking":
-                mark_type = np.array([0.0, 0.0, 1.0, 1.0])
-            elif way_type == "stop_line":
-                mark_type = np.array([1.0, 0.0, 1.0, 1.0])
-            elif way_type == "virtual":
-                # mark_type = np.array([1.0, 1.0, 0.0, 1.0])
-                exlusion_ids.append(way.get("id"))
-                continue
-            elif way_type == "road_border":
-                mark_type = np.array([1.0, 1.0, 1.0, 1.0])
-            elif way_type == "guard_rail":
-                mark_type = np.array([1.0, 1.0, 1.0, 1.0])
-            elif way_type == "traffic_sign":
-                exlusion_ids.append(way.get("id"))
-                continue
-            else:
-                if way_type not in unknown_linestring_types:
-                    unknown_linestring_types.append(way_type)
-                continue
-
-            x_list, y_list = get_x_y_lists(way, point_dict)
-            if len(x_list) < min_length:
-                x_list = np.linspace(x_list[0], x_list[-1], min_length).tolist()
-                y_list = np.linspace(y_list[0], y_list[-1], min_length).tolist()
-
-            lane_pts = np.array([x_list, y_list]).transpose()
-            mark_type = np.zeros((len(lane_pts), 4)) + mark_type
-            if len(x_list) > self.max_num_pts_per_road_seg:
-                self.max_num_pts_per_road_seg = len(x_list)
-
-            lane_pts = np.concatenate((lane_pts, mark_type), axis=1)
-            road_lines.append(lane_pts)
-            road_lines_dict[way.get("id")] = lane_pts
-
-        new_roads = np.zeros((160, self.max_num_pts_per_road_seg, 6))  # empirically found max num roads is 157.
-        for i in range(len(road_lines)):
-            new_roads[i, :len(road_lines[i])] = road_lines[i]
-
-        used_keys_all = []
-        num_relations = len(e.findall('relation'))
-        relation_lanes = np.zeros((num_relations + len(road_lines), 80, 8))
-        counter = 0
-        for rel in e.findall('relation'):
-            rel_lane, used_keys = get_relation_members(rel, road_lines_dict, exlusion_ids)
-            if rel_lane is None:
-                continue
-            used_keys_all += used_keys
-            new_lanes = np.array(rel_lane).reshape((-1, 8))
-            relation_lanes[counter] = new_lanes
-            counter += 1
-
-        # delete all used keys
-        used_keys_all = np.unique(used_keys_all)
-        for used_key in used_keys_all:
-            del road_lines_dict[used_key]
-
-        # add non-used keys
-        for k in road_lines_dict.keys():
-            relation_lanes[counter, :40, :5] = road_lines_dict[k][:, :5]  # rest of state (position (2), and type(3)).
-            relation_lanes[counter, :40, 5:7] = -1.0  # no left-right relationship
-            relation_lanes[counter, :40, 7] = road_lines_dict[k][:, -1]  # mask
-            counter += 1
-
-        return relation_lanes[relation_lanes[:, :, -1].sum(1) > 0]
-
     def split_input_output_normalize(self, agents_data, meta_data, agent_types):
         if self.evaluation:
             in_horizon = 10
@@ -175,12 +67,12 @@ class InteractionDataset(Dataset):
         return ego_in, ego_out, agents_in, agents_out, agent_types
 
     def copy_agent_roads_across_agents(self, agents_in, roads):
-        new_roads = np.zeros((self.num_others + 1, *roads.shape))
-        new_roads[0] = roads  # ego
-        for n in range(self.num_others):
-            if agents_in[n, -1, -1]:
-                new_roads[n + 1] = roads
-        return new_roads
+        """
+        Returns a (read-only) view of roads repeated for the ego and every other agent, without copying them: the
+        copies only differ once rotate_agents moves them to each agent's frame, which is also where the roads of the
+        agents that do not exist are zeroed.
+        """
+        return np.broadcast_to(roads, (self.num_others + 1, *roads.shape))
 
     def make_2d_rotation_matrix(self, angle_in_radians: float) -> np.ndarray:
         """
@@ -206,6 +98,24 @@ class InteractionDataset(Dataset):
             return np.dot(transform, coordinates.reshape((-1, 2)).T).T.reshape(*coord_shape)
         return np.dot(transform, coordinates.T).T[:, :2]
 
+    def make_2d_rotation_matrices(self, angles_in_radians: np.ndarray) -> np.ndarray:
+        """
+        Batched version of make_2d_rotation_matrix, returns an array of shape [n_angles, 2, 2].
+        """
+        cos, sin = np.cos(angles_in_radians), np.sin(angles_in_radians)
+        return np.stack([np.stack([cos, -sin], axis=-1), np.stack([sin, cos], axis=-1)], axis=-2)
+
+    def convert_global_coords_to_local_batch(self, coordinates: np.ndarray, yaws: np.ndarray) -> np.ndarray:
+        """
+        Batched version of convert_global_coords_to_local, rotating coordinates[i] (of any shape [..., 2]) by yaws[i].
+        :param coordinates: x,y locations. array of shape [n_frames, ..., 2].
+        :param yaws: array of shape [n_frames].
+        :return: x,y locations in the frames, same shape as coordinates.
+        """
+        transforms = self.make_2d_rotation_matrices(yaws)
+        coord_shape = coordinates.shape
+        return np.matmul(coordinates.reshape((len(coordinates), -1, 2)), transforms.transpose((0, 2, 1))).reshape(coord_shape)
+
     def rotate_agents(self, ego_in, ego_out, agents_in, agents_out, roads, agent_types):
         new_ego_in = np.zeros(
             (ego_in.shape[0], ego_in.shape[1] + 3))  # +2 adding three dimensions for original positions and yaw
@@ -224,49 +134,37 @@ class InteractionDataset(Dataset):
         new_agents_out[:, :, 2:] = agents_out
         new_agents_out[:, :, 4] -= agents_in[:, -1:, 4]
 
-        new_roads = roads.copy()
+        # ego first, followed by the other agents that exist at the last input timestep.
+        exist = np.concatenate(([True], agents_in[:, -1, -1] != 0))
+        all_in = np.concatenate((ego_in[np.newaxis], agents_in), axis=0)[exist]
+        all_out = np.concatenate((ego_out[np.newaxis], agents_out), axis=0)[exist]
 
-        # "ego" stuff
-        if agent_types[0, 0]:  # vehicle
-            yaw = ego_in[-1, 4]
-        elif agent_types[0, 1]:  # pedestrian/bike
-            diff = ego_in[-1, :2] - ego_in[-5, :2]
-            yaw = np.arctan2(diff[1], diff[0])
+        # vehicles use their yaw, pedestrians/bikes the direction of their last displacement.
+        diff = all_in[:, -1, :2] - all_in[:, -5, :2]
+        yaw = np.where(agent_types[exist, 0] != 0, all_in[:, -1, 4], np.arctan2(diff[:, 1], diff[:, 0]))
         angle_of_rotation = (np.pi / 2) + np.sign(-yaw) * np.abs(yaw)
-        translation = ego_in[-1, :2]
-
-        new_ego_in[:, :2] = self.convert_global_coords_to_local(coordinates=ego_in[:, :2] - translation,
-                                                                yaw=angle_of_rotation)
-        # new_ego_in[:, 4:6] = self.convert_global_coords_to_local(coordinates=ego_in[:, 2:4], yaw=angle_of_rotation)
-        new_ego_in[:, 5:7] = self.convert_global_coords_to_local(coordinates=ego_in[:, 2:4], yaw=angle_of_rotation)
-        new_ego_out[:, :2] = self.convert_global_coords_to_local(coordinates=ego_out[:, :2] - translation,
-                                                                 yaw=angle_of_rotation)
-        new_roads[0, :, :, :2] = self.convert_global_coords_to_local(coordinates=new_roads[0, :, :, :2] - translation,
-                                                                     yaw=angle_of_rotation)
-        new_roads[0][np.where(new_roads[0, :, :, -1] == 0)] = 0.0
-
-        # other agents
-        for n in range(self.num_others):
-            if not agents_in[n, -1, -1]:
-                continue
-
-            if agent_types[n + 1, 0]:  # vehicle
-                yaw = agents_in[n, -1, 4]
-            elif agent_types[n + 1, 1]:  # pedestrian/bike
-                diff = agents_in[n, -1, :2] - agents_in[n, -5, :2]
-                yaw = np.arctan2(diff[1], diff[0])
-            angle_of_rotation = (np.pi / 2) + np.sign(-yaw) * np.abs(yaw)
-            translation = agents_in[n, -1, :2]
-
-            new_agents_in[n, :, :2] = self.convert_global_coords_to_local(coordinates=agents_in[n, :, :2] - translation,
-                                                                          yaw=angle_of_rotation)
-            new_agents_in[n, :, 5:7] = self.convert_global_coords_to_local(coordinates=agents_in[n, :, 2:4],
-                                                                           yaw=angle_of_rotation)
-            new_agents_out[n, :, :2] = self.convert_global_coords_to_local(
-                coordinates=agents_out[n, :, :2] - translation, yaw=angle_of_rotation)
-            new_roads[n + 1, :, :, :2] = self.convert_global_coords_to_local(
-                coordinates=new_roads[n + 1, :, :, :2] - translation, yaw=angle_of_rotation)
-            new_roads[n + 1][np.where(new_roads[n + 1, :, :, -1] == 0)] = 0.0
+        translation = all_in[:, -1, np.newaxis, :2]
+
+        local_in = self.convert_global_coords_to_local_batch(coordinates=all_in[:, :, :2] - translation,
+                                                             yaws=angle_of_rotation)
+        local_vel_in = self.convert_global_coords_to_local_batch(coordinates=all_in[:, :, 2:4], yaws=angle_of_rotation)
+        local_out = self.convert_global_coords_to_local_batch(coordinates=all_out[:, :, :2] - translation,
+                                                              yaws=angle_of_rotation)
+
+        new_ego_in[:, :2] = local_in[0]
+        new_ego_in[:, 5:7] = local_vel_in[0]
+        new_ego_out[:, :2] = local_out[0]
+        new_agents_in[exist[1:], :, :2] = local_in[1:]
+        new_agents_in[exist[1:], :, 5:7] = local_vel_in[1:]
+        new_agents_out[exist[1:], :, :2] = local_out[1:]
+
+        # roads are only materialized per agent here, the ones of agents that do not exist stay at zero.
+        agents_roads = roads[exist]
+        agents_roads[:, :, :, :2] = self.convert_global_coords_to_local_batch(
+            coordinates=agents_roads[:, :, :, :2] - translation[:, np.newaxis], yaws=angle_of_rotation)
+        agents_roads[agents_roads[:, :, :, -1] == 0] = 0.0
+        new_roads = np.zeros(roads.shape)
+        new_roads[exist] = agents_roads
 
         return new_ego_in, new_ego_out, new_agents_in, new_agents_out, new_roads
 
@@ -287,15 +185,17 @@ class InteractionDataset(Dataset):
             plt.show()
         exit()
 
-    def __getitem__(self, idx: int):
-        dataset = h5py.File(os.path.join(self.data_root, self.split_name + '_dataset.hdf5'), 'r')
-        agents_data = dataset['agents_trajectories'][idx]
-        agent_types = dataset['agents_types'][idx]
-        meta_data = dataset['metas'][idx]
+    def get_h5_fields(self):
+        return {'agents_trajectories': (), 'agents_types': (), 'metas': (), 'map_paths': ()}
+
+    def get_sample(self, data):
+        agents_data = data['agents_trajectories']
+        agent_types = data['agents_types']
+        meta_data = data['metas']
         if not self.evaluation:
             agents_data = agents_data[:, 1::2]  # downsampling for efficiency during training.
 
-        road_fname_key = dataset['map_paths'][idx][0].decode("utf-8").split("/")[-1]
+        road_fname_key = data['map_paths'][0].decode("utf-8").split("/")[-1]
         roads = self.roads[road_fname_key].copy()
         roads[:, :, :2] -= np.expand_dims(np.array([meta_data[:2]]), 0)
 
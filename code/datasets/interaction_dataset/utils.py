@@ -8,6 +8,8 @@ import xml.etree.ElementTree as xml
 import pyproj
 import math
 
+import hashlib
+import os
 import sys
 import numpy as np
 import cv2
@@ -59,6 +61,28 @@ class LL2XYProjector:
         [x, y] = self.p(lon, lat)
         return [x - self.x_origin, y - self.y_origin]
 
+    def latlon2xy_batch(self, lats, lons):
+        """
+        Same as latlon2xy for arrays of latitudes and longitudes, which are all projected in a single pyproj call.
+        """
+        xs, ys = self.p(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        return xs - self.x_origin, ys - self.y_origin
+
+
+def get_point_dict(e, projector):
+    """
+    Returns a dict mapping the id of every node of the map e to its projected Point, projecting all nodes at once.
+    """
+    nodes = e.findall("node")
+    xs, ys = projector.latlon2xy_batch([float(node.get('lat')) for node in nodes],
+                                       [float(node.get('lon')) for node in nodes])
+    point_dict = dict()
+    for node, x, y in zip(nodes, xs.tolist(), ys.tolist()):
+        point = Point()
+        point.x, point.y = x, y
+        point_dict[int(node.get('id'))] = point
+    return point_dict
+
 
 def get_type(element):
     for tag in element.findall("tag"):
@@ -154,11 +178,137 @@ def get_minmax_mapfile(filename):
 
     e = xml.parse(filename).getroot()
 
-    point_dict = dict()
-    for node in e.findall("node"):
-        point = Point()
-        point.x, point.y = projector.latlon2xy(float(node.get('lat')), float(node.get('lon')))
-        point_dict[int(node.get('id'))] = point
+    point_dict = get_point_dict(e, projector)
 
     xmin, ymin, xmax, ymax = get_minmax(point_dict)
     return xmin, ymin, xmax, ymax
+
+
+def get_map_lanes(filename, lat_origin=0., lon_origin=0.):
+    """
+    Parses the lanelet map filename into an array of shape (num_lanes, 80, 8) holding, for every lanelet relation and
+    every way that is not part of one, its points with state [x, y, type1, type2, type3, left, right, existence_mask].
+    """
+    projector = LL2XYProjector(lat_origin, lon_origin)
+
+    e = xml.parse(filename).getroot()
+
+    point_dict = get_point_dict(e, projector)
+
+    unknown_linestring_types = list()
+    road_lines = []
+
+    road_lines_dict = {}
+    exlusion_ids = []
+
+    min_length = 40
+    for way in e.findall('way'):
+        way_type = get_type(way)
+
+        if way_type is None:
+            raise RuntimeError("Linestring type must be specified")
+        elif way_type == "curbstone":
+            mark_type = np.array([1.0, 0.0, 0.0, 1.0])
+        elif way_type == "line_thin":
+            way_subtype = get_subtype(way)
+            if way_subtype == "dashed":
+                mark_type = np.array([1.0, 1.0, 0.0, 1.0])
+            else:
+                mark_type = np.array([0.0, 1.0, 0.0, 1.0])
+        elif way_type == "line_thick":
+            way_subtype = get_subtype(way)
+            if way_subtype == "dashed":
+                mark_type = np.array([1.0, 1.0, 0.0, 1.0])
+            else:
+                mark_type = np.array([0.0, 1.0, 0.0, 1.0])
+        elif way_type == "pedestrian_marking":
+            mark_type = np.array([0.0, 0.0, 1.0, 1.0])
+        elif way_type == "bike_marking":
+            mark_type = np.array([0.0, 0.0, 1.0, 1.0])
+        elif way_type == "stop_line":
+            mark_type = np.array([1.0, 0.0, 1.0, 1.0])
+        elif way_type == "virtual":
+            # mark_type = np.array([1.0, 1.0, 0.0, 1.0])
+            exlusion_ids.append(way.get("id"))
+            continue
+        elif way_type == "road_border":
+            mark_type = np.array([1.0, 1.0, 1.0, 1.0])
+        elif way_type == "guard_rail":
+            mark_type = np.array([1.0, 1.0, 1.0, 1.0])
+        elif way_type == "traffic_sign":
+            exlusion_ids.append(way.get("id"))
+            continue
+        else:
+            if way_type not in unknown_linestring_types:
+                unknown_linestring_types.append(way_type)
+            continue
+
+        x_list, y_list = get_x_y_lists(way, point_dict)
+        if len(x_list) < min_length:
+            x_list = np.linspace(x_list[0], x_list[-1], min_length).tolist()
+            y_list = np.linspace(y_list[0], y_list[-1], min_length).tolist()
+
+        lane_pts = np.array([x_list, y_list]).transpose()
+        mark_type = np.zeros((len(lane_pts), 4)) + mark_type
+
+        lane_pts = np.concatenate((lane_pts, mark_type), axis=1)
+        road_lines.append(lane_pts)
+        road_lines_dict[way.get("id")] = lane_pts
+
+    used_keys_all = []
+    num_relations = len(e.findall('relation'))
+    relation_lanes = np.zeros((num_relations + len(road_lines), 80, 8))
+    counter = 0
+    for rel in e.findall('relation'):
+        rel_lane, used_keys = get_relation_members(rel, road_lines_dict, exlusion_ids)
+        if rel_lane is None:
+            continue
+        used_keys_all += used_keys
+        new_lanes = np.array(rel_lane).reshape((-1, 8))
+        relation_lanes[counter] = new_lanes
+        counter += 1
+
+    # delete all used keys
+    used_keys_all = np.unique(used_keys_all)
+    for used_key in used_keys_all:
+        del road_lines_dict[used_key]
+
+    # add non-used keys
+    for k in road_lines_dict.keys():
+        relation_lanes[counter, :40, :5] = road_lines_dict[k][:, :5]  # rest of state (position (2), and type(3)).
+        relation_lanes[counter, :40, 5:7] = -1.0  # no left-right relationship
+        relation_lanes[counter, :40, 7] = road_lines_dict[k][:, -1]  # mask
+        counter += 1
+
+    return relation_lanes[relation_lanes[:, :, -1].sum(1) > 0]
+
+
+MAP_LANES_CACHE_VERSION = 1  # to be increased whenever get_map_lanes changes.
+
+
+def load_map_lanes(filename, cache_dir=None):
+    """
+    Same as get_map_lanes(filename), but the parsed lanes are stored in a .npz file in cache_dir (by default a
+    lanes_cache folder next to the map) named after the sha1 of the map file, so that a map is parsed only once.
+    """
+    with open(filename, "rb") as f:
+        file_hash = hashlib.sha1(f.read()).hexdigest()
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(filename), "lanes_cache")
+    cache_fname = os.path.join(cache_dir, "%s_%s_v%d.npz" % (os.path.basename(filename), file_hash,
+                                                             MAP_LANES_CACHE_VERSION))
+    if os.path.exists(cache_fname):
+        with np.load(cache_fname) as cache:
+            return cache["relation_lanes"]
+
+    relation_lanes = get_map_lanes(filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written to a temporary file first so that concurrent runs never read a partially written cache.
+        tmp_fname = cache_fname + ".tmp%d" % os.getpid()
+        with open(tmp_fname, "wb") as f:
+            np.savez(f, relation_lanes=relation_lanes)
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        print("Could not cache the lanes of", filename, ":", e)
+    return relation_lanes
@@ -0,0 +1,126 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+MASKED_STATES_CACHE_DIR = "masked_states"
+
+
+class ConcatArrayView:
+    """
+    Read-only view of the concatenation of several arrays along their first axis, without copying them.
+    indices optionally maps the rows of the view to rows of the concatenation, e.g. to subsample it.
+    """
+    def __init__(self, arrays, indices=None):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+        self.indices = indices
+
+    @property
+    def shape(self):
+        return (len(self), *self.arrays[0].shape[1:])
+
+    def subset(self, indices):
+        """
+        Returns the view of the given rows of this view.
+        """
+        indices = np.asarray(indices)
+        return ConcatArrayView(self.arrays, indices if self.indices is None else self.indices[indices])
+
+    def __getitem__(self, idx: int):
+        if not -len(self) <= idx < len(self):
+            raise IndexError("index " + str(idx) + " is out of bounds for a view of length " + str(len(self)))
+        idx = idx % len(self)
+        if self.indices is not None:
+            idx = self.indices[idx]
+        array_idx = np.searchsorted(self.offsets, idx, side='right') - 1
+        return self.arrays[array_idx][idx - self.offsets[array_idx]]
+
+    def take(self, indices):
+        """
+        Returns the rows indices of the view as one array, gathered with one fancy index per underlying array.
+        """
+        indices = np.asarray(indices)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        array_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        rows = np.empty((len(indices), *self.arrays[0].shape[1:]), dtype=self.arrays[0].dtype)
+        for array_id in np.unique(array_ids):
+            in_array = array_ids == array_id
+            rows[in_array] = self.arrays[array_id][indices[in_array] - self.offsets[array_id]]
+        return rows
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return int(self.offsets[-1])
+
+
+def load_npys(fnames):
+    """
+    Opens the .npy files with mmap_mode='r' and returns the view of their concatenation. Rows are only read when
+    accessed, and the pages read are shared through the page cache by all the DataLoader workers forked from the
+    process, instead of every worker holding a private copy of the concatenated arrays.
+    """
+    return ConcatArrayView([np.load(fname, mmap_mode='r') for fname in fnames])
+
+
+def get_masked_states(xy, num_agents):
+    """
+    Converts positions of shape (N, T, A, 2), NaN where an agent is absent, to float32 states of shape
+    (N, T, num_agents, 3) whose last attribute is the existence mask, and whose positions are 0 where it is 0.
+    Agents are cropped, or padded with absent agents, to num_agents.
+    """
+    xy = xy[:, :, :num_agents]
+    states = np.zeros((*xy.shape[:2], num_agents, 3), dtype=np.float32)
+    states[:, :, :xy.shape[2], :2] = xy
+    states[:, :, :xy.shape[2], 2] = 1
+    states[np.isnan(states[..., 0])] = 0
+    return states
+
+
+def fill_masked_states(states, xy, num_agents, chunk_size=4096):
+    """
+    Writes the states (see get_masked_states) of the ConcatArrayView xy to states, chunk by chunk.
+    """
+    for array, offset in zip(xy.arrays, xy.offsets):
+        for start in range(0, len(array), chunk_size):
+            chunk = array[start:start + chunk_size]
+            states[offset + start:offset + start + len(chunk)] = get_masked_states(chunk, num_agents)
+    return states
+
+
+def load_masked_states(fnames, num_agents, cache_fname, chunk_size=4096):
+    """
+    Returns the view of the states (see get_masked_states) of the concatenation of the .npy files. They are computed
+    once, chunk by chunk, and written next to cache_fname in a file named after the sha1 of the names, sizes and
+    modification times of the files and of num_agents, which is then opened with mmap_mode='r' by later loads, so
+    that regenerated files are never read from a stale cache. If the cache cannot be written (e.g. read-only dataset
+    directory), the states are computed in memory.
+    """
+    xy = load_npys(fnames)
+    key = hashlib.sha1()
+    for fname in fnames:
+        stat = os.stat(fname)
+        key.update(("%s:%d:%d;" % (os.path.basename(fname), stat.st_size, stat.st_mtime_ns)).encode())
+    key.update(("num_agents:%d" % num_agents).encode())
+    root, ext = os.path.splitext(cache_fname)
+    cache_fname = "%s_%s%s" % (root, key.hexdigest(), ext)
+    if os.path.exists(cache_fname):
+        return ConcatArrayView([np.load(cache_fname, mmap_mode='r')])
+
+    shape = (len(xy), xy.shape[1], num_agents, 3)
+    try:
+        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+        # written to a temporary file first so that concurrent runs never read a partially written cache.
+        tmp_fname = cache_fname + ".tmp%d" % os.getpid()
+        states = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=np.float32, shape=shape)
+        fill_masked_states(states, xy, num_agents, chunk_size)
+        states.flush()
+        del states
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        print("Could not cache the masked states in", cache_fname, ":", e)
+        return ConcatArrayView([fill_masked_states(np.empty(shape, dtype=np.float32), xy, num_agents, chunk_size)])
+    return ConcatArrayView([np.load(cache_fname, mmap_mode='r')])
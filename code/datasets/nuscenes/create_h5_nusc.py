@@ -1,8 +1,11 @@
 import argparse
+import json
 
 import h5py
 import os
 import numpy as np
+from functools import partial
+from multiprocessing import get_context
 
 from datasets.nuscenes.raw_dataset import NuScenesDataset
 
@@ -10,8 +13,18 @@ from datasets.nuscenes.raw_dataset import NuScenesDataset
 '''
 Train H5 generation takes about 3 hours and is about 56GBs.
 Val H5 generation takes about 1 hour and is about 16GBs.
+
+With --num-shards N, the samples are split into N shards generated by --num-workers processes, each shard being written
+to its own file in {output_h5_path}/{split_name}_shards/. Finished shards are recorded in the manifest.json file of that
+folder, so that running the same command again after a crash only generates the missing shards. Once all shards are
+done, {split_name}_dataset.hdf5 is written as a file of virtual datasets (h5py VDS) mapping to the shards, which
+NuscenesH5Dataset reads like the single file. The shard files must be kept next to it.
 '''
 
+SHARD_DIR_SUFFIX = "_shards"
+MANIFEST_FNAME = "manifest.json"
+MAX_NUM_AGENTS = 20
+
 
 def get_args():
     parser = argparse.ArgumentParser(description="Nuscenes H5 Creator")
@@ -20,49 +33,159 @@ def get_args():
     parser.add_argument("--split-name", type=str, default="train", help="split-name to create", choices=["train", "val"])
     parser.add_argument("--ego-range", type=int, nargs="+", default=[75, 75, 75, 75],
                         help="range around ego in meters [left, right, behind, front].")
+    parser.add_argument("--num-shards", type=int, default=0,
+                        help="Number of shards to split the samples into (0 writes a single H5 file directly).")
+    parser.add_argument("--num-workers", type=int, default=4, help="Number of shards generated in parallel.")
+    parser.add_argument("--no-merge", action="store_true",
+                        help="Only generate the shards, without writing the virtual dataset file mapping to them.")
     args = parser.parse_args()
 
     return args
 
 
-if __name__ == '__main__':
-    args = get_args()
-    max_num_agents = 20
+def create_datasets(f, num_scenes, max_num_agents):
+    return {
+        "ego_trajectories": f.create_dataset("ego_trajectories", shape=(num_scenes, 18, 3), chunks=(1, 18, 3), dtype=np.float32),
+        "agents_trajectories": f.create_dataset("agents_trajectories", shape=(num_scenes, 18, max_num_agents, 3), chunks=(1, 18, max_num_agents, 3), dtype=np.float32),
+        "scene_ids": f.create_dataset("scene_ids", shape=(num_scenes, 3), chunks=(1, 3), dtype='S50'),
+        "translation": f.create_dataset("translation", shape=(num_scenes, 3), chunks=(1, 3), dtype=np.float32),
+        "rotation": f.create_dataset("rotation", shape=(num_scenes, 4), chunks=(1, 4), dtype=np.float32),
+        "agents_types": f.create_dataset("agents_types", shape=(num_scenes, max_num_agents+1), chunks=(1, max_num_agents+1), dtype='S50'),
+        "road_pts": f.create_dataset("road_pts", shape=(num_scenes, 100, 40, 4), chunks=(1, 100, 40, 4), dtype=np.float16),
+        "large_roads": f.create_dataset("large_roads", shape=(num_scenes, 750, 750, 3), chunks=(1, 750, 750, 3), dtype=np.uint8),
+    }
 
-    save_dir = os.path.join(args.output_h5_path, args.split_name)
-    nuscenes = NuScenesDataset(data_root=args.raw_dataset_path, split_name=args.split_name,
-                               version='v1.0-trainval', ego_range=args.ego_range, num_others=max_num_agents)
-    num_scenes = len(nuscenes)
 
-    f = h5py.File(os.path.join(args.output_h5_path, args.split_name + '_dataset.hdf5'), 'w')
-    ego_trajectories = f.create_dataset("ego_trajectories", shape=(num_scenes, 18, 3), chunks=(1, 18, 3), dtype=np.float32)
-    agent_trajectories = f.create_dataset("agents_trajectories", shape=(num_scenes, 18, max_num_agents, 3), chunks=(1, 18, max_num_agents, 3), dtype=np.float32)
-    scene_ids = f.create_dataset("scene_ids", shape=(num_scenes, 3), chunks=(1, 3), dtype='S50')
-    scene_translation = f.create_dataset("translation", shape=(num_scenes, 3), chunks=(1, 3))
-    scene_rotation = f.create_dataset("rotation", shape=(num_scenes, 4), chunks=(1, 4))
-    agent_types = f.create_dataset("agents_types", shape=(num_scenes, max_num_agents+1), chunks=(1, max_num_agents+1), dtype='S50')
-    road_pts = f.create_dataset("road_pts", shape=(num_scenes, 100, 40, 4), chunks=(1, 100, 40, 4), dtype=np.float16)
-    road_imgs = f.create_dataset("large_roads", shape=(num_scenes, 750, 750, 3), chunks=(1, 750, 750, 3), dtype=np.uint8)
+def write_sample(datasets, i, data, max_num_agents):
+    datasets["ego_trajectories"][i] = data[0]
+    datasets["agents_trajectories"][i] = data[1]
+
+    datasets["large_roads"][i] = data[2]
+
+    curr_scene_id = [n.encode("ascii", "ignore") for n in [data[3][0], data[3][1], data[3][4]]]
+    datasets["scene_ids"][i] = curr_scene_id
+
+    datasets["translation"][i] = data[3][2]
+    datasets["rotation"][i] = data[3][3]
+
+    curr_agent_types = data[4]
+    while len(curr_agent_types) < max_num_agents + 1:
+        curr_agent_types.append("None")
+    agent_types_ascii = [n.encode("ascii", "ignore") for n in curr_agent_types]
+    datasets["agents_types"][i] = agent_types_ascii
+
+    datasets["road_pts"][i] = data[5]
+
+
+def get_shard_ranges(num_scenes, num_shards):
+    bounds = np.linspace(0, num_scenes, num_shards + 1).astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
 
-    for i, data in enumerate(nuscenes):
-        if i % 10 == 0:
-            print(i, "/", num_scenes)
-        ego_trajectories[i] = data[0]
-        agent_trajectories[i] = data[1]
+def get_shard_fname(shard_id):
+    return "shard_" + str(shard_id).zfill(4) + ".hdf5"
 
-        road_imgs[i] = data[2]
 
-        curr_scene_id = [n.encode("ascii", "ignore") for n in [data[3][0], data[3][1], data[3][4]]]
-        scene_ids[i] = curr_scene_id
+def load_manifest(shard_dir, num_scenes, num_shards):
+    manifest_path = os.path.join(shard_dir, MANIFEST_FNAME)
+    if not os.path.exists(manifest_path):
+        return {"num_scenes": num_scenes, "shard_ranges": get_shard_ranges(num_scenes, num_shards), "done": []}
 
-        scene_translation[i] = data[3][2]
-        scene_rotation[i] = data[3][3]
+    with open(manifest_path, 'r') as fp:
+        manifest = json.load(fp)
+    if manifest["num_scenes"] != num_scenes or len(manifest["shard_ranges"]) != num_shards:
+        raise Exception("Existing manifest in " + shard_dir + " was created with " + str(manifest["num_scenes"]) +
+                        " samples and " + str(len(manifest["shard_ranges"])) + " shards, remove the folder to restart.")
+    # a shard is only done if its file is still there.
+    manifest["done"] = [shard_id for shard_id in manifest["done"]
+                        if os.path.exists(os.path.join(shard_dir, get_shard_fname(shard_id)))]
+    return manifest
 
-        curr_agent_types = data[4]
-        while len(curr_agent_types) < max_num_agents + 1:
-            curr_agent_types.append("None")
-        agent_types_ascii = [n.encode("ascii", "ignore") for n in curr_agent_types]
-        agent_types[i] = agent_types_ascii
 
-        road_pts[i] = data[5]
+def save_manifest(shard_dir, manifest):
+    manifest_path = os.path.join(shard_dir, MANIFEST_FNAME)
+    with open(manifest_path + ".tmp", 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
 
+
+# set in the main process before the worker pool is forked, so that the workers share the loaded nuScenes tables and
+# maps instead of loading their own.
+nuscenes = None
+
+
+def generate_shard(shard, shard_dir, max_num_agents):
+    """
+    Writes the samples [start, end) of shard = (shard_id, start, end) to their shard file. The file is written under a
+    temporary name and renamed once complete, so that a shard file is never partially written.
+    """
+    shard_id, start, end = shard
+    shard_path = os.path.join(shard_dir, get_shard_fname(shard_id))
+    with h5py.File(shard_path + ".tmp", 'w') as f:
+        datasets = create_datasets(f, end - start, max_num_agents)
+        for i in range(start, end):
+            if (i - start) % 100 == 0:
+                print("shard", shard_id, ":", i - start, "/", end - start)
+            write_sample(datasets, i - start, nuscenes[i], max_num_agents)
+    os.replace(shard_path + ".tmp", shard_path)
+    return shard_id
+
+
+def merge_shards(shard_dir, output_fname, manifest):
+    """
+    Writes output_fname as a file of virtual datasets concatenating the datasets of all shards. Shards are referenced
+    relatively to output_fname, so the output folder can be moved as a whole.
+    """
+    num_scenes = manifest["num_scenes"]
+    shard_fnames = [os.path.join(os.path.basename(shard_dir), get_shard_fname(shard_id))
+                    for shard_id in range(len(manifest["shard_ranges"]))]
+    with h5py.File(os.path.join(shard_dir, get_shard_fname(0)), 'r') as f:
+        fields = {key: (f[key].shape[1:], f[key].dtype) for key in f.keys()}
+
+    with h5py.File(output_fname, 'w') as f:
+        for key, (row_shape, dtype) in fields.items():
+            layout = h5py.VirtualLayout(shape=(num_scenes, *row_shape), dtype=dtype)
+            for shard_fname, (start, end) in zip(shard_fnames, manifest["shard_ranges"]):
+                layout[start:end] = h5py.VirtualSource(shard_fname, key, shape=(end - start, *row_shape))
+            f.create_virtual_dataset(key, layout)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    max_num_agents = MAX_NUM_AGENTS
+
+    nuscenes = NuScenesDataset(data_root=args.raw_dataset_path, split_name=args.split_name,
+                               version='v1.0-trainval', ego_range=args.ego_range, num_others=max_num_agents)
+    num_scenes = len(nuscenes)
+    output_fname = os.path.join(args.output_h5_path, args.split_name + '_dataset.hdf5')
+
+    if args.num_shards == 0:
+        f = h5py.File(output_fname, 'w')
+        datasets = create_datasets(f, num_scenes, max_num_agents)
+        for i, data in enumerate(nuscenes):
+            if i % 10 == 0:
+                print(i, "/", num_scenes)
+            write_sample(datasets, i, data, max_num_agents)
+        f.close()
+    else:
+        if args.num_shards > num_scenes:
+            # every shard needs at least one sample, h5py does not create empty chunked datasets.
+            print("Only", num_scenes, "samples, using", num_scenes, "shards instead of", args.num_shards)
+            args.num_shards = num_scenes
+        shard_dir = os.path.join(args.output_h5_path, args.split_name + SHARD_DIR_SUFFIX)
+        os.makedirs(shard_dir, exist_ok=True)
+        manifest = load_manifest(shard_dir, num_scenes, args.num_shards)
+        todo_shards = [(shard_id, start, end) for shard_id, (start, end) in enumerate(manifest["shard_ranges"])
+                       if shard_id not in manifest["done"]]
+        print(len(manifest["done"]), "/", args.num_shards, "shards already done.")
+
+        with get_context("fork").Pool(args.num_workers) as pool:
+            for shard_id in pool.imap_unordered(partial(generate_shard, shard_dir=shard_dir,
+                                                        max_num_agents=max_num_agents), todo_shards):
+                manifest["done"].append(shard_id)
+                save_manifest(shard_dir, manifest)
+                print("Finished shard", shard_id, ",", len(manifest["done"]), "/", args.num_shards, "shards done.")
+
+        if not args.no_merge:
+            merge_shards(shard_dir, output_fname, manifest)
+            print("Wrote", output_fname, "mapping to the", args.num_shards, "shards of", shard_dir)
@@ -0,0 +1,46 @@
+import argparse
+
+import cv2
+import h5py
+import numpy as np
+
+
+'''
+Adds the map images used by NuscenesH5Dataset with use_map_img to an existing {split_name}_dataset.hdf5 file, already
+cropped and resized, so that the dataset does not need to read and resize the 750x750 large_roads image of every sample.
+'''
+
+MAP_IMG_KEY = "map_imgs"
+MAP_IMG_SIZE = 128
+# normalization applied to the cached images once divided by 255, see NuscenesH5Dataset.transforms
+MAP_IMG_MEAN = 0.5
+MAP_IMG_STD = 0.5
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="nuScenes map image cache")
+    parser.add_argument("--h5-path", type=str, required=True, help="Path to the {split_name}_dataset.hdf5 file.")
+    parser.add_argument("--batch-size", type=int, default=256, help="Number of images cropped per read.")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    with h5py.File(args.h5_path, 'r+') as f:
+        large_roads = f["large_roads"]
+        num_scenes = len(large_roads)
+        if MAP_IMG_KEY in f:
+            del f[MAP_IMG_KEY]
+        map_imgs = f.create_dataset(MAP_IMG_KEY, shape=(num_scenes, MAP_IMG_SIZE, MAP_IMG_SIZE, 3),
+                                    chunks=(1, MAP_IMG_SIZE, MAP_IMG_SIZE, 3), dtype=np.uint8)
+        map_imgs.attrs["mean"] = MAP_IMG_MEAN
+        map_imgs.attrs["std"] = MAP_IMG_STD
+
+        for start in range(0, num_scenes, args.batch_size):
+            print(start, "/", num_scenes)
+            # original image is 75m behind, 75m in front, 75m left, 75m right @ 0.2m/px resolution.
+            # below recovers an image with 0m behind, 75m in front, 30m left, 30m right
+            crops = large_roads[start:start + args.batch_size, 0:375, 225:525]
+            map_imgs[start:start + len(crops)] = np.stack([cv2.resize(crop, dsize=(MAP_IMG_SIZE, MAP_IMG_SIZE))
+                                                           for crop in crops])
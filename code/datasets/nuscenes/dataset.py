@@ -2,15 +2,17 @@ import cv2
 import h5py
 import os
 import numpy as np
-from torch.utils.data import Dataset
 from torchvision.transforms import transforms
+from datasets.h5_dataset import H5Dataset
+from datasets.nuscenes.create_map_img_cache import MAP_IMG_KEY
 import warnings
 warnings.filterwarnings("ignore")
 
 
-class NuscenesH5Dataset(Dataset):
+class NuscenesH5Dataset(H5Dataset):
     def __init__(self, dset_path, split_name="train", rtn_extras=False, model_type="Autobot-Joint",
                  use_map_img=False, use_map_lanes=True):
+        super(NuscenesH5Dataset, self).__init__(os.path.join(dset_path, split_name + '_dataset.hdf5'))
         self.data_root = dset_path
         self.split_name = split_name
         self.rtn_extras = rtn_extras
@@ -31,8 +33,14 @@ class NuscenesH5Dataset(Dataset):
         if self.use_joint_version and self.use_map_img:
             raise Exception("Cannot use joint version with map image. Use Map lanes instead...")
 
-        dataset = h5py.File(os.path.join(self.data_root, self.split_name + '_dataset.hdf5'), 'r')
-        self.dset_len = len(dataset["ego_trajectories"])
+        self.dset_len = self.get_h5_len("ego_trajectories")
+
+        # use the cropped and resized map images written by create_map_img_cache.py if the file has them.
+        with h5py.File(self.h5_fname, 'r') as dataset:
+            self.use_map_img_cache = self.use_map_img and MAP_IMG_KEY in dataset
+            if self.use_map_img_cache:
+                self.map_img_mean = np.float32(dataset[MAP_IMG_KEY].attrs["mean"])
+                self.map_img_std = np.float32(dataset[MAP_IMG_KEY].attrs["std"])
 
         self.transforms = transforms.Compose([
             transforms.ToTensor(),
@@ -159,36 +167,43 @@ class NuscenesH5Dataset(Dataset):
             return np.dot(transform, coordinates.reshape((-1, 2)).T).T.reshape(*coord_shape)
         return np.dot(transform, coordinates.T).T[:, :2]
 
+    def make_2d_rotation_matrices(self, angles_in_radians: np.ndarray) -> np.ndarray:
+        """
+        Batched version of make_2d_rotation_matrix, returns an array of shape [n_angles, 2, 2].
+        """
+        cos, sin = np.cos(angles_in_radians), np.sin(angles_in_radians)
+        return np.stack([np.stack([cos, -sin], axis=-1), np.stack([sin, cos], axis=-1)], axis=-2)
+
+    def convert_global_coords_to_local_batch(self, coordinates: np.ndarray, yaws: np.ndarray) -> np.ndarray:
+        """
+        Batched version of convert_global_coords_to_local, rotating coordinates[i] (of any shape [..., 2]) by yaws[i].
+        :param coordinates: x,y locations. array of shape [n_frames, ..., 2].
+        :param yaws: array of shape [n_frames].
+        :return: x,y locations in the frames, same shape as coordinates.
+        """
+        transforms = self.make_2d_rotation_matrices(yaws)
+        coord_shape = coordinates.shape
+        return np.matmul(coordinates.reshape((len(coordinates), -1, 2)), transforms.transpose((0, 2, 1))).reshape(coord_shape)
+
     def get_agent_roads(self, roads, agents_in):
         N = 100
-        curr_roads = roads.copy()
-        curr_roads[np.where(curr_roads[:, :, -1] == 0)] = np.nan
-        mean_roads = np.nanmean(curr_roads, axis=1)[:, :2]
-
-        # Ego Agent
-        args_closest_roads = np.argsort(np.linalg.norm(np.array([[0.0, 0.0]]) - mean_roads, axis=-1))
-        if len(args_closest_roads) >= N:
-            per_agent_roads = [roads[args_closest_roads[:N]]]
-        else:
-            ego_roads = np.zeros((N, 40, 4))
-            ego_roads[:len(args_closest_roads)] = roads[args_closest_roads]
-            per_agent_roads = [ego_roads]
-
-        # Other Agents
-        for n in range(self.num_others):
-                if agents_in[-1, n, 2]:
-                    args_closest_roads = np.argsort(np.linalg.norm(agents_in[-1:, n, :2] - mean_roads, axis=-1))
-                    if len(args_closest_roads) >= N:
-                        per_agent_roads.append(roads[args_closest_roads[:N]])
-                    else:
-                        agent_roads = np.zeros((N, 40, 4))
-                        agent_roads[:len(args_closest_roads)] = roads[args_closest_roads]
-                        per_agent_roads.append(agent_roads)
-                else:
-                    per_agent_roads.append(np.zeros((N, 40, 4)))
-
-        roads = np.array(per_agent_roads)
-        roads[:, :, :, 2][np.where(roads[:, :, :, 2] < 0.0)] += 2 * np.pi  # making all orientations between 0 and 2pi
+        curr_roads = roads[:, :, :2].copy()
+        curr_roads[roads[:, :, -1] == 0] = np.nan
+        mean_roads = np.nanmean(curr_roads, axis=1)
+
+        # Distances of the ego (at the origin) and of the other agents' last observed position to all roads.
+        agents_pos = np.concatenate((np.zeros((1, 2)), agents_in[-1, :, :2]), axis=0)
+        dists = np.linalg.norm(agents_pos[:, np.newaxis] - mean_roads[np.newaxis], axis=-1)
+        args_closest_roads = np.argsort(dists, axis=-1)[:, :N]
+        agents_exist = np.concatenate(([True], agents_in[-1, :, 2] != 0))
+
+        # agents that don't exist and missing roads are zero padded. The roads keep their (float16) dtype only if no
+        # padding is needed, as when stacking the per agent road arrays.
+        dtype = roads.dtype if len(mean_roads) >= N and agents_exist.all() else np.float64
+        agent_roads = np.zeros((len(agents_pos), N, *roads.shape[1:]), dtype=dtype)
+        agent_roads[agents_exist, :args_closest_roads.shape[1]] = roads[args_closest_roads[agents_exist]]
+        roads = agent_roads
+        roads[:, :, :, 2][roads[:, :, :, 2] < 0.0] += 2 * np.pi  # making all orientations between 0 and 2pi
 
         # ensure pt closest to ego has an angle of pi/2
         temp_ego_roads = roads[0].copy()
@@ -212,57 +227,74 @@ class NuscenesH5Dataset(Dataset):
         new_ego_out[:, :2] = ego_out[:, :2]
         new_ego_out[:, 2:] = ego_out
 
-        for n in range(self.num_others):
-            new_agents_in[:, n, 2:] = agents_in[:, n]
-            new_agents_out[:, n, 2:] = agents_out[:, n]
-            if agents_in[:, n, -1].sum() >= 2:
-                # then we can use the past to compute the angle to +y-axis
-                diff = agents_in[-1, n, :2] - agents_in[-2, n, :2]
-                yaw = np.arctan2(diff[1], diff[0])
-                angle_of_rotation = (np.pi / 2) + np.sign(-yaw) * np.abs(yaw)
-                translation = agents_in[-1, n, :2]
-            elif agents_in[:, n, -1].sum() == 1:
-                # then we need to use the future to compute angle to +y-axis
-                diff = agents_out[0, n, :2] - agents_in[-1, n, :2]
-                yaw = np.arctan2(diff[1], diff[0])
-                translation = agents_in[-1, n, :2]
-                angle_of_rotation = (np.pi / 2) + np.sign(-yaw) * np.abs(yaw)
-            else:
-                # the agent does not exist...
-                angle_of_rotation = None
-                translation = None
-
-            if angle_of_rotation is not None:
-                new_agents_in[:, n, :2] = self.convert_global_coords_to_local(coordinates=agents_in[:, n, :2] - translation, yaw=angle_of_rotation)
-                new_agents_out[:, n, :2] = self.convert_global_coords_to_local(coordinates=agents_out[:, n, :2] - translation, yaw=angle_of_rotation)
-                new_agents_in[:, n, :2][np.where(new_agents_in[:, n, -1] == 0)] = 0.0
-                new_agents_out[:, n, :2][np.where(new_agents_out[:, n, -1] == 0)] = 0.0
-                if self.use_map_lanes:
-                    new_roads[n+1, :, :, :2] = self.convert_global_coords_to_local(coordinates=new_roads[n+1, :, :, :2] - translation, yaw=angle_of_rotation)
-                    new_roads[n+1, :, :, 2] -= angle_of_rotation
-                    new_roads[n+1][np.where(new_roads[n+1, :, :, -1] == 0)] = 0.0
+        new_agents_in[:, :, 2:] = agents_in
+        new_agents_out[:, :, 2:] = agents_out
+
+        # The angle to the +y-axis is computed from the past if the agent has at least 2 observed timesteps, and
+        # from the first future timestep if it has only one. Agents that do not exist are left at zero.
+        num_observed = agents_in[:, :, -1].sum(axis=0)
+        exist = num_observed >= 1
+        diff = np.where((num_observed >= 2)[:, np.newaxis], agents_in[-1, :, :2] - agents_in[-2, :, :2],
+                        agents_out[0, :, :2] - agents_in[-1, :, :2])[exist]
+        yaw = np.arctan2(diff[:, 1], diff[:, 0])
+        angle_of_rotation = (np.pi / 2) + np.sign(-yaw) * np.abs(yaw)
+        translation = agents_in[-1, exist, :2]
+
+        # agents first for the batched rotation.
+        local_agents_in = self.convert_global_coords_to_local_batch(
+            coordinates=agents_in[:, exist, :2].transpose((1, 0, 2)) - translation[:, np.newaxis], yaws=angle_of_rotation)
+        local_agents_out = self.convert_global_coords_to_local_batch(
+            coordinates=agents_out[:, exist, :2].transpose((1, 0, 2)) - translation[:, np.newaxis], yaws=angle_of_rotation)
+        new_agents_in[:, exist, :2] = local_agents_in.transpose((1, 0, 2))
+        new_agents_out[:, exist, :2] = local_agents_out.transpose((1, 0, 2))
+        new_agents_in[:, :, :2][new_agents_in[:, :, -1] == 0] = 0.0
+        new_agents_out[:, :, :2][new_agents_out[:, :, -1] == 0] = 0.0
+        if self.use_map_lanes:
+            agents_roads = new_roads[1:][exist]
+            agents_roads[:, :, :, :2] = self.convert_global_coords_to_local_batch(
+                coordinates=agents_roads[:, :, :, :2] - translation[:, np.newaxis, np.newaxis], yaws=angle_of_rotation)
+            agents_roads[:, :, :, 2] -= angle_of_rotation[:, np.newaxis, np.newaxis]
+            agents_roads[agents_roads[:, :, :, -1] == 0] = 0.0
+            new_roads[1:][exist] = agents_roads
 
         return new_ego_in, new_ego_out, new_agents_in, new_agents_out, new_roads
 
-    def __getitem__(self, idx: int):
-        dataset = h5py.File(os.path.join(self.data_root, self.split_name + '_dataset.hdf5'), 'r')
-
-        ego_data = dataset['ego_trajectories'][idx]
-        agents_data = dataset['agents_trajectories'][idx]
-
-        agent_types = self.get_agent_types(dataset['agents_types'][idx], num_raw_agents=agents_data.shape[1])
+    def get_h5_fields(self):
+        fields = {'ego_trajectories': (), 'agents_trajectories': (), 'agents_types': (), 'scene_ids': ()}
+        if self.use_map_img_cache:
+            fields[MAP_IMG_KEY] = ()
+        elif self.use_map_img:
+            # original image is 75m behind, 75m in front, 75m left, 75m right @ 0.2m/px resolution.
+            # below recovers an image with 0m behind, 75m in front, 30m left, 30m right
+            fields['large_roads'] = (slice(0, 375), slice(225, 525))
+        elif self.use_map_lanes:
+            fields['road_pts'] = ()
+        if self.rtn_extras:
+            fields['translation'] = ()
+            fields['rotation'] = ()
+            if self.use_joint_version:
+                fields['large_roads'] = ()
+        return fields
+
+    def get_sample(self, data):
+        ego_data = data['ego_trajectories']
+        agents_data = data['agents_trajectories']
+
+        agent_types = self.get_agent_types(data['agents_types'], num_raw_agents=agents_data.shape[1])
         agents_data, agent_types = self.select_valid_others(agents_data, agent_types)
 
         in_ego, out_ego, in_agents, out_agents = self.get_input_output_seqs(ego_data, agents_data)
 
-        if self.use_map_img:
-            # original image is 75m behind, 75m in front, 75m left, 75m right @ 0.2m/px resolution.
-            # below recovers an image with 0m behind, 75m in front, 30m left, 30m right
-            road_img_data = dataset['large_roads'][idx][0:375, 225:525]
+        if self.use_map_img_cache:
+            # same as self.transforms, the image is already cropped and resized.
+            roads = data[MAP_IMG_KEY].transpose((2, 0, 1)).astype(np.float32) / np.float32(255)
+            roads = (roads - self.map_img_mean) / self.map_img_std
+        elif self.use_map_img:
+            road_img_data = data['large_roads']  # cropped in get_h5_fields
             road_img_data = cv2.resize(road_img_data, dsize=(128, 128))
             roads = self.transforms(road_img_data).numpy()
         elif self.use_map_lanes:
-            roads = dataset['road_pts'][idx]
+            roads = data['road_pts']
             roads = self.get_agent_roads(roads, in_agents)
         else:
             roads = np.ones((1, 1))
@@ -273,7 +305,8 @@ class NuscenesH5Dataset(Dataset):
             in_ego, out_ego, in_agents, out_agents, roads = \
                 self.rotate_agent_datas(in_ego, out_ego, in_agents, out_agents, roads)
 
-        city_name = dataset['scene_ids'][idx][-1].decode('utf-8')
+        scene_ids = data['scene_ids']
+        city_name = scene_ids[-1].decode('utf-8')
         if "train" in self.split_name:
             should_we_mirror = np.random.choice([0, 1])
             if should_we_mirror:
@@ -281,8 +314,8 @@ class NuscenesH5Dataset(Dataset):
 
         if self.use_joint_version:
             if self.rtn_extras:
-                extras = [dataset['translation'][idx], dataset['rotation'][idx], dataset['scene_ids'][idx][2].decode("utf-8")]
-                return in_ego, out_ego, in_agents, out_agents, roads, agent_types, extras, dataset['large_roads'][idx]
+                extras = [data['translation'], data['rotation'], scene_ids[2].decode("utf-8")]
+                return in_ego, out_ego, in_agents, out_agents, roads, agent_types, extras, data['large_roads']
 
             return in_ego, out_ego, in_agents, out_agents, roads, agent_types
         else:
@@ -293,8 +326,8 @@ class NuscenesH5Dataset(Dataset):
 
             if self.rtn_extras:
                 # translation, rotation, instance_token, sample_token
-                extras = [dataset['translation'][idx], dataset['rotation'][idx],
-                          dataset['scene_ids'][idx][0].decode("utf-8"), dataset['scene_ids'][idx][1].decode("utf-8")]
+                extras = [data['translation'], data['rotation'],
+                          scene_ids[0].decode("utf-8"), scene_ids[1].decode("utf-8")]
                 return in_ego, out_ego, in_agents, ego_roads, extras
 
             return in_ego, out_ego, in_agents, ego_roads
@@ -1,6 +1,7 @@
 import cv2
 import os
 import math
+from functools import lru_cache
 
 from nuscenes.prediction.input_representation.agents import AgentBoxesWithFadedHistory
 from nuscenes.prediction.input_representation.combinators import Rasterizer
@@ -14,7 +15,7 @@ from nuscenes import NuScenes
 from nuscenes.prediction import PredictHelper
 from nuscenes.eval.prediction.splits import get_prediction_challenge_split
 from nuscenes.map_expansion.map_api import NuScenesMap
-from nuscenes.prediction.input_representation.static_layers import get_lanes_in_radius, StaticLayerRasterizer, correct_yaw
+from nuscenes.prediction.input_representation.static_layers import StaticLayerRasterizer, correct_yaw
 from nuscenes.prediction.helper import quaternion_yaw, convert_global_coords_to_local
 
 import matplotlib.pyplot as plt
@@ -59,7 +60,8 @@ def load_all_maps(helper: PredictHelper, verbose: bool = False) -> Dict[str, NuS
 
 
 class NuScenesDataset(Dataset):
-    def __init__(self, data_root, split_name, version, ego_range=(25, 25, 10, 50), debug=False, num_others=10):
+    def __init__(self, data_root, split_name, version, ego_range=(25, 25, 10, 50), debug=False, num_others=10,
+                 map_tile_size=200., lane_cache_size=20000):
 
         super(NuScenesDataset).__init__()
         nusc = NuScenes(version=version, dataroot=data_root)
@@ -77,6 +79,13 @@ class NuScenesDataset(Dataset):
         self._max_number_roads = 100
         self._number_future_road_points = 40  # the number of points to include along the current lane.
         self._map_dict = load_all_maps(self._helper, verbose=True)
+        self._lane_layers = ['lane', 'lane_connector']
+        # map work shared across samples: lanes of each (map_name, tile) of map_tile_size meters, and discretized lanes
+        # and outgoing lanes keyed by (map_name, lane_id).
+        self._map_tile_size = map_tile_size
+        self._map_tiles = {}
+        self._get_discretized_lane = lru_cache(maxsize=lane_cache_size)(self._discretize_lane)
+        self._get_outgoing_lane_ids = lru_cache(maxsize=lane_cache_size)(self._outgoing_lane_ids)
         self._static_layer_rasterizer = StaticLayerRasterizer(
             self._helper,
             layer_names=['drivable_area', 'ped_crossing', 'walkway'],
@@ -132,9 +141,50 @@ class NuScenesDataset(Dataset):
             plt.savefig(os.path.join(image_folder, str(count) + ".png"))
             count += 1
 
-    def _get_map_features(self, nusc_map, x, y, yaw, radius, reference_position):
+    def _discretize_lane(self, map_name, lane_id):
+        return self._map_dict[map_name].discretize_lanes([lane_id], 2.0)[lane_id]
+
+    def _outgoing_lane_ids(self, map_name, lane_id):
+        return self._map_dict[map_name].get_outgoing_lane_ids(lane_id)
+
+    def _get_map_tile(self, map_name, tile):
+        """
+        Returns, for every lane layer, the indices (in the map's list of records of that layer) of the lanes
+        intersecting the tile (tile_x, tile_y) of the map, computed once per tile.
+        """
+        if (map_name, tile) not in self._map_tiles:
+            nusc_map = self._map_dict[map_name]
+            tile_box = (tile[0] * self._map_tile_size, tile[1] * self._map_tile_size,
+                        (tile[0] + 1) * self._map_tile_size, (tile[1] + 1) * self._map_tile_size)
+            self._map_tiles[(map_name, tile)] = {
+                layer_name: [i for i, record in enumerate(getattr(nusc_map, layer_name))
+                             if nusc_map.explorer.is_record_in_patch(layer_name, record['token'], tile_box, 'intersect')]
+                for layer_name in self._lane_layers
+            }
+        return self._map_tiles[(map_name, tile)]
+
+    def _get_lanes_in_radius(self, map_name, x, y, radius):
+        """
+        Same as nuscenes' get_lanes_in_radius with a discretization of 2 meters, returning the lanes in the same order,
+        but only the lanes of the map tiles covered by the query box are tested against it.
+        """
+        nusc_map = self._map_dict[map_name]
+        box = (x - radius, y - radius, x + radius, y + radius)
+        tiles = [(tile_x, tile_y)
+                 for tile_x in range(int(math.floor(box[0] / self._map_tile_size)), int(math.floor(box[2] / self._map_tile_size)) + 1)
+                 for tile_y in range(int(math.floor(box[1] / self._map_tile_size)), int(math.floor(box[3] / self._map_tile_size)) + 1)]
+
+        lane_ids = []
+        for layer_name in self._lane_layers:
+            records = getattr(nusc_map, layer_name)
+            candidates = sorted(set(i for tile in tiles for i in self._get_map_tile(map_name, tile)[layer_name]))
+            lane_ids += [records[i]['token'] for i in candidates
+                         if nusc_map.explorer.is_record_in_patch(layer_name, records[i]['token'], box, 'intersect')]
+        return {lane_id: self._get_discretized_lane(map_name, lane_id) for lane_id in lane_ids}
+
+    def _get_map_features(self, map_name, x, y, yaw, radius, reference_position):
         curr_map = np.zeros((self._max_number_roads, self._number_future_road_points, 4))
-        lanes = get_lanes_in_radius(x=x, y=y, radius=200, map_api=nusc_map, discretization_meters=2.0)
+        lanes = self._get_lanes_in_radius(map_name, x, y, radius=200)
 
         # need to combine lanes that are connected to avoid random gaps.
         combined_lane_ids = []  # list of connected lane ids.
@@ -143,13 +193,13 @@ class NuScenesDataset(Dataset):
             if lane_id in ignore_lane_ids:
                 continue
             curr_lane_ids = [lane_id]
-            out_lane_ids = nusc_map.get_outgoing_lane_ids(lane_id)
+            out_lane_ids = self._get_outgoing_lane_ids(map_name, lane_id)
             for out_lane_id in out_lane_ids:
                 if out_lane_id in lanes.keys():
                     curr_lane_ids.append(out_lane_id)
                     ignore_lane_ids.append(out_lane_id)
 
-                    outout_lane_ids = nusc_map.get_outgoing_lane_ids(out_lane_id)
+                    outout_lane_ids = self._get_outgoing_lane_ids(map_name, out_lane_id)
                     for outout_lane_id in outout_lane_ids:
                         if outout_lane_id in lanes.keys():
                             curr_lane_ids.append(outout_lane_id)
@@ -293,7 +343,7 @@ class NuScenesDataset(Dataset):
         # Map stuff
         map_name = self._helper.get_map_name_from_sample_token(sample_token)
         theta = correct_yaw(quaternion_yaw(Quaternion(annotation['rotation'])))
-        raw_map = self._get_map_features(self._map_dict[map_name], annotation["translation"][0], annotation["translation"][1], theta, 100, [0, 0])
+        raw_map = self._get_map_features(map_name, annotation["translation"][0], annotation["translation"][1], theta, 100, [0, 0])
 
         rotated_map = np.zeros_like(raw_map)
         for road_idx in range(len(raw_map)):
@@ -0,0 +1,100 @@
+import argparse
+import os
+import time
+
+import h5py
+import numpy as np
+
+
+'''
+Rewrites one of the generated HDF5 datasets ({split_name}_dataset.hdf5) with another chunk layout and compression, and
+reports the file size and read throughput of both files, e.g.
+python -m datasets.rechunk_h5 --input <path>/train_dataset.hdf5 --output <path>/train_dataset_lzf.hdf5 --compression lzf
+
+The datasets of the rewritten file keep their names, shapes and dtypes, so it can replace the original one as is.
+'''
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Rechunk and compress an HDF5 dataset file.")
+    parser.add_argument("--input", type=str, required=True, help="HDF5 file to rewrite.")
+    parser.add_argument("--output", type=str, required=True, help="Where to write the rewritten HDF5 file.")
+    parser.add_argument("--chunk-size", type=int, default=16, help="Number of scenes per chunk.")
+    parser.add_argument("--max-chunk-mb", type=float, default=1.0,
+                        help="Upper bound on the size of a chunk, the number of scenes per chunk is reduced for "
+                             "fields with large rows (e.g. nuScenes' large_roads) so that reading one scene does "
+                             "not decompress more than this.")
+    parser.add_argument("--compression", type=str, default="lzf", choices=["none", "lzf", "gzip"],
+                        help="Compression filter, lzf is fast, gzip is smaller.")
+    parser.add_argument("--compression-level", type=int, default=4, help="gzip compression level (0-9).")
+    parser.add_argument("--shuffle", action="store_true",
+                        help="Apply the HDF5 byte shuffle filter before compression (helps on float data).")
+    parser.add_argument("--copy-mb", type=float, default=256.0, help="Amount of data copied per read/write.")
+    parser.add_argument("--benchmark-reads", type=int, default=1000,
+                        help="Number of random scenes read to measure read throughput (0 to skip).")
+    return parser.parse_args()
+
+
+def get_chunks(dataset, chunk_size, max_chunk_mb):
+    if dataset.ndim == 0:
+        return None
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    rows_per_chunk = min(chunk_size, max(1, int(max_chunk_mb * 2 ** 20) // max(row_bytes, 1)), max(len(dataset), 1))
+    return (rows_per_chunk, *dataset.shape[1:])
+
+
+def rewrite_h5(args):
+    compression = None if args.compression == "none" else args.compression
+    compression_opts = args.compression_level if compression == "gzip" else None
+    with h5py.File(args.input, 'r') as f_in, h5py.File(args.output, 'w') as f_out:
+        f_out.attrs.update(f_in.attrs)
+        for key, dataset in f_in.items():
+            chunks = get_chunks(dataset, args.chunk_size, args.max_chunk_mb)
+            new_dataset = f_out.create_dataset(key, shape=dataset.shape, dtype=dataset.dtype, chunks=chunks,
+                                               compression=compression if chunks else None,
+                                               compression_opts=compression_opts if chunks else None,
+                                               shuffle=args.shuffle and chunks is not None)
+            new_dataset.attrs.update(dataset.attrs)
+            if dataset.ndim == 0:
+                new_dataset[()] = dataset[()]
+                continue
+
+            row_bytes = max(dataset.dtype.itemsize * int(np.prod(dataset.shape[1:])), 1)
+            # copy whole chunks at a time so that every output chunk is compressed exactly once.
+            rows_per_copy = max(1, int(args.copy_mb * 2 ** 20) // row_bytes) // chunks[0] * chunks[0] or chunks[0]
+            for start in range(0, len(dataset), rows_per_copy):
+                new_dataset[start:start + rows_per_copy] = dataset[start:start + rows_per_copy]
+            print(key, dataset.shape, dataset.dtype, "chunks", dataset.chunks, "->", chunks)
+
+
+def benchmark_reads(fname, num_reads, seed=0):
+    """
+    Reads num_reads random scenes (every field of a scene, one scene per read as done by the datasets' __getitem__)
+    and returns the number of scenes and megabytes read per second.
+    Note that the OS page cache is not dropped, so the throughput of the first file read from disk is the cold one.
+    """
+    with h5py.File(fname, 'r') as f:
+        keys = [key for key in f.keys() if f[key].ndim > 0]
+        dset_len = min(len(f[key]) for key in keys)
+        indices = np.random.default_rng(seed).integers(0, dset_len, size=num_reads)
+        num_bytes = 0
+        start_time = time.time()
+        for idx in indices:
+            for key in keys:
+                num_bytes += f[key][idx].nbytes
+        elapsed = time.time() - start_time
+    return num_reads / elapsed, num_bytes / 2 ** 20 / elapsed
+
+
+if __name__ == '__main__':
+    args = get_args()
+    start_time = time.time()
+    rewrite_h5(args)
+    print("Rewrote", args.input, "to", args.output, "in", round(time.time() - start_time, 1), "s")
+
+    for fname in [args.input, args.output]:
+        print(fname)
+        print("    size:", round(os.path.getsize(fname) / 2 ** 20, 1), "MB")
+        if args.benchmark_reads > 0:
+            scenes_per_s, mb_per_s = benchmark_reads(fname, args.benchmark_reads)
+            print("    random scene reads:", round(scenes_per_s, 1), "scenes/s,", round(mb_per_s, 1), "MB/s")
@@ -0,0 +1,113 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+import torch
+
+from datasets.synth.dataset import PACKED_FIELDS, MATERIALIZED_FIELDS, get_packed_paths, get_materialized_paths, \
+    SynthV1CausalDataset, SynthV1PackedCausalDataset
+
+
+'''
+Packs all scene_<idx>.pkl files of a Synth-v1 split into a single flat float64 file ({split}_packed.bin) plus an
+offsets/shapes index ({split}_packed_index.npz). Use --synth-format packed in train.py/evaluate.py to read it.
+
+With --materialize, the preprocessed model inputs (ego_in, ego_out, agents_in, agents_out) of the factual and all
+counterfactual scenes are written instead, together with the causal effects and directly-causal labels
+({split}_materialized_*.bin and {split}_materialized_index.npz). Use --synth-format materialized to read them.
+'''
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Synth-v1 packed store creator")
+    parser.add_argument("--dataset-path", type=str, required=True, help="Path to the synth dataset (containing train/val).")
+    parser.add_argument("--output-path", type=str, default=None, help="Output path, defaults to --dataset-path.")
+    parser.add_argument("--split", type=str, default="train", help="split to pack")
+    parser.add_argument("--materialize", action="store_true", help="Store the preprocessed model inputs.")
+    parser.add_argument("--source-format", type=str, default="pickle", choices=["pickle", "packed"],
+                        help="Format to read the raw scenes from when materializing.")
+    parser.add_argument("--num-workers", type=int, default=12, help="Number of preprocessing workers.")
+    args = parser.parse_args()
+    return args
+
+
+def pack_split(dset_path, split, out_path):
+    split_path = os.path.join(dset_path, split)
+    num_scenes = len(os.listdir(split_path))
+    data_fname, index_fname = get_packed_paths(out_path, split)
+
+    offsets = {field: np.zeros(num_scenes, dtype=np.int64) for field in PACKED_FIELDS}
+    shapes = {field: [] for field in PACKED_FIELDS}
+    curr_offset = 0
+    with open(data_fname, "wb") as f:
+        for idx in range(num_scenes):
+            if idx % 1000 == 0:
+                print(idx, "/", num_scenes)
+            with open(os.path.join(split_path, "scene_" + str(idx) + ".pkl"), "rb") as scene_f:
+                scene = pickle.load(scene_f)
+            for field in PACKED_FIELDS:
+                arr = np.ascontiguousarray(scene[field], dtype=np.float64)
+                offsets[field][idx] = curr_offset
+                shapes[field].append(arr.shape)
+                f.write(arr.tobytes())
+                curr_offset += arr.size
+
+    index = {}
+    for field in PACKED_FIELDS:
+        index[field + "_offsets"] = offsets[field]
+        index[field + "_shapes"] = np.array(shapes[field], dtype=np.int64)
+    np.savez(index_fname, **index)
+    print("Packed", num_scenes, "scenes into", data_fname, "(%.2f GB)" % (curr_offset * 8 / 1e9))
+
+
+def materialize_split(dset_path, split, out_path, source_format="pickle", num_workers=12):
+    if source_format == "packed":
+        dset = SynthV1PackedCausalDataset(dset_path=dset_path, split=split)
+    else:
+        dset = SynthV1CausalDataset(dset_path=dset_path, split=split)
+    loader = torch.utils.data.DataLoader(dset, batch_size=1, shuffle=False, num_workers=num_workers,
+                                         collate_fn=lambda batch: batch[0])
+    data_fnames, index_fname = get_materialized_paths(out_path, split)
+    dtypes = {"ego_in": np.float32, "ego_out": np.float32, "agents_in": np.float32, "agents_out": np.float32,
+              "causal_effects": np.float64, "directly_causal": bool}
+
+    files = {field: open(data_fnames[field], "wb") for field in MATERIALIZED_FIELDS}
+    scene_offsets = [0]
+    shapes = {}
+    for idx, (f_cf_scenes, cf_causal_effects, directly_causal) in enumerate(loader):
+        if idx % 1000 == 0:
+            print(idx, "/", len(dset))
+        fields = {
+            "ego_in": np.stack([scene[0] for scene in f_cf_scenes]),
+            "ego_out": np.stack([scene[1] for scene in f_cf_scenes]),
+            "agents_in": np.stack([scene[2] for scene in f_cf_scenes]),
+            "agents_out": np.stack([scene[3] for scene in f_cf_scenes]),
+            # aligned with the scenes, the first (factual) entry is a placeholder.
+            "causal_effects": np.concatenate(([0.0], cf_causal_effects)),
+            "directly_causal": np.concatenate(([False], directly_causal)),
+        }
+        for field in MATERIALIZED_FIELDS:
+            arr = np.ascontiguousarray(fields[field], dtype=dtypes[field])
+            shapes[field] = arr.shape[1:]
+            files[field].write(arr.tobytes())
+        scene_offsets.append(scene_offsets[-1] + len(f_cf_scenes))
+    for f in files.values():
+        f.close()
+
+    index = {"scene_offsets": np.array(scene_offsets, dtype=np.int64)}
+    for field in MATERIALIZED_FIELDS:
+        index[field + "_shape"] = np.array(shapes[field], dtype=np.int64)
+        index[field + "_dtype"] = np.dtype(dtypes[field]).str
+    np.savez(index_fname, **index)
+    print("Materialized", len(dset), "samples with", scene_offsets[-1], "scenes into", out_path)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    out_path = args.output_path if args.output_path is not None else args.dataset_path
+    if args.materialize:
+        materialize_split(args.dataset_path, args.split, out_path, source_format=args.source_format,
+                          num_workers=args.num_workers)
+    else:
+        pack_split(args.dataset_path, args.split, out_path)
@@ -1,4 +1,5 @@
 import os
+from collections import Counter
 
 import numpy as np
 from torch.utils.data import Dataset
@@ -44,6 +45,37 @@ def center_scene(xy, obs_length=8, ped_id=0):
     return xy, rotation, center
 
 
+def drop_distant_batch(xy, max_num_peds=5):
+    """
+    Batched version of drop_distant for xy of shape (batch, time, agent, 2)
+    """
+    distance_2 = np.sum(np.square(xy - xy[:, :, 0:1]), axis=3)
+    smallest_dist_to_ego = np.nanmin(distance_2, axis=1)
+    closest = np.argsort(smallest_dist_to_ego, axis=1)[:, :max_num_peds]
+    return xy[np.arange(len(xy))[:, np.newaxis], :, closest].transpose((0, 2, 1, 3))
+
+
+def center_scene_batch(xy, obs_length=8, ped_id=0):
+    """
+    Batched version of center_scene for xy of shape (batch, time, agent, 2)
+    """
+    ## Center
+    center = xy[:, obs_length - 1, ped_id]  ## Last Observation
+    xy = xy - center[:, np.newaxis, np.newaxis, :]
+
+    ## Rotate
+    diff = xy[:, obs_length - 1, ped_id] - xy[:, obs_length - 2, ped_id]
+    # angles are computed per scene with the same scalar functions as center_scene and theta_rotation,
+    # the vectorized ufuncs can differ from them in the last bit.
+    rotation = np.array([-np.arctan2(d[1], d[0]) + np.pi / 2 for d in diff])
+    ct = np.array([math.cos(theta) for theta in rotation])
+    st = np.array([math.sin(theta) for theta in rotation])
+    # same products and sums as the einsum of theta_rotation, written out because a batched einsum is much slower.
+    ct, st = ct[:, np.newaxis, np.newaxis], st[:, np.newaxis, np.newaxis]
+    xy = np.stack([xy[..., 0] * ct + xy[..., 1] * -st, xy[..., 0] * st + xy[..., 1] * ct], axis=3)
+    return xy, rotation, center
+
+
 class SynthV1CausalDataset(Dataset):
     def __init__(self, dset_path, split="train", size=-1):
         # TODO: Note that the number of agents is hardcoded to match the
@@ -61,12 +93,16 @@ class SynthV1CausalDataset(Dataset):
         self.k_attr = 2
 
         self.dataset_path = os.path.join(dset_path, split)
-        print(f"SynthV1CausalDataset: Loading dataset from {os.path.abspath(self.dataset_path)}")
-        self.size = size
-        if size == -1:
-            self.size = len(os.listdir(self.dataset_path))
-        else:
-            self.size = min(self.size, len(os.listdir(self.dataset_path)))
+        print(f"{type(self).__name__}: Loading dataset from {os.path.abspath(self.dataset_path)}")
+        num_scenes = self._get_num_scenes()
+        self.size = num_scenes if size == -1 else min(size, num_scenes)
+
+    def _get_num_scenes(self):
+        return len(os.listdir(self.dataset_path))
+
+    def _load_scene(self, idx):
+        with open(os.path.join(self.dataset_path, "scene_"+str(idx)+".pkl"), "rb") as f:
+            return pickle.load(f)
 
     def unpack_datapoint(self, trajectories):
         assert len(trajectories) == self.in_seq_len + self.pred_horizon
@@ -101,27 +137,50 @@ class SynthV1CausalDataset(Dataset):
             trajectories = tmp_trajectories.copy()
         return self.unpack_datapoint(trajectories)
 
-    def __getitem__(self, idx: int):
-        f_cf_scenes = []
-        cf_causal_effects = []
+    def unpack_datapoints(self, trajectories):
+        """
+        Batched version of unpack_datapoint for trajectories of shape (batch, time, agent, 2).
+        Returns one unpacked datapoint per element of the batch.
+        """
+        assert trajectories.shape[1] == self.in_seq_len + self.pred_horizon
 
-        with open(os.path.join(self.dataset_path, "scene_"+str(idx)+".pkl"), "rb") as f:
-            scene = pickle.load(f)
+        # Remove nan values and add mask column to state
+        data_mask = np.ones((*trajectories.shape[:3], 3))
+        data_mask[..., :2] = trajectories
+        data_mask[np.isnan(trajectories[..., 0])] = 0
+
+        # Separate past and future.
+        agents_in = data_mask[:, :self.in_seq_len]
+        agents_out = data_mask[:, self.in_seq_len:]
+
+        agent_types = np.ones((self.num_others + 1, self.num_agent_types))
+        roads = np.ones((1, 1))  # for dataloading to work with other datasets that have images.
+
+        return [(agents_in[i, :, 0], agents_out[i, :, 0], agents_in[i, :, 1:], agents_out[i, :, 1:], roads, agent_types)
+                for i in range(len(trajectories))]
 
-        num_agents = len(scene["trajectories"])
+    def _do_preprocess_batch(self, raw_trajectories, max_number_of_agents=39):
+        # Same as _do_preprocess, for all (time, agent, state) trajectories stacked in raw_trajectories at once.
+        assert raw_trajectories.shape[1] == 20
+        trajectories = drop_distant_batch(raw_trajectories, max_num_peds=max_number_of_agents)
+        trajectories, rotation, center = center_scene_batch(trajectories)
+        if trajectories.shape[2] < max_number_of_agents:
+            tmp_trajectories = np.full((len(trajectories), 20, max_number_of_agents, 2), np.nan)
+            tmp_trajectories[:, :, :trajectories.shape[2], :] = trajectories
+            trajectories = tmp_trajectories
+        return self.unpack_datapoints(trajectories)
 
-        f_traj = scene["trajectories"].transpose((1, 0, 2))  # (time, agent, state)
-        f_cf_scenes.append(self._do_preprocess(f_traj))
+    def __getitem__(self, idx: int):
+        scene = self._load_scene(idx)
 
-        for i in range(1, num_agents):
-            cf_traj = scene["remove_agent_i_trajectories"][i].transpose((1, 0, 2))
+        # factual scene followed by the scenes with agent i removed, for i = 1..num_agents-1.
+        f_cf_traj = np.concatenate([scene["trajectories"][np.newaxis], scene["remove_agent_i_trajectories"][1:]])
+        f_cf_scenes = self._do_preprocess_batch(f_cf_traj.transpose((0, 2, 1, 3)))  # (scene, time, agent, state)
 
-            cf_gt = scene["remove_agent_i_trajectories"][i, 0, -self.pred_horizon:, :]
-            f_gt = scene["trajectories"][0, -self.pred_horizon:, :]
-            causal_effect = (np.sqrt(((cf_gt - f_gt) ** 2).sum(1))).mean()
+        cf_gt = scene["remove_agent_i_trajectories"][1:, 0, -self.pred_horizon:, :]
+        f_gt = scene["trajectories"][0, -self.pred_horizon:, :]
+        cf_causal_effects = list(np.sqrt(((cf_gt - f_gt) ** 2).sum(2)).mean(1))
 
-            f_cf_scenes.append(self._do_preprocess(cf_traj))
-            cf_causal_effects.append(causal_effect)
         # directly causality labels
         ego_causality_labels = scene["causality_labels"][0, :, 1:]
         directly_causal = ego_causality_labels.any(0)
@@ -132,11 +191,162 @@ class SynthV1CausalDataset(Dataset):
         return self.size
 
 
+PACKED_FIELDS = ["trajectories", "remove_agent_i_trajectories", "causality_labels"]
+
+
+def get_packed_paths(dset_path, split):
+    """
+    Returns the (data, index) file paths of the packed version of a Synth-v1 split.
+    """
+    return os.path.join(dset_path, split + "_packed.bin"), os.path.join(dset_path, split + "_packed_index.npz")
+
+
+class SynthV1PackedCausalDataset(SynthV1CausalDataset):
+    """
+    Same samples as SynthV1CausalDataset, but read from the packed store written by create_packed_synth.py.
+    All scenes live in one flat float64 file that is memory-mapped, so scenes are sliced zero-copy from the page
+    cache instead of being unpickled from one file per scene.
+    """
+    def __init__(self, dset_path, split="train", size=-1):
+        self.data_fname, index_fname = get_packed_paths(dset_path, split)
+        with np.load(index_fname) as index:
+            self.index = {k: index[k] for k in index.files}
+        self.data = None  # opened lazily so that every DataLoader worker maps the file itself.
+        super(SynthV1PackedCausalDataset, self).__init__(dset_path, split=split, size=size)
+
+    def _get_num_scenes(self):
+        return len(self.index["trajectories_offsets"])
+
+    def _load_scene(self, idx):
+        if self.data is None:
+            self.data = np.memmap(self.data_fname, dtype=np.float64, mode="r")
+        scene = {}
+        for field in PACKED_FIELDS:
+            start = self.index[field + "_offsets"][idx]
+            shape = self.index[field + "_shapes"][idx]
+            scene[field] = self.data[start:start + np.prod(shape)].reshape(shape)
+        return scene
+
+
+MATERIALIZED_FIELDS = ["ego_in", "ego_out", "agents_in", "agents_out", "causal_effects", "directly_causal"]
+
+
+def get_materialized_paths(dset_path, split):
+    """
+    Returns the per-field data file paths and the index file path of the materialized version of a Synth-v1 split.
+    """
+    data_fnames = {field: os.path.join(dset_path, split + "_materialized_" + field + ".bin")
+                   for field in MATERIALIZED_FIELDS}
+    return data_fnames, os.path.join(dset_path, split + "_materialized_index.npz")
+
+
+class SynthV1MaterializedCausalDataset(SynthV1CausalDataset):
+    """
+    Reads the already preprocessed factual/counterfactual scenes and causal effects written by
+    create_packed_synth.py --materialize, so __getitem__ only slices memory-mapped arrays.
+    All scenes of a split are stored back to back along the first axis of every field, with
+    index["scene_offsets"][idx] pointing at the factual scene of sample idx and the following entries
+    being its counterfactuals. The causal effects and directly-causal labels are aligned with the
+    counterfactual scenes (the entry at the factual position is unused).
+    """
+    def __init__(self, dset_path, split="train", size=-1):
+        self.data_fnames, index_fname = get_materialized_paths(dset_path, split)
+        with np.load(index_fname) as index:
+            self.index = {k: index[k] for k in index.files}
+        self.data = None  # opened lazily so that every DataLoader worker maps the files itself.
+        super(SynthV1MaterializedCausalDataset, self).__init__(dset_path, split=split, size=size)
+
+    def _get_num_scenes(self):
+        return len(self.index["scene_offsets"]) - 1
+
+    def _open_data(self):
+        num_total_scenes = self.index["scene_offsets"][-1]
+        self.data = {}
+        for field in MATERIALIZED_FIELDS:
+            shape = (num_total_scenes, *self.index[field + "_shape"])
+            self.data[field] = np.memmap(self.data_fnames[field], dtype=str(self.index[field + "_dtype"]), mode="r",
+                                         shape=shape)
+
+    def __getitem__(self, idx: int):
+        if self.data is None:
+            self._open_data()
+        start, end = self.index["scene_offsets"][idx], self.index["scene_offsets"][idx + 1]
+        ego_in, ego_out = self.data["ego_in"][start:end], self.data["ego_out"][start:end]
+        agents_in, agents_out = self.data["agents_in"][start:end], self.data["agents_out"][start:end]
+
+        roads = np.ones((1, 1))  # for dataloading to work with other datasets that have images.
+        agent_types = np.ones((self.num_others + 1, self.num_agent_types))
+        f_cf_scenes = [(ego_in[i], ego_out[i], agents_in[i], agents_out[i], roads, agent_types)
+                       for i in range(end - start)]
+        cf_causal_effects = list(self.data["causal_effects"][start + 1:end])
+        directly_causal = np.array(self.data["directly_causal"][start + 1:end])
+        return f_cf_scenes, cf_causal_effects, directly_causal
+
+
+# maps the --synth-format argument to the dataset class reading that format.
+SYNTH_DATASET_FORMATS = {
+    "pickle": SynthV1CausalDataset,
+    "packed": SynthV1PackedCausalDataset,
+    "materialized": SynthV1MaterializedCausalDataset,
+}
+
+
+def get_removed_agents(f_cf_scenes):
+    """
+    Returns, for every counterfactual of f_cf_scenes (the factual scene followed by its counterfactuals, as returned by
+    the datasets), the index in the factual agents_in of the agent removed in it, or -1 if the observations of the
+    counterfactual are not those of the factual scene without one of its agents. Counterfactuals are preprocessed on
+    their own, and drop_distant sorts their agents by distance over the whole scene, future included, so their
+    observed agents are matched to the factual ones in any order (AutoBotEgo does not depend on the order of the other
+    agents). If the removed agent is not observed, an unobserved slot of the factual scene is returned.
+    """
+    f_ego_in, _, f_agents_in = f_cf_scenes[0][:3]
+    f_observed = np.flatnonzero(f_agents_in[:, :, -1].any(0))
+    f_unobserved = np.flatnonzero(~f_agents_in[:, :, -1].any(0))
+    f_agents = Counter(f_agents_in[:, agent].tobytes() for agent in f_observed)
+
+    removed_agents = np.full(len(f_cf_scenes) - 1, -1, dtype=np.int64)
+    for cf_id, (ego_in, _, agents_in) in enumerate(scene[:3] for scene in f_cf_scenes[1:]):
+        if not np.array_equal(ego_in, f_ego_in):
+            continue
+        cf_agents = Counter(agents_in[:, agent].tobytes() for agent in np.flatnonzero(agents_in[:, :, -1].any(0)))
+        missing = f_agents - cf_agents
+        if cf_agents - f_agents:
+            continue
+        if sum(missing.values()) == 1:
+            missing_agent = next(iter(missing))
+            removed_agents[cf_id] = next(agent for agent in f_observed
+                                         if f_agents_in[:, agent].tobytes() == missing_agent)
+        elif not missing and len(f_unobserved) > 0:
+            removed_agents[cf_id] = f_unobserved[0]
+    return removed_agents
+
+
 def my_collate_fn(batch):
-    scenes, causal_effects, directly_causals, data_split = [], [], [], [0]
-    for f_cf_scenes, cf_causal_effects, directly_causal in batch:
-        scenes = scenes + f_cf_scenes
-        causal_effects.append(cf_causal_effects)
-        directly_causals.append(directly_causal)
-        data_split.append(data_split[-1] + len(f_cf_scenes))
-    return torch.utils.data.dataloader.default_collate(scenes), causal_effects, directly_causals, data_split
\ No newline at end of file
+    """
+    Collates the factual and counterfactual scenes of all samples of the batch into one flat batch of scenes.
+    Every field is written into a single float32 tensor that is preallocated from the number of scenes per sample
+    (in shared memory when called from a DataLoader worker, so the batch is not copied again to reach the main
+    process). data_splits[i]:data_splits[i+1] are the scenes of sample i, the first of them being the factual one.
+    removed_agents[i] are the agents removed in the counterfactuals of sample i (see get_removed_agents), for
+    AutoBotEgo.forward_counterfactual.
+    """
+    num_scenes = torch.tensor([len(f_cf_scenes) for f_cf_scenes, _, _ in batch])
+    data_splits = torch.zeros(len(batch) + 1, dtype=torch.long)
+    data_splits[1:] = torch.cumsum(num_scenes, 0)
+    in_worker = torch.utils.data.get_worker_info() is not None
+
+    scenes = []
+    for field_id, field in enumerate(batch[0][0][0]):
+        collated = torch.empty((int(data_splits[-1]), *np.shape(field)), dtype=torch.float32)
+        if in_worker:
+            collated.share_memory_()
+        collated_np = collated.numpy()
+        for (f_cf_scenes, _, _), start, end in zip(batch, data_splits[:-1], data_splits[1:]):
+            np.stack([scene[field_id] for scene in f_cf_scenes], out=collated_np[start:end])
+        scenes.append(collated)
+
+    causal_effects = [cf_causal_effects for _, cf_causal_effects, _ in batch]
+    directly_causals = [directly_causal for _, _, directly_causal in batch]
+    removed_agents = [torch.from_numpy(get_removed_agents(f_cf_scenes)) for f_cf_scenes, _, _ in batch]
+    return scenes, causal_effects, directly_causals, data_splits, removed_agents
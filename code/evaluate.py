@@ -8,15 +8,17 @@ import torch
 from tqdm import tqdm
 
 from datasets.argoverse.dataset import ArgoH5Dataset
+from datasets.h5_dataset import h5_worker_init_fn
 from datasets.interaction_dataset.dataset import InteractionDataset
 from datasets.nuscenes.dataset import NuscenesH5Dataset
-from datasets.synth.dataset import SynthV1CausalDataset, my_collate_fn
+from datasets.synth.dataset import SYNTH_DATASET_FORMATS, my_collate_fn
 from datasets.trajnetpp.dataset import TrajNetPPDataset
 from models.autobot_ego import AutoBotEgo
 from models.autobot_joint import AutoBotJoint
 from process_args import get_eval_args
+from utils.data_helpers import get_dataloader_kwargs, prefetch
 from utils.metric_helpers import min_xde_K, yaw_from_predictions, interpolate_trajectories, collisions_for_inter_dataset, collision_rate
-from utils.train_helpers import  calc_consistency_loss, HNC_ARS, ACEs
+from utils.train_helpers import  calc_consistency_loss, HNC_ARS, ACEs, forward_f_cf
 
 
 class Evaluator:
@@ -57,7 +59,7 @@ class Evaluator:
                                      use_map_lanes=self.model_config.use_map_lanes)
 
         elif self.args.dataset == "synth":
-            val_dset = SynthV1CausalDataset(dset_path=self.args.dataset_path, split="val")
+            val_dset = SYNTH_DATASET_FORMATS[self.args.synth_format](dset_path=self.args.dataset_path, split="val")
         
         elif "s2r" in self.args.dataset:
             val_dset = TrajNetPPDataset(dset_path=self.args.dataset_path, split_name="test")
@@ -73,16 +75,19 @@ class Evaluator:
         if "Joint" in self.model_config.model_type:
             self.num_agent_types = val_dset.num_agent_types
 
+        loader_kwargs = get_dataloader_kwargs(self.args)
         if self.args.dataset == "synth":
             self.val_loader = torch.utils.data.DataLoader(
-                val_dset, batch_size=self.args.batch_size, shuffle=True, num_workers=12, drop_last=False,
-                pin_memory=False, collate_fn=my_collate_fn
+                val_dset, batch_size=self.args.batch_size, shuffle=True, drop_last=False, collate_fn=my_collate_fn,
+                **loader_kwargs
             )
         else:
             self.val_loader = torch.utils.data.DataLoader(
-                val_dset, batch_size=self.args.batch_size, shuffle=True, num_workers=12, drop_last=False,
-                pin_memory=False
+                val_dset, batch_size=self.args.batch_size, shuffle=True, drop_last=False,
+                worker_init_fn=h5_worker_init_fn, **loader_kwargs
             )
+        if self.args.prefetch_batches > 0:
+            self.val_loader = prefetch(self.val_loader, self.device, self.args.prefetch_batches)
 
         print("Val dataset loaded with length", len(val_dset))
 
@@ -111,7 +116,9 @@ class Evaluator:
                                             return_embeddings=((self.model_config.reg_type in ["contrastive", "ranking"] and self.model_config.dataset == "synth") or self.model_config.dataset == "s2r"),
                                             projector_dim1=proj_dim1,
                                             projector_dim2=proj_dim2,
-                                            projector_dim3=proj_dim3).to(self.device)
+                                            projector_dim3=proj_dim3,
+                                            pack_agents=getattr(self.model_config, 'pack_agents', False),
+                                            use_sdpa=self.args.sdpa_attention).to(self.device)
 
         elif "Joint" in self.model_config.model_type:
             self.autobot_model = AutoBotJoint(k_attr=self.k_attr,
@@ -127,7 +134,9 @@ class Evaluator:
                                               use_map_lanes=self.model_config.use_map_lanes,
                                               map_attr=self.map_attr,
                                               num_agent_types=self.num_agent_types,
-                                              predict_yaw=self.predict_yaw).to(self.device)
+                                              predict_yaw=self.predict_yaw,
+                                              mode_chunk_size=self.args.mode_chunk_size,
+                                              use_sdpa=self.args.sdpa_attention).to(self.device)
         else:
             raise NotImplementedError
 
@@ -146,20 +155,20 @@ class Evaluator:
 
         if "Joint" in model_type:
             ego_in, ego_out, agents_in, agents_out, context_img, agent_types = data
-            ego_in = ego_in.float().to(self.device)
-            ego_out = ego_out.float().to(self.device)
-            agents_in = agents_in.float().to(self.device)
-            agents_out = agents_out.float().to(self.device)
-            context_img = context_img.float().to(self.device)
-            agent_types = agent_types.float().to(self.device)
+            ego_in = ego_in.float().to(self.device, non_blocking=True)
+            ego_out = ego_out.float().to(self.device, non_blocking=True)
+            agents_in = agents_in.float().to(self.device, non_blocking=True)
+            agents_out = agents_out.float().to(self.device, non_blocking=True)
+            context_img = context_img.float().to(self.device, non_blocking=True)
+            agent_types = agent_types.float().to(self.device, non_blocking=True)
             return ego_in, ego_out, agents_in, agents_out, context_img, agent_types
 
         elif "Ego" in model_type:
             ego_in, ego_out, agents_in, roads = data
-            ego_in = ego_in.float().to(self.device)
-            ego_out = ego_out.float().to(self.device)
-            agents_in = agents_in.float().to(self.device)
-            roads = roads.float().to(self.device)
+            ego_in = ego_in.float().to(self.device, non_blocking=True)
+            ego_out = ego_out.float().to(self.device, non_blocking=True)
+            agents_in = agents_in.float().to(self.device, non_blocking=True)
+            roads = roads.float().to(self.device, non_blocking=True)
             return ego_in, ego_out, agents_in, roads
 
     def _compute_ego_errors(self, ego_preds, ego_gt):
@@ -218,8 +227,8 @@ class Evaluator:
                     # compute scene collisions almost like they do.
                     orig_ego_in, orig_agents_in, original_roads, translations = data[6:]
                     data = data[:6]
-                    orig_ego_in = orig_ego_in.float().to(self.device)
-                    orig_agents_in = orig_agents_in.float().to(self.device)
+                    orig_ego_in = orig_ego_in.float().to(self.device, non_blocking=True)
+                    orig_agents_in = orig_agents_in.float().to(self.device, non_blocking=True)
 
                 ego_in, ego_out, agents_in, agents_out, context_img, agent_types = self._data_to_device(data)
                 pred_obs, mode_probs = self.autobot_model(ego_in, agents_in, context_img, agent_types)
@@ -284,7 +293,7 @@ class Evaluator:
                     print(i, "/", len(self.val_loader.dataset) // self.args.batch_size)
 
                 if self.args.dataset == "synth":
-                    scenes, causal_effects, directly_causals, data_splits = data
+                    scenes, causal_effects, directly_causals, data_splits, removed_agents = data
                     if not self.args.evaluate_causal:
                         scenes = [data[data_splits[:-1]] for data in scenes]
                     ego_in, ego_out, agents_in, agents_out, context_img, _ = self._data_to_device(scenes, "Joint")
@@ -298,7 +307,9 @@ class Evaluator:
                     ego_in, ego_out, agents_in, roads = self._data_to_device(data)
 
                 if "Ego" in self.model_config.model_type:
-                    if self.model_config.dataset == "synth" and self.model_config.reg_type in ["contrastive", "ranking"]:
+                    if self.args.dataset == "synth" and self.args.evaluate_causal:
+                        pred_obs, mode_probs = forward_f_cf(self.autobot_model, ego_in, agents_in, roads, data_splits, removed_agents)[:2]
+                    elif self.model_config.dataset == "synth" and self.model_config.reg_type in ["contrastive", "ranking"]:
                         pred_obs, mode_probs, _ = self.autobot_model(ego_in, agents_in, roads)
                     elif self.model_config.dataset == "s2r":
                         pred_obs, mode_probs, _ = self.autobot_model(ego_in, agents_in, roads)
@@ -0,0 +1,180 @@
+import torch
+import torch.nn.functional as F
+
+
+# F.scaled_dot_product_attention was added in torch 2.0, the SDPA paths fall back to the stock modules without it.
+SDPA_AVAILABLE = hasattr(F, "scaled_dot_product_attention")
+
+
+def packed_encoder_layer(layer, x, key_padding_mask, num_buckets=4):
+    '''
+    Applies layer, a (seq, batch, H) transformer encoder, to the non-padded elements of every sequence of x only.
+    The elements of every sequence are reordered so that the non-padded ones come first, the sequences are sorted by
+    number of non-padded elements and split into num_buckets buckets, and every bucket is trimmed to its longest
+    sequence. The cost of the layer then scales with the number of non-padded elements instead of the padded length.
+    Outputs at non-padded elements are the ones of layer(x, src_key_padding_mask=key_padding_mask), padded elements
+    are returned unchanged (the layer is not applied to them).
+    :param x: (N, R, H) R sequences of N elements.
+    :param key_padding_mask: (R, N) True at padded elements.
+    :return: (N, R, H)
+    '''
+    R = x.size(1)
+    num_live = (~key_padding_mask).sum(1)
+    elements_order = torch.argsort(key_padding_mask.to(torch.uint8), dim=1, stable=True)  # non-padded first.
+    rows_order = torch.argsort(num_live)
+
+    out = x.clone()
+    bucket_size = (R + num_buckets - 1) // num_buckets
+    for start in range(0, R, bucket_size):
+        rows = rows_order[start:start + bucket_size]
+        width = max(int(num_live[rows[-1]]), 1)
+        elements = elements_order[rows, :width]  # (rows, width)
+        bucket_masks = key_padding_mask[rows.unsqueeze(1), elements]
+        bucket_emb = layer(x[elements.t(), rows], src_key_padding_mask=bucket_masks)
+        bucket_emb = torch.where(bucket_masks.t().unsqueeze(-1), x[elements.t(), rows], bucket_emb)
+        out[elements.t(), rows] = bucket_emb
+    return out
+
+
+def merge_modes(x, num_modes):
+    '''
+    :param x: (L, B*num_modes, H) with the modes of a scene consecutive along the batch.
+    :return: (num_modes*L, B, H) the sequences of all the modes of a scene back to back.
+    '''
+    L, BK, H = x.shape
+    return x.view(L, BK // num_modes, num_modes, H).permute(2, 0, 1, 3).reshape(num_modes * L, BK // num_modes, H)
+
+
+def split_modes(x, num_modes):
+    '''
+    Inverse of merge_modes.
+    :param x: (num_modes*L, B, H)
+    :return: (L, B*num_modes, H)
+    '''
+    KL, B, H = x.shape
+    return x.view(num_modes, KL // num_modes, B, H).permute(1, 2, 0, 3).reshape(KL // num_modes, B * num_modes, H)
+
+
+def sdpa_attn(attn, query, key, value, attn_mask=None, key_padding_mask=None):
+    '''
+    Same as attn(query, key, value, attn_mask=attn_mask, key_padding_mask=key_padding_mask)[0] for a stock
+    nn.MultiheadAttention attn, but with batch-first inputs of any number of batch dimensions, computed with
+    F.scaled_dot_product_attention from the parameters of attn (so that checkpoints are shared by both paths).
+    The inputs can be views (e.g. transposes) of larger tensors, the heads are split and merged with views only.
+    :param query: (..., L, E)
+    :param key, value: (..., S, E), passing the same tensor as query for self-attention projects it only once.
+    :param attn_mask: (L, S) True where attention is not allowed.
+    :param key_padding_mask: (..., S) True at padded keys.
+    :return: (..., L, E)
+    '''
+    num_heads = attn.num_heads
+    if query is key and key is value:
+        q, k, v = F.linear(query, attn.in_proj_weight, attn.in_proj_bias).unflatten(-1, (3, num_heads, -1)).unbind(-3)
+    else:
+        w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = attn.in_proj_bias.chunk(3) if attn.in_proj_bias is not None else (None, None, None)
+        q = F.linear(query, w_q, b_q).unflatten(-1, (num_heads, -1))
+        k = F.linear(key, w_k, b_k).unflatten(-1, (num_heads, -1))
+        v = F.linear(value, w_v, b_v).unflatten(-1, (num_heads, -1))
+
+    # scaled_dot_product_attention masks are True where attention is allowed.
+    mask = None
+    if key_padding_mask is not None:
+        mask = ~key_padding_mask.unsqueeze(-2).unsqueeze(-3)  # [..., 1, 1, S]
+    if attn_mask is not None:
+        mask = ~attn_mask if mask is None else mask & ~attn_mask
+
+    out = F.scaled_dot_product_attention(q.transpose(-2, -3), k.transpose(-2, -3), v.transpose(-2, -3),
+                                         attn_mask=mask, dropout_p=attn.dropout if attn.training else 0.0)
+    return attn.out_proj(out.transpose(-2, -3).flatten(-2))
+
+
+def sdpa_encoder(encoder, x, key_padding_mask, dim):
+    '''
+    Same as encoder, a stock seq-first nn.TransformerEncoder, applied to the sequences along dimension dim of x, with
+    the attention computed by sdpa_attn. The sequence dimension is moved with views, x keeps its layout.
+    :param x: (..., H)
+    :param key_padding_mask: True at padded elements, shaped like x.movedim(dim, -2) without its last dimension.
+    :return: same shape as x.
+    '''
+    x = x.movedim(dim, -2)
+    for layer in encoder.layers:
+        def sa_block(x):
+            return layer.dropout1(sdpa_attn(layer.self_attn, x, x, x, key_padding_mask=key_padding_mask))
+
+        def ff_block(x):
+            return layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(x)))))
+
+        if layer.norm_first:
+            x = x + sa_block(layer.norm1(x))
+            x = x + ff_block(layer.norm2(x))
+        else:
+            x = layer.norm1(x + sa_block(x))
+            x = layer.norm2(x + ff_block(x))
+    if encoder.norm is not None:
+        x = encoder.norm(x)
+    return x.movedim(-2, dim)
+
+
+def shared_memory_attn(attn, query, memory, num_modes, key_padding_mask=None, use_sdpa=False):
+    '''
+    Same as attn(query, memory_rep, memory_rep, key_padding_mask=key_padding_mask_rep)[0], memory_rep and
+    key_padding_mask_rep being memory and key_padding_mask repeated for every mode, without repeating them: the queries
+    of all the modes of a scene are attended at once to the memory of the scene, whose keys and values are then only
+    projected once.
+    :param attn: seq-first nn.MultiheadAttention.
+    :param query: (L, B*num_modes, H)
+    :param memory: (S, B, H)
+    :param key_padding_mask: (B, S)
+    :param use_sdpa: computes the attention with sdpa_attn.
+    :return: (L, B*num_modes, H)
+    '''
+    query = merge_modes(query, num_modes)
+    if use_sdpa:
+        memory = memory.transpose(0, 1)
+        out = sdpa_attn(attn, query.transpose(0, 1), memory, memory, key_padding_mask=key_padding_mask).transpose(0, 1)
+    else:
+        out = attn(query, memory, memory, key_padding_mask=key_padding_mask, need_weights=False)[0]
+    return split_modes(out, num_modes)
+
+
+def shared_memory_decoder_layer(layer, tgt, memory, num_modes, tgt_mask=None, memory_key_padding_mask=None,
+                                use_sdpa=False):
+    '''
+    Same as layer(tgt, memory_rep, tgt_mask=tgt_mask, memory_key_padding_mask=memory_key_padding_mask_rep) for memory
+    shared by the num_modes modes of each scene, see shared_memory_attn. Only the cross-attention changes: the
+    self-attention stays per mode and sequence.
+    :param layer: seq-first nn.TransformerDecoderLayer.
+    :param tgt: (T, B*num_modes, H)
+    :param memory: (S, B, H)
+    :param memory_key_padding_mask: (B, S)
+    :param use_sdpa: computes the attention with sdpa_attn.
+    :return: (T, B*num_modes, H)
+    '''
+    def sa_block(x):
+        if use_sdpa:
+            x = x.transpose(0, 1)
+            x = sdpa_attn(layer.self_attn, x, x, x, attn_mask=tgt_mask).transpose(0, 1)
+        else:
+            x = layer.self_attn(x, x, x, attn_mask=tgt_mask, need_weights=False)[0]
+        return layer.dropout1(x)
+
+    def mha_block(x):
+        x = shared_memory_attn(layer.multihead_attn, x, memory, num_modes, key_padding_mask=memory_key_padding_mask,
+                               use_sdpa=use_sdpa)
+        return layer.dropout2(x)
+
+    def ff_block(x):
+        x = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+        return layer.dropout3(x)
+
+    x = tgt
+    if layer.norm_first:
+        x = x + sa_block(layer.norm1(x))
+        x = x + mha_block(layer.norm2(x))
+        x = x + ff_block(layer.norm3(x))
+    else:
+        x = layer.norm1(x + sa_block(x))
+        x = layer.norm2(x + mha_block(x))
+        x = layer.norm3(x + ff_block(x))
+    return x
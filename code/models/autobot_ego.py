@@ -4,6 +4,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from models.attention_utils import SDPA_AVAILABLE, packed_encoder_layer, sdpa_encoder, shared_memory_attn, \
+    shared_memory_decoder_layer
 from models.context_encoders import MapEncoderCNN, MapEncoderPts
 
 
@@ -33,10 +35,10 @@ class PositionalEncoding(nn.Module):
 
     def forward(self, x):
         '''
-        :param x: must be (T, B, H)
+        :param x: must be (T, B, H) or (T, B, N, H)
         :return:
         '''
-        x = x + self.pe[:x.size(0), :]
+        x = x + self.pe[:x.size(0)].view(x.size(0), *([1] * (x.dim() - 2)), -1)
         return self.dropout(x)
 
 
@@ -74,7 +76,8 @@ class AutoBotEgo(nn.Module):
     AutoBot-Ego Class.
     '''
     def __init__(self, d_k=128, _M=5, c=5, T=30, L_enc=1, dropout=0.0, k_attr=2, map_attr=3,
-                 num_heads=16, L_dec=1, tx_hidden_size=384, use_map_img=False, use_map_lanes=False, return_embeddings=False, projector_dim1=128, projector_dim2=16, projector_dim3=0):
+                 num_heads=16, L_dec=1, tx_hidden_size=384, use_map_img=False, use_map_lanes=False, return_embeddings=False, projector_dim1=128, projector_dim2=16, projector_dim3=0, pack_agents=False,
+                 use_sdpa=False):
         super(AutoBotEgo, self).__init__()
 
         init_ = lambda m: init(m, nn.init.xavier_normal_, lambda x: nn.init.constant_(x, 0), np.sqrt(2))
@@ -96,6 +99,11 @@ class AutoBotEgo(nn.Module):
         self.projector_dim1 = projector_dim1
         self.projector_dim2 = projector_dim2
         self.projector_dim3 = projector_dim3
+        self.pack_agents = pack_agents  # social attention only over the agents present, see packed_encoder_layer.
+        # attention computed with F.scaled_dot_product_attention (see sdpa_attn), from the same parameters.
+        self.use_sdpa = use_sdpa and SDPA_AVAILABLE
+        if use_sdpa and not SDPA_AVAILABLE:
+            print("scaled_dot_product_attention needs torch >= 2.0, using nn.MultiheadAttention instead.")
 
         # INPUT ENCODERS
         self.agents_dynamic_encoder = nn.Sequential(init_(nn.Linear(k_attr, d_k)))
@@ -192,7 +200,6 @@ class AutoBotEgo(nn.Module):
         ego_tensor = ego[:, :, :self.k_attr]
         env_masks_orig = ego[:, :, -1]
         env_masks = (1.0 - env_masks_orig).type(torch.BoolTensor).to(env_masks_orig.device)
-        env_masks = env_masks.unsqueeze(1).repeat(1, self.c, 1).view(ego.shape[0] * self.c, -1)
 
         # Agents stuff
         temp_masks = torch.cat((torch.ones_like(env_masks_orig.unsqueeze(-1)), agents[:, :, :, -1]), dim=-1)
@@ -208,6 +215,10 @@ class AutoBotEgo(nn.Module):
         :return: (T, B, N, H)
         '''
         T_obs = agents_emb.size(0)
+        if self.use_sdpa:
+            temp_masks = agent_masks.transpose(1, 2).clone()
+            temp_masks[:, :, -1][temp_masks.sum(-1) == T_obs] = False
+            return sdpa_encoder(layer, self.pos_encoder(agents_emb), temp_masks, dim=0)
         B = agent_masks.size(0)
         num_agents = agent_masks.size(2)
         temp_masks = agent_masks.permute(0, 2, 1).reshape(-1, T_obs)
@@ -222,10 +233,15 @@ class AutoBotEgo(nn.Module):
         :param agent_masks: (B, T, N)
         :return: (T, B, N, H)
         '''
+        if self.use_sdpa and not self.pack_agents:
+            return sdpa_encoder(layer, agents_emb, agent_masks.transpose(0, 1), dim=2)
         T_obs = agents_emb.size(0)
         B = agent_masks.size(0)
         agents_emb = agents_emb.permute(2, 1, 0, 3).reshape(self._M + 1, B * T_obs, -1)
-        agents_soc_emb = layer(agents_emb, src_key_padding_mask=agent_masks.view(-1, self._M+1))
+        if self.pack_agents:
+            agents_soc_emb = packed_encoder_layer(layer, agents_emb, agent_masks.view(-1, self._M+1))
+        else:
+            agents_soc_emb = layer(agents_emb, src_key_padding_mask=agent_masks.view(-1, self._M+1))
         agents_soc_emb = agents_soc_emb.view(self._M+1, B, T_obs, -1).permute(2, 1, 0, 3)
         return agents_soc_emb
 
@@ -254,41 +270,95 @@ class AutoBotEgo(nn.Module):
             agents_emb = self.social_attn_fn(agents_emb, opps_masks, layer=self.social_attn_layers[i])
         ego_soctemp_emb = agents_emb[:, :, 0]  # take ego-agent encodings only. 8 159 128
 
+        return self.decode(ego_soctemp_emb, env_masks, roads)
+
+    def forward_counterfactual(self, ego_in, agents_in, roads, removed_agents):
+        '''
+        Same as forward for every factual scene followed by its counterfactual scenes, in which one of the other agents
+        is removed, without running the per-agent part of the encoder again for every counterfactual. The dynamic
+        encoder and the first temporal attention layer see each agent on its own, so their outputs are computed once on
+        the factual scenes and shared with the counterfactuals, in which the removed agent is masked out; only the
+        layers mixing agents (and the following ones) are run per scene.
+        :param ego_in, agents_in, roads: factual scenes, see forward.
+        :param removed_agents: list of B LongTensors, removed_agents[b][j] being the index in agents_in[b] of the agent
+                               removed in the j-th counterfactual scene of sample b.
+        :return: pred_obs [c, T, S, 5], mode_probs [S, c] (and the embeddings [S, projector_dim] if
+                 self.return_embeddings) of the S = B + sum_b len(removed_agents[b]) scenes, and data_splits [B+1],
+                 the scenes data_splits[b]:data_splits[b+1] being the factual scene b followed by its counterfactuals
+                 (the layout of my_collate_fn).
+        '''
+        B = ego_in.size(0)
+        device = ego_in.device
+
+        ego_tensor, _agents_tensor, opps_masks, env_masks = self.process_observations(ego_in, agents_in)
+        agents_tensor = torch.cat((ego_tensor.unsqueeze(2), _agents_tensor), dim=2)
+        agents_emb = self.agents_dynamic_encoder(agents_tensor).permute(1, 0, 2, 3)
+        agents_emb = self.temporal_attn_fn(agents_emb, opps_masks, layer=self.temporal_attn_layers[0])
+
+        # scene_samples[s] is the factual sample of scene s, scene_removed[s] the removed agent in it (-1 if none).
+        num_scenes = torch.tensor([1 + len(removed) for removed in removed_agents], device=device)
+        data_splits = torch.zeros(B + 1, dtype=torch.long)
+        data_splits[1:] = torch.cumsum(num_scenes, 0).cpu()
+        scene_samples = torch.repeat_interleave(torch.arange(B, device=device), num_scenes)
+        scene_removed = torch.cat([torch.cat((torch.tensor([-1], device=device), removed.to(device)))
+                                   for removed in removed_agents])
+
+        agents_emb = agents_emb[:, scene_samples]
+        opps_masks = opps_masks[scene_samples]
+        counterfactuals = scene_removed >= 0
+        opps_masks[counterfactuals, :, scene_removed[counterfactuals] + 1] = True  # + 1 as agent 0 is the ego-agent.
+        env_masks = env_masks[scene_samples]
+        roads = roads[scene_samples]
+
+        for i in range(self.L_enc):
+            if i > 0:
+                agents_emb = self.temporal_attn_fn(agents_emb, opps_masks, layer=self.temporal_attn_layers[i])
+            agents_emb = self.social_attn_fn(agents_emb, opps_masks, layer=self.social_attn_layers[i])
+        ego_soctemp_emb = agents_emb[:, :, 0]
+
+        return (*self.decode(ego_soctemp_emb, env_masks, roads), data_splits)
+
+    def decode(self, ego_soctemp_emb, env_masks, roads):
+        '''
+        :param ego_soctemp_emb: (T_obs, B, H) encodings of the ego-agent.
+        :param env_masks: (B, T_obs) masks of the ego-agent, from process_observations.
+        :param roads: see forward.
+        :return: see forward.
+        '''
+        B = ego_soctemp_emb.size(1)
+
         # Pass the embeddings through the projector
         if self.return_embeddings:
-            ret_embeds = self.contrastive_projector(ego_soctemp_emb.permute(1, 0, 2).view(B, -1))
+            ret_embeds = self.contrastive_projector(ego_soctemp_emb.permute(1, 0, 2).reshape(B, -1))
             ret_embeds = nn.functional.normalize(ret_embeds, p=2, dim=1)
 
         # Process map information
         if self.use_map_img:
             orig_map_features = self.map_encoder(roads)
-            map_features = orig_map_features.view(B * self.c, -1).unsqueeze(0).repeat(self.T, 1, 1)
+            map_features = orig_map_features.view(1, B * self.c, -1).expand(self.T, -1, -1)
         elif self.use_map_lanes:
             orig_map_features, orig_road_segs_masks = self.map_encoder(roads, ego_soctemp_emb)
-            map_features = orig_map_features.unsqueeze(2).repeat(1, 1, self.c, 1).view(-1, B*self.c, self.d_k)
-            road_segs_masks = orig_road_segs_masks.unsqueeze(1).repeat(1, self.c, 1).view(B*self.c, -1)
-
-        # Repeat the tensors for the number of modes for efficient forward pass.
-        context = ego_soctemp_emb.unsqueeze(2).repeat(1, 1, self.c, 1)
-        context = context.view(-1, B*self.c, self.d_k)
 
-        # AutoBot-Ego Decoding
+        # AutoBot-Ego Decoding. The context and map features of a scene are shared by its c modes (see
+        # shared_memory_attn) instead of being repeated for every mode.
         out_seq = self.Q.repeat(1, B, 1, 1).view(self.T, B*self.c, -1)
-        time_masks = self.generate_decoder_mask(seq_len=self.T, device=ego_in.device)
+        time_masks = self.generate_decoder_mask(seq_len=self.T, device=ego_soctemp_emb.device)
         for d in range(self.L_dec):
             if self.use_map_img and d == 1:
                 ego_dec_emb_map = torch.cat((out_seq, map_features), dim=-1)
                 out_seq = self.emb_state_map(ego_dec_emb_map) + out_seq
             elif self.use_map_lanes and d == 1:
-                ego_dec_emb_map = self.map_attn_layers(query=out_seq, key=map_features, value=map_features,
-                                                       key_padding_mask=road_segs_masks)[0]
+                ego_dec_emb_map = shared_memory_attn(self.map_attn_layers, out_seq, orig_map_features, self.c,
+                                                     key_padding_mask=orig_road_segs_masks, use_sdpa=self.use_sdpa)
                 out_seq = out_seq + ego_dec_emb_map
-            out_seq = self.tx_decoder[d](out_seq, context, tgt_mask=time_masks, memory_key_padding_mask=env_masks)
+            out_seq = shared_memory_decoder_layer(self.tx_decoder[d], out_seq, ego_soctemp_emb, self.c,
+                                                  tgt_mask=time_masks, memory_key_padding_mask=env_masks,
+                                                  use_sdpa=self.use_sdpa)
         out_dists = self.output_model(out_seq).reshape(self.T, B, self.c, -1).permute(2, 0, 1, 3)
         # breakpoint()
 
         # Mode prediction
-        mode_params_emb = self.P.repeat(1, B, 1)
+        mode_params_emb = self.P.expand(-1, B, -1)
         mode_params_emb = self.prob_decoder(query=mode_params_emb, key=ego_soctemp_emb, value=ego_soctemp_emb)[0]
         if self.use_map_img:
             mode_params_emb = self.modemap_net(torch.cat((mode_params_emb, orig_map_features.transpose(0, 1)), dim=-1))
@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from models.attention_utils import SDPA_AVAILABLE, sdpa_encoder, shared_memory_attn, shared_memory_decoder_layer
 from models.context_encoders import MapEncoderPtsMA
 
 
@@ -28,10 +29,10 @@ class PositionalEncoding(nn.Module):
 
     def forward(self, x):
         '''
-        :param x: must be (T, B, H)
+        :param x: must be (T, B, H) or (T, B, N, H)
         :return:
         '''
-        x = x + self.pe[:x.size(0), :]
+        x = x + self.pe[:x.size(0)].view(x.size(0), *([1] * (x.dim() - 2)), -1)
         return self.dropout(x)
 
 
@@ -77,7 +78,8 @@ class AutoBotJoint(nn.Module):
     AutoBot-Joint Class.
     '''
     def __init__(self, d_k=128, _M=5, c=5, T=30, L_enc=1, dropout=0.0, k_attr=2, map_attr=3, num_heads=16, L_dec=1,
-                 tx_hidden_size=384, use_map_lanes=False, num_agent_types=None, predict_yaw=False):
+                 tx_hidden_size=384, use_map_lanes=False, num_agent_types=None, predict_yaw=False, mode_chunk_size=0,
+                 use_sdpa=False):
         super(AutoBotJoint, self).__init__()
 
         init_ = lambda m: init(m, nn.init.xavier_normal_, lambda x: nn.init.constant_(x, 0), np.sqrt(2))
@@ -95,6 +97,11 @@ class AutoBotJoint(nn.Module):
         self.tx_hidden_size = tx_hidden_size
         self.use_map_lanes = use_map_lanes
         self.predict_yaw = predict_yaw
+        self.mode_chunk_size = mode_chunk_size  # modes decoded at once, to bound the decoder memory (0 for all).
+        # attention computed with F.scaled_dot_product_attention (see sdpa_attn), from the same parameters.
+        self.use_sdpa = use_sdpa and SDPA_AVAILABLE
+        if use_sdpa and not SDPA_AVAILABLE:
+            print("scaled_dot_product_attention needs torch >= 2.0, using nn.MultiheadAttention instead.")
 
         # INPUT ENCODERS
         self.agents_dynamic_encoder = nn.Sequential(init_(nn.Linear(self.k_attr, self.d_k)))
@@ -185,6 +192,10 @@ class AutoBotJoint(nn.Module):
         :return: (T, B, N, H)
         '''
         T_obs = agents_emb.size(0)
+        if self.use_sdpa:
+            temp_masks = agent_masks.transpose(1, 2).clone()
+            temp_masks[:, :, -1][temp_masks.sum(-1) == T_obs] = False
+            return sdpa_encoder(layer, self.pos_encoder(agents_emb), temp_masks, dim=0)
         B = agent_masks.size(0)
         agent_masks = agent_masks.permute(0, 2, 1).reshape(-1, T_obs)
         agent_masks[:, -1][agent_masks.sum(-1) == T_obs] = False  # Ensure agent's that don't exist don't throw NaNs.
@@ -198,6 +209,8 @@ class AutoBotJoint(nn.Module):
         :param agent_masks: (B, T, N)
         :return: (T, B, N, H)
         '''
+        if self.use_sdpa:
+            return sdpa_encoder(layer, agents_emb, agent_masks.transpose(0, 1), dim=2)
         T_obs = agents_emb.size(0)
         B = agent_masks.size(0)
         agents_emb = agents_emb.permute(2, 1, 0, 3).reshape(self._M + 1, B * T_obs, -1)
@@ -207,37 +220,77 @@ class AutoBotJoint(nn.Module):
 
     def temporal_attn_decoder_fn(self, agents_emb, context, agent_masks, layer):
         '''
-        :param agents_emb: (T, BK, N, H)
-        :param context: (T_in, BK, N, H)
-        :param agent_masks: (BK, T, N)
-        :return: (T, BK, N, H)
+        :param agents_emb: (T, B, N, K, H) for K modes.
+        :param context: (T_in, B, N, H) shared by the K modes (see shared_memory_attn).
+        :param agent_masks: (B, T_in, N)
+        :return: (T, B, N, K, H)
         '''
         T_obs = context.size(0)
-        BK = agent_masks.size(0)
+        B, N, K = agents_emb.shape[1:4]
         time_masks = self.generate_decoder_mask(seq_len=self.T, device=agents_emb.device)
         agent_masks = agent_masks.permute(0, 2, 1).reshape(-1, T_obs)
         agent_masks[:, -1][agent_masks.sum(-1) == T_obs] = False  # Ensure that agent's that don't exist don't make NaN.
-        agents_emb = agents_emb.reshape(self.T, -1, self.d_k)  # [T, BxKxN, H]
-        context = context.view(-1, BK*(self._M+1), self.d_k)
+        agents_temp_emb = agents_emb.reshape(self.T, -1, self.d_k)  # [T, BxNxK, H]
+        context = context.reshape(T_obs, B*N, self.d_k)
 
-        agents_temp_emb = layer(agents_emb, context, tgt_mask=time_masks, memory_key_padding_mask=agent_masks)
-        agents_temp_emb = agents_temp_emb.view(self.T, BK, self._M+1, -1)
-
-        return agents_temp_emb
+        for decoder_layer in layer.layers:
+            agents_temp_emb = shared_memory_decoder_layer(decoder_layer, agents_temp_emb, context, K,
+                                                          tgt_mask=time_masks, memory_key_padding_mask=agent_masks,
+                                                          use_sdpa=self.use_sdpa)
+        if layer.norm is not None:
+            agents_temp_emb = layer.norm(agents_temp_emb)
+        return agents_temp_emb.view(self.T, B, N, K, -1)
 
     def social_attn_decoder_fn(self, agents_emb, agent_masks, layer):
         '''
-        :param agents_emb: (T, BK, N, H)
-        :param agent_masks: (BK, T, N)
-        :return: (T, BK, N, H)
+        :param agents_emb: (T, B, N, K, H) for K modes.
+        :param agent_masks: (B, T_in, N)
+        :return: (T, B, N, K, H)
         '''
-        B = agent_masks.size(0)
-        agent_masks = agent_masks[:, -1:].repeat(1, self.T, 1).view(-1, self._M + 1)  # take last timestep of all agents.
-        agents_emb = agents_emb.permute(2, 1, 0, 3).reshape(self._M + 1, B * self.T, -1)
+        B, N, K = agents_emb.shape[1:4]
+        if self.use_sdpa:
+            agent_masks = agent_masks[:, -1].view(1, B, 1, N).expand(self.T, B, K, N)  # last timestep of all agents.
+            return sdpa_encoder(layer, agents_emb, agent_masks, dim=2)
+        agent_masks = agent_masks[:, -1:].expand(B, K * self.T, N).reshape(-1, N)  # take last timestep of all agents.
+        agents_emb = agents_emb.permute(2, 1, 3, 0, 4).reshape(N, B * K * self.T, -1)
         agents_soc_emb = layer(agents_emb, src_key_padding_mask=agent_masks)
-        agents_soc_emb = agents_soc_emb.view(self._M + 1, B, self.T, -1).permute(2, 1, 0, 3)
+        agents_soc_emb = agents_soc_emb.view(N, B, K, self.T, -1).permute(3, 1, 0, 2, 4)
         return agents_soc_emb
 
+    def decode(self, modes, context, agent_masks, agent_types_features, map_features=None, road_segs_masks=None):
+        '''
+        Decodes the modes given by the slice modes of the c modes. The decoder inputs, its context and the map features
+        are shared by all modes (see shared_memory_attn), so that decoding in chunks of modes only needs the memory of
+        the decoder activations of one chunk at a time.
+        :param context: (T_in, B, N, H) output of the encoder.
+        :param agent_masks: (B, T_in, N)
+        :param agent_types_features: (B, N, H) agent types projected by the first layer of dec_agenttypes_encoder.
+        :param map_features: (S, B*N, H) and road_segs_masks: (B*N, S) if self.use_map_lanes.
+        :return: (K, T, B, N, 5(6)) for the K modes of the slice.
+        '''
+        B, N = agent_types_features.shape[:2]
+
+        # The first layer of dec_agenttypes_encoder takes the concatenation of Q and the agent types features, it is
+        # applied to both separately and summed instead of concatenating them for every time, mode and agent.
+        dec_parameters = F.linear(self.Q[:, :, modes].transpose(2, 3), self.dec_agenttypes_encoder[0].weight[:, :self.d_k])
+        dec_parameters = dec_parameters + agent_types_features.unsqueeze(2)  # [T, B, N, K, H]
+        agents_dec_emb = self.dec_agenttypes_encoder[1:](dec_parameters)
+        K = agents_dec_emb.size(3)
+
+        for d in range(self.L_dec):
+            if self.use_map_lanes and d == 1:
+                agents_dec_emb = agents_dec_emb.reshape(self.T, -1, self.d_k)
+                agents_dec_emb_map = shared_memory_attn(self.map_attn_layers, agents_dec_emb, map_features, K,
+                                                        key_padding_mask=road_segs_masks, use_sdpa=self.use_sdpa)
+                agents_dec_emb = agents_dec_emb + agents_dec_emb_map
+                agents_dec_emb = agents_dec_emb.reshape(self.T, B, N, K, -1)
+
+            agents_dec_emb = self.temporal_attn_decoder_fn(agents_dec_emb, context, agent_masks, layer=self.temporal_attn_decoder_layers[d])
+            agents_dec_emb = self.social_attn_decoder_fn(agents_dec_emb, agent_masks, layer=self.social_attn_decoder_layers[d])
+
+        out_dists = self.output_model(agents_dec_emb.reshape(self.T, -1, self.d_k))
+        return out_dists.reshape(self.T, B, N, K, -1).permute(3, 0, 1, 2, 4)
+
     def forward(self, ego_in, agents_in, roads, agent_types):
         '''
         :param ego_in: one agent called ego, shape [B, T_obs, k_attr+1] with last values being the existence mask.
@@ -263,50 +316,30 @@ class AutoBotJoint(nn.Module):
             agents_emb = self.social_attn_fn(agents_emb, opps_masks, layer=self.social_attn_layers[i])
 
         # Process map information
+        map_features, road_segs_masks = None, None
         if self.use_map_lanes:
             orig_map_features, orig_road_segs_masks = self.map_encoder(roads, agents_emb)
-            map_features = orig_map_features.unsqueeze(2).repeat(1, 1, self.c, 1, 1).view(-1, B * self.c * (self._M+1), self.d_k)
-            road_segs_masks = orig_road_segs_masks.unsqueeze(2).repeat(1, self.c, 1, 1).view(B * self.c * (self._M+1), -1)
-
-        # Repeat the tensors for the number of modes.
-        opps_masks_modes = opps_masks.unsqueeze(1).repeat(1, self.c, 1, 1).view(B*self.c, ego_in.shape[1], -1)
-        context = agents_emb.unsqueeze(2).repeat(1, 1, self.c, 1, 1)
-        context = context.view(ego_in.shape[1], B*self.c, self._M+1, self.d_k)
+            map_features = orig_map_features.view(-1, B*(self._M+1), self.d_k)
+            road_segs_masks = orig_road_segs_masks.view(B*(self._M+1), -1)
 
         # embed agent types
-        agent_types_features = self.emb_agent_types(agent_types).unsqueeze(1).\
-            repeat(1, self.c, 1, 1).view(-1, self._M+1, self.d_k)
-        agent_types_features = agent_types_features.unsqueeze(0).repeat(self.T, 1, 1, 1)
+        agent_types_features = F.linear(self.emb_agent_types(agent_types),
+                                        self.dec_agenttypes_encoder[0].weight[:, self.d_k:],
+                                        self.dec_agenttypes_encoder[0].bias)
 
-        # AutoBot-Joint Decoding
-        dec_parameters = self.Q.repeat(1, B, 1, self._M+1, 1).view(self.T, B*self.c, self._M+1, -1)
-        dec_parameters = torch.cat((dec_parameters, agent_types_features), dim=-1)
-        dec_parameters = self.dec_agenttypes_encoder(dec_parameters)
-        agents_dec_emb = dec_parameters
-
-        for d in range(self.L_dec):
-            if self.use_map_lanes and d == 1:
-                agents_dec_emb = agents_dec_emb.reshape(self.T, -1, self.d_k)
-                agents_dec_emb_map = self.map_attn_layers(query=agents_dec_emb, key=map_features, value=map_features,
-                                                          key_padding_mask=road_segs_masks)[0]
-                agents_dec_emb = agents_dec_emb + agents_dec_emb_map
-                agents_dec_emb = agents_dec_emb.reshape(self.T, B*self.c, self._M+1, -1)
-
-            agents_dec_emb = self.temporal_attn_decoder_fn(agents_dec_emb, context, opps_masks_modes, layer=self.temporal_attn_decoder_layers[d])
-            agents_dec_emb = self.social_attn_decoder_fn(agents_dec_emb, opps_masks_modes, layer=self.social_attn_decoder_layers[d])
-
-        out_dists = self.output_model(agents_dec_emb.reshape(self.T, -1, self.d_k))
-        out_dists = out_dists.reshape(self.T, B, self.c, self._M+1, -1).permute(2, 0, 1, 3, 4)
+        # AutoBot-Joint Decoding, self.mode_chunk_size modes at a time.
+        mode_chunk_size = self.mode_chunk_size if self.mode_chunk_size > 0 else self.c
+        out_dists = torch.cat([self.decode(slice(start, start + mode_chunk_size), agents_emb, opps_masks,
+                                           agent_types_features, map_features, road_segs_masks)
+                               for start in range(0, self.c, mode_chunk_size)], dim=0)
 
         # Mode prediction
-        mode_params_emb = self.P.repeat(1, B, self._M+1, 1).view(self.c, -1, self.d_k)
+        mode_params_emb = self.P.expand(-1, B, self._M+1, -1).reshape(self.c, -1, self.d_k)
         mode_params_emb = self.prob_decoder(query=mode_params_emb, key=agents_emb.reshape(-1, B*(self._M+1), self.d_k),
                                             value=agents_emb.reshape(-1, B*(self._M+1), self.d_k))[0]
         if self.use_map_lanes:
-            orig_map_features = orig_map_features.view(-1, B*(self._M+1), self.d_k)
-            orig_road_segs_masks = orig_road_segs_masks.view(B*(self._M+1), -1)
-            mode_params_emb = self.mode_map_attn(query=mode_params_emb, key=orig_map_features, value=orig_map_features,
-                                                 key_padding_mask=orig_road_segs_masks)[0] + mode_params_emb
+            mode_params_emb = self.mode_map_attn(query=mode_params_emb, key=map_features, value=map_features,
+                                                 key_padding_mask=road_segs_masks)[0] + mode_params_emb
 
         mode_probs = self.prob_predictor(mode_params_emb).squeeze(-1).view(self.c, B, self._M+1).sum(2).transpose(0, 1)
         mode_probs = F.softmax(mode_probs, dim=1)
@@ -4,6 +4,18 @@ import os
 from collections import namedtuple
 
 
+def add_dataloader_args(parser):
+    parser.add_argument("--num-workers", type=int, default=12, help="Number of DataLoader worker processes.")
+    parser.add_argument("--pin-memory", action="store_true",
+                        help="Collate batches in pinned memory, so that they are copied asynchronously to the GPU.")
+    parser.add_argument("--persistent-workers", action="store_true",
+                        help="Keep the DataLoader workers alive from one epoch to the next.")
+    parser.add_argument("--prefetch-factor", type=int, default=2, help="Number of batches loaded ahead by each worker.")
+    parser.add_argument("--prefetch-batches", type=int, default=0,
+                        help="If > 0, number of batches copied to the GPU (or loaded, without GPU) in the background "
+                             "ahead of the batch in use.")
+
+
 def get_train_args():
     parser = argparse.ArgumentParser(description="AutoBots")
     # Section: General Configuration
@@ -18,8 +30,18 @@ def get_train_args():
                                                                        "interaction-dataset", "synth", "s2r"],
                         help="Dataset to train on.")
     parser.add_argument("--dataset-path", type=str, required=True, help="Path to dataset files.")
+    parser.add_argument("--synth-format", type=str, default="pickle", choices=["pickle", "packed", "materialized"],
+                        help="Storage format of Synth-v1 (packed/materialized are created by "
+                             "datasets/synth/create_packed_synth.py).")
     parser.add_argument("--use-map-image", type=bool, default=False, help="Use map image if applicable.")
     parser.add_argument("--use-map-lanes", type=bool, default=False, help="Use map lanes if applicable.")
+    parser.add_argument("--h5-block-size", type=int, default=0,
+                        help="If > 0, training batches of the HDF5 datasets are made of shuffled blocks of this many "
+                             "consecutive scenes, which are read with one slice per field.")
+    parser.add_argument("--device-dataset", action="store_true",
+                        help="Keep the whole train and val splits on the device and gather batches there, instead of "
+                             "using DataLoader workers (only for the small synth, s2r and trajnet++ datasets).")
+    add_dataloader_args(parser)
 
     # Section: Algorithm
     parser.add_argument("--model-type", type=str, default="Autobot-Ego", choices=["Autobot-Joint", "Autobot-Ego"],
@@ -39,6 +61,13 @@ def get_train_args():
     parser.add_argument("--projector-dim1", type=int, default=256, help="Projector's first hidden dim.")
     parser.add_argument("--projector-dim2", type=int, default=128, help="Projector's second hidden dim.")
     parser.add_argument("--projector-dim3", type=int, default=0, help="Projector's third hidden dim.")
+    parser.add_argument("--pack-agents", action="store_true",
+                        help="Run the social attention layers of AutoBot-Ego only over the agents present at each "
+                             "timestep, by bucketing scenes by number of agents, instead of over all the padded agent "
+                             "slots.")
+    parser.add_argument("--sdpa-attention", action="store_true",
+                        help="Compute the attention of the transformer layers with scaled_dot_product_attention "
+                             "(torch >= 2.0). Models are interchangeable with the default path.")
 
     # Section: Loss Function
     parser.add_argument("--entropy-weight", type=float, default=40.0, metavar="lamda", help="Weight of entropy loss.")
@@ -83,6 +112,14 @@ def get_train_args():
 
     if args.use_map_image and args.use_map_lanes:
         raise Exception('We do not support having both the map image and the map lanes...')
+    if args.device_dataset and args.dataset not in ["synth", "s2r", "trajnet++"]:
+        # the H5 splits do not fit on the device, and their per-sample randomness (e.g. nuScenes mirroring,
+        # Interaction ego choice) would be frozen by loading every sample once.
+        parser.error("--device-dataset is only supported for synth, s2r and trajnet++, not %s." % args.dataset)
+    if args.pack_agents and "Joint" in args.model_type:
+        # AutoBot-Joint predicts (and is scored on) the agents absent at the last observed timestep too, whose
+        # encodings packing would leave out of the social layers.
+        parser.error("--pack-agents is only supported for Autobot-Ego.")
 
     # Perform config checks
     if "trajnet" in args.dataset:
@@ -109,9 +146,18 @@ def get_eval_args():
     parser.add_argument("--dataset", type=str, default="synth", choices=["Argoverse", "Nuscenes", "trajnet++",
                                                                        "interaction-dataset", "synth", 's2r'], help="Dataset to evaluate on.")
     parser.add_argument("--dataset-path", type=str, required=True, help="Dataset path.")
+    parser.add_argument("--synth-format", type=str, default="pickle", choices=["pickle", "packed", "materialized"],
+                        help="Storage format of Synth-v1 (packed/materialized are created by "
+                             "datasets/synth/create_packed_synth.py).")
     parser.add_argument("--batch-size", type=int, default=50, help="Batch size")
     parser.add_argument("--disable-cuda", action="store_true", help="Disable CUDA")
     parser.add_argument("--evaluate_causal", action="store_true", help="Evaluates causality understanding metrics.")
+    parser.add_argument("--sdpa-attention", action="store_true",
+                        help="Compute the attention of the transformer layers with scaled_dot_product_attention "
+                             "(torch >= 2.0).")
+    parser.add_argument("--mode-chunk-size", type=int, default=0,
+                        help="Number of modes decoded at once by AutoBot-Joint, to bound its memory use (0 for all).")
+    add_dataloader_args(parser)
     args = parser.parse_args()
 
     config, model_dirname = load_config(args.models_path)
@@ -0,0 +1,85 @@
+import os
+import pickle
+import warnings
+
+import numpy as np
+import pytest
+import torch
+
+from datasets.synth.dataset import SynthV1CausalDataset, my_collate_fn
+from models.autobot_ego import AutoBotEgo
+from utils.train_helpers import calc_consistency_loss, forward_f_cf
+
+
+def make_scene(rng, num_agents, changed_past_agent=None):
+    # trajectories of shape (agent, time, 2), the counterfactual i being the scene without agent i, in which only the
+    # future of the other agents changes (unless changed_past_agent, whose counterfactual changes the ego's past too).
+    trajectories = np.cumsum(rng.normal(size=(num_agents, 20, 2)), axis=1) + rng.uniform(-10, 10, (num_agents, 1, 2))
+    remove_agent_i_trajectories = np.repeat(trajectories[np.newaxis], num_agents, axis=0)
+    for i in range(1, num_agents):
+        remove_agent_i_trajectories[i, i] = np.nan
+        remove_agent_i_trajectories[i, :i, 8:] += rng.normal(scale=0.1, size=(i, 12, 2))
+        remove_agent_i_trajectories[i, i + 1:, 8:] += rng.normal(scale=0.1, size=(num_agents - i - 1, 12, 2))
+    if changed_past_agent is not None:
+        remove_agent_i_trajectories[changed_past_agent, 0, :8] += 0.5
+    causality_labels = rng.uniform(size=(num_agents, 20, num_agents)) > 0.8
+    return {"trajectories": trajectories, "remove_agent_i_trajectories": remove_agent_i_trajectories,
+            "causality_labels": causality_labels}
+
+
+def make_batch(tmp_path, scenes):
+    os.makedirs(os.path.join(tmp_path, "train"))
+    for idx, scene in enumerate(scenes):
+        with open(os.path.join(tmp_path, "train", "scene_" + str(idx) + ".pkl"), "wb") as f:
+            pickle.dump(scene, f)
+    dset = SynthV1CausalDataset(str(tmp_path), split="train")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # nanmin of the removed agents in drop_distant.
+        return my_collate_fn([dset[idx] for idx in range(len(dset))])
+
+
+def make_model(num_others, **kwargs):
+    torch.manual_seed(0)
+    return AutoBotEgo(k_attr=2, d_k=32, _M=num_others, c=3, T=12, L_enc=2, dropout=0.0, num_heads=4, L_dec=2,
+                      tx_hidden_size=64, **kwargs).double().eval()
+
+
+@pytest.mark.parametrize("return_embeddings", [False, True])
+def test_forward_f_cf_matches_forward(tmp_path, return_embeddings):
+    rng = np.random.default_rng(0)
+    scenes, causal_effects, _, data_splits, removed_agents = make_batch(
+        tmp_path, [make_scene(rng, num_agents) for num_agents in [6, 11, 2]])
+    # every counterfactual removes a different agent of the preprocessed factual scene, whatever the order in which
+    # drop_distant sorts the remaining ones.
+    assert all((removed >= 0).all() for removed in removed_agents)
+    assert [len(removed) for removed in removed_agents] == [5, 10, 1]
+    assert all(sorted(removed.tolist()) == list(range(len(removed))) for removed in removed_agents)
+
+    ego_in, _, agents_in, _, roads, _ = [field.double() for field in scenes]
+    model = make_model(agents_in.size(2), return_embeddings=return_embeddings, projector_dim1=16, projector_dim2=8)
+    with torch.no_grad():
+        expected = model(ego_in, agents_in, roads)
+        outputs = forward_f_cf(model, ego_in, agents_in, roads, data_splits, removed_agents)
+    assert len(outputs) == len(expected)
+    for output, expected_output in zip(outputs, expected):
+        torch.testing.assert_close(output, expected_output)
+
+    causal_effects = [torch.as_tensor(causal_effect) for causal_effect in causal_effects]
+    torch.testing.assert_close(calc_consistency_loss(outputs[0], causal_effects, data_splits),
+                               calc_consistency_loss(expected[0], causal_effects, data_splits))
+
+
+def test_forward_f_cf_falls_back_to_forward(tmp_path):
+    rng = np.random.default_rng(1)
+    scenes, _, _, data_splits, removed_agents = make_batch(
+        tmp_path, [make_scene(rng, 5), make_scene(rng, 7, changed_past_agent=3)])
+    assert (removed_agents[0] >= 0).all()
+    assert (removed_agents[1] == -1).sum() == 1
+
+    ego_in, _, agents_in, _, roads, _ = [field.double() for field in scenes]
+    model = make_model(agents_in.size(2))
+    with torch.no_grad():
+        expected = model(ego_in, agents_in, roads)
+        outputs = forward_f_cf(model, ego_in, agents_in, roads, data_splits, removed_agents)
+    for output, expected_output in zip(outputs, expected):
+        torch.testing.assert_close(output, expected_output)
@@ -9,15 +9,17 @@ from torch.optim.lr_scheduler import MultiStepLR
 from torch.utils.tensorboard import SummaryWriter
 
 from datasets.argoverse.dataset import ArgoH5Dataset
+from datasets.h5_dataset import H5Dataset, BlockBatchSampler, h5_worker_init_fn
 from datasets.interaction_dataset.dataset import InteractionDataset
 from datasets.nuscenes.dataset import NuscenesH5Dataset
-from datasets.synth.dataset import SynthV1CausalDataset, my_collate_fn
+from datasets.synth.dataset import SYNTH_DATASET_FORMATS, my_collate_fn
 from datasets.trajnetpp.dataset import TrajNetPPDataset
 from models.autobot_ego import AutoBotEgo
 from models.autobot_joint import AutoBotJoint
 from process_args import get_train_args
+from utils.data_helpers import DeviceDataLoader, SynthDeviceDataLoader, get_dataloader_kwargs, prefetch
 from utils.metric_helpers import min_xde_K
-from utils.train_helpers import nll_loss_multimodes, nll_loss_multimodes_joint, calc_consistency_loss, HNC_ARS, calc_contrastive_loss, calc_ranking_loss, ACEs
+from utils.train_helpers import nll_loss_multimodes, nll_loss_multimodes_joint, calc_consistency_loss, HNC_ARS, calc_contrastive_loss, calc_ranking_loss, ACEs, forward_f_cf
 import wandb
 import pickle
 
@@ -65,6 +67,7 @@ class Trainer:
         self.smallest_minfde_k = 5.0  # for computing best models
 
     def initialize_dataloaders(self):
+        synth_dset_cls = SYNTH_DATASET_FORMATS[self.args.synth_format]
         if "Nuscenes" in self.args.dataset:
             train_dset = NuscenesH5Dataset(dset_path=self.args.dataset_path, split_name="train",
                                            model_type=self.args.model_type, use_map_img=self.args.use_map_image,
@@ -89,14 +92,14 @@ class Trainer:
             val_dset = ArgoH5Dataset(dset_path=self.args.dataset_path, split_name="val",
                                      use_map_lanes=self.args.use_map_lanes)
         elif self.args.dataset == "synth":
-            train_dset = SynthV1CausalDataset(dset_path=self.args.dataset_path, split="train", size=self.args.train_data_size)
-            val_dset = SynthV1CausalDataset(dset_path=self.args.dataset_path, split="val")
+            train_dset = synth_dset_cls(dset_path=self.args.dataset_path, split="train", size=self.args.train_data_size)
+            val_dset = synth_dset_cls(dset_path=self.args.dataset_path, split="val")
         elif self.args.dataset == 's2r':
             # real and sim datasets
             train_dset_real = TrajNetPPDataset(dset_path=self.args.dataset_path_real, split_name="train", proportion=self.args.low_data)
             val_dset_real = TrajNetPPDataset(dset_path=self.args.dataset_path_real, split_name="test")
-            train_dset_sim = SynthV1CausalDataset(dset_path=self.args.dataset_path_synth, split="train", size=self.args.train_data_size) 
-            val_dset_sim = SynthV1CausalDataset(dset_path=self.args.dataset_path_synth, split="val")
+            train_dset_sim = synth_dset_cls(dset_path=self.args.dataset_path_synth, split="train", size=self.args.train_data_size)
+            val_dset_sim = synth_dset_cls(dset_path=self.args.dataset_path_synth, split="val")
         else:
             raise NotImplementedError
 
@@ -116,39 +119,74 @@ class Trainer:
         if "Joint" in self.args.model_type:
             self.num_agent_types = train_dset.num_agent_types
 
-        if self.args.dataset == "synth":
+        loader_kwargs = get_dataloader_kwargs(self.args)
+        if self.args.device_dataset:
+            # whole splits kept on the device, batches are gathered there (synth, s2r and trajnet++ only, see
+            # get_train_args).
+            load_kwargs = {"load_num_workers": self.args.num_workers}
+            if self.args.dataset == "synth":
+                self.train_loader = SynthDeviceDataLoader(train_dset, self.args.batch_size, self.device, my_collate_fn,
+                                                          **load_kwargs)
+                self.val_loader = SynthDeviceDataLoader(val_dset, 512, self.device, my_collate_fn, **load_kwargs)
+            elif self.args.dataset == "s2r":
+                self.train_loader_real = DeviceDataLoader(train_dset_real, self.args.batch_size, self.device,
+                                                          **load_kwargs)
+                self.val_loader = DeviceDataLoader(val_dset_real, self.args.batch_size, self.device, **load_kwargs)
+                self.train_loader_sim = SynthDeviceDataLoader(train_dset_sim, self.args.batch_size_sim, self.device,
+                                                              my_collate_fn, **load_kwargs)
+                self.val_loader_sim = SynthDeviceDataLoader(val_dset_sim, self.args.batch_size_sim, self.device,
+                                                            my_collate_fn, **load_kwargs)
+            else:
+                self.train_loader = DeviceDataLoader(train_dset, self.args.batch_size, self.device, **load_kwargs)
+                self.val_loader = DeviceDataLoader(val_dset, self.args.batch_size, self.device, **load_kwargs)
+        elif self.args.dataset == "synth":
             self.train_loader = torch.utils.data.DataLoader(
-                train_dset, batch_size=self.args.batch_size, shuffle=True, num_workers=12, drop_last=False,
-                pin_memory=False, collate_fn=my_collate_fn
+                train_dset, batch_size=self.args.batch_size, shuffle=True, drop_last=False, collate_fn=my_collate_fn,
+                **loader_kwargs
             )
             self.val_loader = torch.utils.data.DataLoader(
-                val_dset, batch_size=512, shuffle=True, num_workers=12, drop_last=False,
-                pin_memory=False, collate_fn=my_collate_fn
+                val_dset, batch_size=512, shuffle=True, drop_last=False, collate_fn=my_collate_fn, **loader_kwargs
             )
         elif self.args.dataset == "s2r":
             # Real
             self.train_loader_real = torch.utils.data.DataLoader(
-                train_dset_real, batch_size=self.args.batch_size, shuffle=True, num_workers=12, drop_last=False, pin_memory=False
+                train_dset_real, batch_size=self.args.batch_size, shuffle=True, drop_last=False, **loader_kwargs
             )
             self.val_loader = torch.utils.data.DataLoader(
-                val_dset_real, batch_size=self.args.batch_size, shuffle=True, num_workers=12, drop_last=False, pin_memory=False
+                val_dset_real, batch_size=self.args.batch_size, shuffle=True, drop_last=False, **loader_kwargs
             )
             # Sim
             self.train_loader_sim = torch.utils.data.DataLoader(
-                train_dset_sim, batch_size=self.args.batch_size_sim, shuffle=True, num_workers=12, drop_last=False,
-                pin_memory=False, collate_fn=my_collate_fn
+                train_dset_sim, batch_size=self.args.batch_size_sim, shuffle=True, drop_last=False,
+                collate_fn=my_collate_fn, **loader_kwargs
             )
             self.val_loader_sim = torch.utils.data.DataLoader(
-                val_dset_sim, batch_size=self.args.batch_size_sim, shuffle=True, num_workers=12, drop_last=False,
-                pin_memory=False, collate_fn=my_collate_fn
+                val_dset_sim, batch_size=self.args.batch_size_sim, shuffle=True, drop_last=False,
+                collate_fn=my_collate_fn, **loader_kwargs
             )
         else:
-            self.train_loader = torch.utils.data.DataLoader(
-                train_dset, batch_size=self.args.batch_size, shuffle=True, num_workers=12, drop_last=False, pin_memory=False
-            )
+            if self.args.h5_block_size > 0 and isinstance(train_dset, H5Dataset):
+                self.train_loader = torch.utils.data.DataLoader(
+                    train_dset, batch_sampler=BlockBatchSampler(len(train_dset), self.args.batch_size,
+                                                                self.args.h5_block_size),
+                    worker_init_fn=h5_worker_init_fn, **loader_kwargs
+                )
+            else:
+                self.train_loader = torch.utils.data.DataLoader(
+                    train_dset, batch_size=self.args.batch_size, shuffle=True, drop_last=False,
+                    worker_init_fn=h5_worker_init_fn, **loader_kwargs
+                )
             self.val_loader = torch.utils.data.DataLoader(
-                val_dset, batch_size=self.args.batch_size, shuffle=True, num_workers=12, drop_last=False, pin_memory=False
+                val_dset, batch_size=self.args.batch_size, shuffle=True, drop_last=False,
+                worker_init_fn=h5_worker_init_fn, **loader_kwargs
             )
+
+        if self.args.prefetch_batches > 0 and not self.args.device_dataset:
+            # copy (or load, without GPU) the next batches in the background while the model runs on the current one.
+            for loader_name in ["train_loader", "val_loader", "train_loader_real", "train_loader_sim", "val_loader_sim"]:
+                if hasattr(self, loader_name):
+                    setattr(self, loader_name, prefetch(getattr(self, loader_name), self.device,
+                                                        self.args.prefetch_batches))
         
         if self.args.dataset == "s2r":
             print("Train dataset loaded with length", len(train_dset_real))
@@ -175,7 +213,9 @@ class Trainer:
                                             return_embeddings=((self.args.reg_type in ["contrastive", "ranking"] and self.args.dataset == "synth") or self.args.dataset == "s2r"),
                                             projector_dim1=self.args.projector_dim1,
                                             projector_dim2=self.args.projector_dim2,
-                                            projector_dim3=self.args.projector_dim3).to(self.device)
+                                            projector_dim3=self.args.projector_dim3,
+                                            pack_agents=self.args.pack_agents,
+                                            use_sdpa=self.args.sdpa_attention).to(self.device)
 
         elif "Joint" in self.args.model_type:
             self.autobot_model = AutoBotJoint(k_attr=self.k_attr,
@@ -191,7 +231,8 @@ class Trainer:
                                               use_map_lanes=self.args.use_map_lanes,
                                               map_attr=self.map_attr,
                                               num_agent_types=self.num_agent_types,
-                                              predict_yaw=self.predict_yaw).to(self.device)
+                                              predict_yaw=self.predict_yaw,
+                                              use_sdpa=self.args.sdpa_attention).to(self.device)
         else:
             raise NotImplementedError
 
@@ -205,20 +246,20 @@ class Trainer:
 
         if "Joint" in model_type:
             ego_in, ego_out, agents_in, agents_out, context_img, agent_types = data
-            ego_in = ego_in.float().to(self.device)
-            ego_out = ego_out.float().to(self.device)
-            agents_in = agents_in.float().to(self.device)
-            agents_out = agents_out.float().to(self.device)
-            context_img = context_img.float().to(self.device)
-            agent_types = agent_types.float().to(self.device)
+            ego_in = ego_in.float().to(self.device, non_blocking=True)
+            ego_out = ego_out.float().to(self.device, non_blocking=True)
+            agents_in = agents_in.float().to(self.device, non_blocking=True)
+            agents_out = agents_out.float().to(self.device, non_blocking=True)
+            context_img = context_img.float().to(self.device, non_blocking=True)
+            agent_types = agent_types.float().to(self.device, non_blocking=True)
             return ego_in, ego_out, agents_in, agents_out, context_img, agent_types
 
         elif "Ego" in model_type:
             ego_in, ego_out, agents_in, roads = data
-            ego_in = ego_in.float().to(self.device)
-            ego_out = ego_out.float().to(self.device)
-            agents_in = agents_in.float().to(self.device)
-            roads = roads.float().to(self.device)
+            ego_in = ego_in.float().to(self.device, non_blocking=True)
+            ego_out = ego_out.float().to(self.device, non_blocking=True)
+            agents_in = agents_in.float().to(self.device, non_blocking=True)
+            roads = roads.float().to(self.device, non_blocking=True)
             return ego_in, ego_out, agents_in, roads
 
     def _compute_ego_errors(self, ego_preds, ego_gt):
@@ -288,9 +329,9 @@ class Trainer:
 
             for i, data in enumerate(self.train_loader):
                 if self.args.dataset == "synth":
-                    scenes, causal_effects, directly_causals, data_splits = data
-                    causal_effects = [torch.Tensor(causal_effect).float().to(self.device) for causal_effect in causal_effects]
-                    directly_causals = [torch.Tensor(directly_causal).bool().to(self.device) for directly_causal in directly_causals]
+                    scenes, causal_effects, directly_causals, data_splits, removed_agents = data
+                    causal_effects = [torch.as_tensor(causal_effect, dtype=torch.float32, device=self.device) for causal_effect in causal_effects]
+                    directly_causals = [torch.as_tensor(directly_causal, device=self.device).bool() for directly_causal in directly_causals]
                     if self.args.reg_type == "None":
                         scenes = [data[data_splits[:-1]] for data in scenes]
                     elif self.args.reg_type == "augment":
@@ -308,9 +349,9 @@ class Trainer:
                 elif self.args.dataset == "s2r":
                     data_real, data_sim = data
                     # sim 
-                    scenes, causal_effects, directly_causals, data_splits = data_sim 
-                    causal_effects = [torch.Tensor(causal_effect).float().to(self.device) for causal_effect in causal_effects]
-                    directly_causals = [torch.Tensor(directly_causal).bool().to(self.device) for directly_causal in directly_causals]
+                    scenes, causal_effects, directly_causals, data_splits, removed_agents = data_sim 
+                    causal_effects = [torch.as_tensor(causal_effect, dtype=torch.float32, device=self.device) for causal_effect in causal_effects]
+                    directly_causals = [torch.as_tensor(directly_causal, device=self.device).bool() for directly_causal in directly_causals]
                     # augmentation
                     if self.args.reg_type == "augment":
                         mask = np.zeros(len(scenes[0]))
@@ -328,14 +369,21 @@ class Trainer:
                 else:
                     ego_in, ego_out, agents_in, roads = self._data_to_device(data)
 
+                # the factual and counterfactual scenes are encoded together by forward_f_cf, unless augment keeps
+                # only some of them.
                 if self.args.dataset == "synth" and self.args.reg_type in ["contrastive", "ranking"]:
-                    pred_obs, mode_probs, embeds = self.autobot_model(ego_in, agents_in, roads)
+                    pred_obs, mode_probs, embeds = forward_f_cf(self.autobot_model, ego_in, agents_in, roads, data_splits, removed_agents)
+                elif self.args.dataset == "synth" and self.args.reg_type == "consistency":
+                    pred_obs, mode_probs = forward_f_cf(self.autobot_model, ego_in, agents_in, roads, data_splits, removed_agents)
                 elif self.args.dataset == "s2r":
                     # Forward 2 times
                     # Real
                     pred_obs_real, mode_probs_real, embeds_real = self.autobot_model(ego_in_real, agents_in_real, roads_real)
                     # Sim
-                    pred_obs_sim, mode_probs_sim, embeds_sim = self.autobot_model(ego_in_sim, agents_in_sim, roads_sim)
+                    if self.args.reg_type == "augment":
+                        pred_obs_sim, mode_probs_sim, embeds_sim = self.autobot_model(ego_in_sim, agents_in_sim, roads_sim)
+                    else:
+                        pred_obs_sim, mode_probs_sim, embeds_sim = forward_f_cf(self.autobot_model, ego_in_sim, agents_in_sim, roads_sim, data_splits, removed_agents)
                 else:
                     pred_obs, mode_probs = self.autobot_model(ego_in, agents_in, roads)
 
@@ -555,13 +603,13 @@ class Trainer:
                 NC_ACEs, IC_ACEs, DC_ACEs, Ignored_ACEs = [], [], [], []
             for i, data in enumerate(self.val_loader):
                 if self.args.dataset == "synth":
-                    scenes, causal_effects, directly_causals, data_splits = data
+                    scenes, causal_effects, directly_causals, data_splits, removed_agents = data
                     if not self.args.evaluate_causal:
                         scenes = [data[data_splits[:-1]] for data in scenes]
                     ego_in, ego_out, agents_in, _, context_img, _ = self._data_to_device(scenes, "Joint")
                     roads = context_img
-                    causal_effects = [torch.Tensor(causal_effect).float().to(self.device) for causal_effect in causal_effects]
-                    directly_causals = [torch.Tensor(directly_causal).bool().to(self.device) for directly_causal in directly_causals]
+                    causal_effects = [torch.as_tensor(causal_effect, dtype=torch.float32, device=self.device) for causal_effect in causal_effects]
+                    directly_causals = [torch.as_tensor(directly_causal, device=self.device).bool() for directly_causal in directly_causals]
                 elif  "trajnet++" in self.args.dataset:
                     ego_in, ego_out, agents_in, context_img = self._data_to_device(data)
                     roads = context_img
@@ -569,7 +617,9 @@ class Trainer:
                     ego_in, ego_out, agents_in, roads = self._data_to_device(data)
 
                 # encode observations
-                if (self.args.dataset == "synth" and self.args.reg_type in ["contrastive", "ranking"]) or self.args.dataset == "s2r":
+                if self.args.dataset == "synth" and self.args.evaluate_causal:
+                    pred_obs, mode_probs = forward_f_cf(self.autobot_model, ego_in, agents_in, roads, data_splits, removed_agents)[:2]
+                elif (self.args.dataset == "synth" and self.args.reg_type in ["contrastive", "ranking"]) or self.args.dataset == "s2r":
                     pred_obs, mode_probs, _ = self.autobot_model(ego_in, agents_in, roads)
                 else:
                     pred_obs, mode_probs = self.autobot_model(ego_in, agents_in, roads)
@@ -668,7 +718,7 @@ class Trainer:
                         scenes = [data[data_splits[:-1]] for data in scenes]
                     ego_in, ego_out, agents_in, _, context_img, _ = self._data_to_device(scenes, "Joint")
                     roads = context_img
-                    causal_effects = [torch.Tensor(causal_effect).float().to(self.device) for causal_effect in causal_effects]
+                    causal_effects = [torch.as_tensor(causal_effect, dtype=torch.float32, device=self.device) for causal_effect in causal_effects]
                 elif  "trajnet++" in self.args.dataset:
                     ego_in, ego_out, agents_in, _, context_img, _ = self._data_to_device(data, "Joint")
                     roads = context_img
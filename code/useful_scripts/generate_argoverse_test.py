@@ -6,8 +6,10 @@ import torch
 from sklearn.cluster import AgglomerativeClustering
 
 from datasets.argoverse.dataset import ArgoH5Dataset
+from datasets.h5_dataset import h5_worker_init_fn
 from models.autobot_ego import AutoBotEgo
 from process_args import get_eval_args
+from utils.data_helpers import get_dataloader_kwargs
 
 
 def load_model(args, config, k_attr, num_other_agents, pred_horizon, map_attr):
@@ -97,7 +99,8 @@ if __name__ == "__main__":
     args, config, model_dirname = get_eval_args()
     test_argoverse = ArgoH5Dataset(args.dataset_path, split_name="test", use_map_lanes=config['use_map_lanes'])
     test_loader = torch.utils.data.DataLoader(
-        test_argoverse, batch_size=args.batch_size, shuffle=False, num_workers=12, drop_last=False, pin_memory=False
+        test_argoverse, batch_size=args.batch_size, shuffle=False, drop_last=False, worker_init_fn=h5_worker_init_fn,
+        **get_dataloader_kwargs(args)
     )
     print("Test dataset loaded with length", len(test_argoverse))
 
@@ -113,9 +116,9 @@ if __name__ == "__main__":
                 print(i, "/", len(test_argoverse) // args.batch_size)
 
             ego_in, agents_in, roads, extra = data
-            ego_in = ego_in.float().to(device)
-            agents_in = agents_in.float().to(device)
-            roads = roads.float().to(device)
+            ego_in = ego_in.float().to(device, non_blocking=True)
+            agents_in = agents_in.float().to(device, non_blocking=True)
+            roads = roads.float().to(device, non_blocking=True)
 
             pred_obs, mode_probs = autobot_model(ego_in, agents_in, roads)
             pred_obs = pred_obs.cpu().numpy()
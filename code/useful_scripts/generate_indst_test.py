@@ -5,10 +5,8 @@ import glob
 from collections import namedtuple
 
 import pandas as pd
-import xml.etree.ElementTree as xml
 
-from datasets.interaction_dataset.utils import get_x_y_lists, get_subtype, get_type, Point, LL2XYProjector, \
-    get_relation_members
+from datasets.interaction_dataset.utils import load_map_lanes
 from models.autobot_joint import AutoBotJoint
 from process_args import load_config
 
@@ -50,109 +48,6 @@ def get_dataset_files(dataset_root):
     return datafiles
 
 
-def get_map_lanes(filename):
-    print(filename)
-    projector = LL2XYProjector(0.0, 0.0)
-
-    e = xml.parse(filename).getroot()
-
-    point_dict = dict()
-    for node in e.findall("node"):
-        point = Point()
-        point.x, point.y = projector.latlon2xy(float(node.get('lat')), float(node.get('lon')))
-        point_dict[int(node.get('id'))] = point
-
-    unknown_linestring_types = list()
-    road_lines = []
-
-    road_lines_dict = {}
-    exlusion_ids = []
-
-    min_length = 40
-    for way in e.findall('way'):
-        way_type = get_type(way)
-
-        if way_type is None:
-            raise RuntimeError("Linestring type must be specified")
-        elif way_type == "curbstone":
-            mark_type = np.array([1.0, 0.0, 0.0, 1.0])
-        elif way_type == "line_thin":
-            way_subtype = get_subtype(way)
-            if way_subtype == "dashed":
-                mark_type = np.array([1.0, 1.0, 0.0, 1.0])
-            else:
-                mark_type = np.array([0.0, 1.0, 0.0, 1.0])
-        elif way_type == "line_thick":
-            way_subtype = get_subtype(way)
-            if way_subtype == "dashed":
-                mark_type = np.array([1.0, 1.0, 0.0, 1.0])
-            else:
-                mark_type = np.array([0.0, 1.0, 0.0, 1.0])
-        elif way_type == "pedestrian_marking":
-            mark_type = np.array([0.0, 0.0, 1.0, 1.0])
-        elif way_type == "bike_marking":
-            mark_type = np.array([0.0, 0.0, 1.0, 1.0])
-        elif way_type == "stop_line":
-            mark_type = np.array([1.0, 0.0, 1.0, 1.0])
-        elif way_type == "virtual":
-            exlusion_ids.append(way.get("id"))
-            continue
-        elif way_type == "road_border":
-            mark_type = np.array([1.0, 1.0, 1.0, 1.0])
-        elif way_type == "guard_rail":
-            mark_type = np.array([1.0, 1.0, 1.0, 1.0])
-        elif way_type == "traffic_sign":
-            exlusion_ids.append(way.get("id"))
-            continue
-        else:
-            if way_type not in unknown_linestring_types:
-                unknown_linestring_types.append(way_type)
-            continue
-
-        x_list, y_list = get_x_y_lists(way, point_dict)
-        if len(x_list) < min_length:
-            x_list = np.linspace(x_list[0], x_list[-1], min_length).tolist()
-            y_list = np.linspace(y_list[0], y_list[-1], min_length).tolist()
-
-        lane_pts = np.array([x_list, y_list]).transpose()
-        mark_type = np.zeros((len(lane_pts), 4)) + mark_type
-
-        lane_pts = np.concatenate((lane_pts, mark_type), axis=1)
-        road_lines.append(lane_pts)
-        road_lines_dict[way.get("id")] = lane_pts
-
-    new_roads = np.zeros((160, 40, 6))  # empirically found max num roads is 157.
-    for i in range(len(road_lines)):
-        new_roads[i, :len(road_lines[i])] = road_lines[i]
-
-    used_keys_all = []
-    num_relations = len(e.findall('relation'))
-    relation_lanes = np.zeros((num_relations + len(road_lines), 80, 8))
-    counter = 0
-    for rel in e.findall('relation'):
-        rel_lane, used_keys = get_relation_members(rel, road_lines_dict, exlusion_ids)
-        if rel_lane is None:
-            continue
-        used_keys_all += used_keys
-        new_lanes = np.array(rel_lane).reshape((-1, 8))
-        relation_lanes[counter] = new_lanes
-        counter += 1
-
-    # delete all used keys
-    used_keys_all = np.unique(used_keys_all)
-    for used_key in used_keys_all:
-        del road_lines_dict[used_key]
-
-    # add non-used keys
-    for k in road_lines_dict.keys():
-        relation_lanes[counter, :40, :5] = road_lines_dict[k][:, :5]  # rest of state (position (2), and type(3)).
-        relation_lanes[counter, :40, 5:7] = -1.0  # no left-right relationship
-        relation_lanes[counter, :40, 7] = road_lines_dict[k][:, -1]  # mask
-        counter += 1
-
-    return relation_lanes[relation_lanes[:, :, -1].sum(1) > 0]
-
-
 def get_ego_and_agents(agents_data):
     agent_masks = np.ones((*agents_data.shape[:2], 1))
     agents_data = np.concatenate((agents_data, agent_masks), axis=-1)
@@ -289,7 +184,8 @@ if __name__ == '__main__':
 
         # load map
         map_fname = os.path.join(args.dataset_root, "maps", dataf.split("/")[-1].split(".")[0].replace("_obs", ".osm"))
-        roads = get_map_lanes(map_fname)
+        print(map_fname)
+        roads = load_map_lanes(map_fname)
 
         data = pd.read_csv(dataf)
         scene_ids = list(set(data['case_id'].tolist()))
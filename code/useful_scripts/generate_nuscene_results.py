@@ -5,8 +5,10 @@ from nuscenes.prediction import convert_local_coords_to_global
 from sklearn.cluster import AgglomerativeClustering
 
 from datasets.nuscenes.dataset import NuscenesH5Dataset
+from datasets.h5_dataset import h5_worker_init_fn
 from models.autobot_ego import AutoBotEgo
 from process_args import get_eval_args
+from utils.data_helpers import get_dataloader_kwargs
 
 
 def load_model(args, model_config, k_attr, num_other_agents, pred_horizon, map_attr):
@@ -65,7 +67,8 @@ if __name__ == "__main__":
                                  use_map_lanes=model_config.use_map_lanes, rtn_extras=True)
 
     val_loader = torch.utils.data.DataLoader(
-        val_dset, batch_size=args.batch_size, shuffle=False, num_workers=12, drop_last=False, pin_memory=False
+        val_dset, batch_size=args.batch_size, shuffle=False, drop_last=False, worker_init_fn=h5_worker_init_fn,
+        **get_dataloader_kwargs(args)
     )
     print("Val dataset loaded with length", len(val_dset))
 
@@ -79,10 +82,10 @@ if __name__ == "__main__":
                 print(i, "/", len(val_dset) // args.batch_size)
 
             ego_in, ego_out, agents_in, roads, extras = data
-            ego_in = ego_in.float().to(device)
-            ego_out = ego_out.float().to(device)
-            agents_in = agents_in.float().to(device)
-            roads = roads.float().to(device)
+            ego_in = ego_in.float().to(device, non_blocking=True)
+            ego_out = ego_out.float().to(device, non_blocking=True)
+            agents_in = agents_in.float().to(device, non_blocking=True)
+            roads = roads.float().to(device, non_blocking=True)
 
             pred_obs, mode_preds = autobot_model(ego_in, agents_in, roads)
             pred_seqs = pred_obs[:, :, :, :2].cpu().numpy().transpose((2, 0, 1, 3))
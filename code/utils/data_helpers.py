@@ -0,0 +1,219 @@
+from collections import deque
+from itertools import islice
+from queue import Queue, Full
+from threading import Event, Thread
+
+import torch
+from torch.utils.data import DataLoader
+
+
+class DeviceDataLoader:
+    """
+    Replaces a DataLoader for datasets small enough to be kept on the device. All the samples are collated once into
+    float32 device tensors, one per field, and every batch is then gathered from them with an index tensor on the
+    device, so that iterating over the dataset needs no DataLoader workers, collation or host to device copies.
+    """
+    def __init__(self, dataset, batch_size, device, shuffle=True, drop_last=False, load_num_workers=12,
+                 load_batch_size=512):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.index_device = device  # device of the sample indices given to get_batch.
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.load(load_num_workers, load_batch_size)
+
+    def load(self, num_workers, batch_size):
+        batches = list(DataLoader(self.dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers))
+        self.fields = [torch.cat(field).float().to(self.device) for field in zip(*batches)]
+
+    def get_batch(self, indices):
+        return [field[indices] for field in self.fields]
+
+    def __iter__(self):
+        num_samples = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(num_samples, device=self.index_device)
+        else:
+            order = torch.arange(num_samples, device=self.index_device)
+        for start in range(0, num_samples, self.batch_size):
+            if self.drop_last and start + self.batch_size > num_samples:
+                return
+            yield self.get_batch(order[start:start + self.batch_size])
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
+class SynthDeviceDataLoader(DeviceDataLoader):
+    """
+    DeviceDataLoader for the Synth-v1 datasets, yielding the same (scenes, causal_effects, directly_causals,
+    data_splits, removed_agents) batches as a DataLoader using my_collate_fn. The factual and counterfactual scenes of
+    all samples are kept back to back on the device, and the scenes of a batch are gathered with a single index.
+    Sample indices and data_splits stay on the CPU, as data_splits is also used to index numpy arrays.
+    """
+    def __init__(self, dataset, batch_size, device, collate_fn, shuffle=True, drop_last=False, load_num_workers=12,
+                 load_batch_size=512):
+        self.collate_fn = collate_fn
+        super(SynthDeviceDataLoader, self).__init__(dataset, batch_size, device, shuffle=shuffle, drop_last=drop_last,
+                                                    load_num_workers=load_num_workers, load_batch_size=load_batch_size)
+        self.index_device = torch.device("cpu")
+
+    def load(self, num_workers, batch_size):
+        loader = DataLoader(self.dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                            collate_fn=self.collate_fn)
+        scenes, self.causal_effects, self.directly_causals, self.removed_agents, num_scenes = [], [], [], [], []
+        for batch_scenes, batch_causal_effects, batch_directly_causals, batch_data_splits, batch_removed_agents \
+                in loader:
+            scenes.append(batch_scenes)
+            self.causal_effects += [torch.as_tensor(causal_effect, dtype=torch.float32, device=self.device)
+                                    for causal_effect in batch_causal_effects]
+            self.directly_causals += [torch.as_tensor(directly_causal, device=self.device).bool()
+                                      for directly_causal in batch_directly_causals]
+            self.removed_agents += batch_removed_agents
+            num_scenes.append(batch_data_splits[1:] - batch_data_splits[:-1])
+        self.fields = [torch.cat(field).to(self.device) for field in zip(*scenes)]
+        self.num_scenes = torch.cat(num_scenes)
+        self.scene_starts = torch.cumsum(self.num_scenes, 0) - self.num_scenes
+
+    def get_batch(self, indices):
+        num_scenes = self.num_scenes[indices]
+        data_splits = torch.zeros(len(indices) + 1, dtype=torch.long)
+        data_splits[1:] = torch.cumsum(num_scenes, 0)
+        # scenes data_splits[i]:data_splits[i+1] of the batch are the scenes of sample indices[i].
+        scene_indices = (torch.repeat_interleave(self.scene_starts[indices] - data_splits[:-1], num_scenes)
+                         + torch.arange(int(data_splits[-1])))
+
+        scenes = [field[scene_indices.to(self.device)] for field in self.fields]
+        causal_effects = [self.causal_effects[idx] for idx in indices.tolist()]
+        directly_causals = [self.directly_causals[idx] for idx in indices.tolist()]
+        removed_agents = [self.removed_agents[idx] for idx in indices.tolist()]
+        return scenes, causal_effects, directly_causals, data_splits, removed_agents
+
+
+def get_dataloader_kwargs(args):
+    """
+    Returns the DataLoader keyword arguments set by the data loading arguments of process_args.add_dataloader_args.
+    """
+    kwargs = {"num_workers": args.num_workers, "pin_memory": args.pin_memory}
+    if args.num_workers > 0:
+        kwargs.update(persistent_workers=args.persistent_workers, prefetch_factor=args.prefetch_factor)
+    return kwargs
+
+
+def batch_to_device(batch, device, non_blocking=False):
+    """
+    Moves the floating point tensors of a batch (possibly nested in lists and tuples) to device. Other entries, e.g.
+    the data_splits of my_collate_fn which also index numpy arrays, are left as they are.
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking) if batch.is_floating_point() else batch
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to_device(entry, device, non_blocking=non_blocking) for entry in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for entry in batch:
+            _record_stream(entry, stream)
+
+
+class CUDAPrefetcher:
+    """
+    Iterates over a loader while copying the next num_batches batches to the GPU on a side CUDA stream, so that these
+    copies overlap with the computation on the current batch. Copies are only asynchronous for batches in pinned
+    memory (--pin-memory).
+    """
+    def __init__(self, loader, device, num_batches=1):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        self.num_batches = num_batches
+        self.stream = torch.cuda.Stream(device)
+
+    def _copy(self, batch):
+        with torch.cuda.stream(self.stream):
+            return batch_to_device(batch, self.device, non_blocking=True)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        queue = deque(self._copy(batch) for batch in islice(batches, self.num_batches))
+        while queue:
+            batch = queue.popleft()
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # the batch was allocated on the side stream but is used on the current one.
+            _record_stream(batch, current_stream)
+            queue.extend(self._copy(next_batch) for next_batch in islice(batches, 1))
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+
+class ThreadPrefetcher:
+    """
+    Iterates over a loader from a background thread keeping up to num_batches batches ready (and moved to device), so
+    that loading the next batches overlaps with the computation on the current one. Used when there is no GPU.
+    """
+    def __init__(self, loader, device, num_batches=1):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.num_batches)
+        stop = Event()
+        end_of_data = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(batch_to_device(batch, self.device)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(end_of_data)
+
+        thread = Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is end_of_data:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def __len__(self):
+        return len(self.loader)
+
+
+def prefetch(loader, device, num_batches):
+    """
+    Wraps loader in the prefetcher suited to device: a CUDA stream for GPUs, a background thread otherwise.
+    """
+    if device.type == "cuda":
+        return CUDAPrefetcher(loader, device, num_batches)
+    return ThreadPrefetcher(loader, device, num_batches)
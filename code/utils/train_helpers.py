@@ -100,6 +100,19 @@ def l2_loss_fde(pred, data):
     return 100.0 * loss.mean()
 
 
+def forward_f_cf(model, ego_in, agents_in, roads, data_splits, removed_agents):
+    '''
+    Same outputs as model(ego_in, agents_in, roads) on the factual and counterfactual scenes of a my_collate_fn batch.
+    They are computed with model.forward_counterfactual from the factual scenes only, which encodes the agents of a
+    sample once for all its counterfactuals, unless a counterfactual of the batch is not the factual scene without one
+    of its agents (removed agent -1, see get_removed_agents).
+    '''
+    if all(bool((removed >= 0).all()) for removed in removed_agents):
+        factual = data_splits[:-1]
+        return model.forward_counterfactual(ego_in[factual], agents_in[factual], roads[factual], removed_agents)[:-1]
+    return model(ego_in, agents_in, roads)
+
+
 def calc_consistency_loss(pred_obs, causal_effects, data_splits, consistency_weight=1.0):
     consistency_diffs = []
     mse = torch.nn.MSELoss()
@@ -137,9 +150,9 @@ def calc_contrastive_loss(embeds, causal_effects, directly_causals, data_splits,
             k_plus = embeds[data_splits[sample_id] + 1 + positive_id]
 
             if poison_prob > 0:
-                k_negs = embeds[data_splits[sample_id] + 1 + np.where(DC_mask.cpu().numpy())[0]]
+                k_negs = embeds[data_splits[sample_id] + 1 + torch.where(DC_mask)[0]]
             else:
-                k_negs = embeds[data_splits[sample_id] + 1 + np.where(torch.logical_or(DC_mask, IC_mask).cpu().numpy())[0]]
+                k_negs = embeds[data_splits[sample_id] + 1 + torch.where(torch.logical_or(DC_mask, IC_mask))[0]]
 
             numerator = torch.matmul(q, k_plus) / tau
             denominator = torch.exp(numerator) + torch.sum(torch.exp(torch.matmul(k_negs, q) / tau))